@@ -0,0 +1,108 @@
+import importlib
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# ru_maxrss is in bytes on macOS, in kilobytes on Linux and the BSDs
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+# The modules of the methods are imported on their first analysis, which
+# request threads can start together; concurrent imports of skimage can see
+# its modules partially initialized, so they are made one at a time
+_import_lock = threading.Lock()
+
+# quality -> levels of the image pyramid the v2 and v3 skeletons are taken
+# on: full resolution, half and a quarter of it
+QUALITY_LEVELS = {"full": 0, "standard": 1, "preview": 2}
+
+
+def pyramid_levels(quality):
+    """Levels of the image pyramid of a quality, ValueError if it is unknown"""
+    try:
+        return QUALITY_LEVELS[quality]
+    except KeyError:
+        raise ValueError(
+            f"Unknown quality {quality}, expected one of {', '.join(QUALITY_LEVELS)}"
+        )
+
+
+def load(name):
+    """A module of the analysis methods, imported on first use"""
+    with _import_lock:
+        return importlib.import_module(name)
+
+
+def run_analysis(version, filename, data, params, tile=None, warm_start=None):
+    """
+    Run the pipeline of an API version on the bytes of an uploaded file.
+    The result is a plain dict so it can be returned from a worker process.
+
+    data can also be an ImagePipeline, so several methods run on one upload
+    share their preprocessing. The seconds spent in each stage are returned
+    as timings, the image size and the counts of each method as stats.
+    With a tile size the preprocessing runs tile by tile, for large images.
+    The modules of a method, with plantcv, sklearn or skan behind them, are
+    only imported when it first runs. v3 renders its overlay with the
+    rendering options of params["render"] (see rendering.options), or only
+    measures when they are None. v2 and v3 run at the quality of
+    params["quality"], full by default. warm_start is the key v3 clusters
+    its endpoints with (see clustering.cluster_endpoints).
+    """
+    start = time.perf_counter()
+    pipeline = load("pipeline").as_pipeline(data, tile=tile)
+    levels = pyramid_levels(params.get("quality", "full"))
+
+    if version == "v1":
+        method = params.get("method", 1)
+        if method == 1:
+            lines_1 = load("lines_1")
+            result = lines_1.fiber_length_1(f"uploads/{filename}", 1, image=pipeline)
+        elif method == 2:
+            result = load("lines_2").fiber_length_2(f"uploads/{filename}", image=pipeline)
+        else:
+            raise ValueError(f"Unknown method: {method}")
+        result = {"length": result}
+
+    elif version == "v2":
+        segmentation = load("segmentation")
+        result = {
+            "length": segmentation.segment_threads(filename, image=pipeline, levels=levels)
+        }
+
+    elif version == "v3":
+        clustering = load("clustering")
+        img, pixels = clustering.analyze(pipeline, levels, warm_start)
+        calibration_factor = params.get("calibration_factor", 1.0)
+        # rendering options, None when only the numbers are wanted
+        render = params.get("render", {})
+        if render is None:
+            msfl, ifl, ml = clustering.measure(pixels, calibration_factor)
+            result = {}
+        else:
+            with pipeline.timer("render"):
+                image, mimetype, msfl, ifl, ml = clustering.render(
+                    img, pixels, calibration_factor, **render
+                )
+            result = {"image": image, "mimetype": mimetype}
+        result.update(
+            msfl=msfl,
+            ifl=ifl,
+            ml=ml,
+            analysis=pixels,  # kept to recalibrate without recomputing
+        )
+
+    else:
+        raise ValueError(f"Unknown version: {version}")
+
+    result["timings"] = dict(pipeline.timings, total=time.perf_counter() - start)
+    result["stats"] = dict(pipeline.stats)
+    if resource is not None:
+        # peak resident memory of the process running the analysis, in bytes
+        result["stats"]["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+    return result
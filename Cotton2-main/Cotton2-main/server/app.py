@@ -1,11 +1,18 @@
-import bcrypt
-import cv2 as cv
+import click
+import hashlib
+import io
+import json
+import mimetypes
 import os
 import pymongo
+import threading
+import time
 
-from datetime import datetime
+from concurrent.futures import BrokenExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
 import pytz
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, Request, g, has_request_context, jsonify, make_response, request, url_for
 from flask_jwt_extended import (
     JWTManager,
     get_jwt_identity,
@@ -13,41 +20,461 @@ from flask_jwt_extended import (
     create_access_token,
 )
 from gridfs import GridFS
+from gridfs.errors import FileExists, NoFile
 from pydantic import ValidationError
-from pymongo import MongoClient
+from pymongo import DeleteOne, MongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from bson import ObjectId
+from bson.errors import InvalidId
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
-from clustering import main
-from lines_1 import fiber_length_1
-from lines_2 import fiber_length_2
+from analysis import load, pyramid_levels, run_analysis
+from auth import ROUNDS as BCRYPT_ROUNDS, PasswordHasher
+from batch import DETAILS, file_details, is_zip, read_zip, report, run_batch, summary
+from cache import ResultCache, TTLCache, cache_key
+from fibers import MIMETYPE as FIBERS_MIMETYPE, frame, from_binary, to_binary
+from fibrogram import KEYS as FIBROGRAM_KEYS, KINDS as FIBROGRAM_KINDS
+from fibrogram import from_hist, histogram, metrics as fibrogram_metrics
+from fibrogram import rollup_key as fibrogram_key, rollup_update as fibrogram_update, to_hist
+from images import read_image
+from jobs import JobQueue, QueueFull
+from metrics import CONTENT_TYPE, REGISTRY
+from rendering import EXTENSIONS, options as render_options
 from schemas import *
-from segmentation import segment_threads
+from stats import GROUPS as STATS_GROUPS, KEYS as STATS_KEYS
+from stats import merge, report as stats_report, rollup as stats_rollup, rollup_key, rollup_update
+from warmup import warm_up
+
+
+
+class UploadRequest(Request):
+    """
+    Request keeping the uploaded files of a body of at most
+    UPLOAD_MEMORY_BYTES in memory, where werkzeug would spool every file
+    over 500 kB to a temporary file. Larger bodies are still spooled.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= app.config["UPLOAD_MEMORY_BYTES"]:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config["UPLOAD_FOLDER"] = "uploads"
 app.config["JWT_SECRET_KEY"] = "cotton123456"
+# Largest request body (a batch can be up to BATCH_MAX_BYTES), and largest
+# body whose files are kept in memory rather than in a temporary file
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 64 * 1024 * 1024))
+app.config["UPLOAD_MEMORY_BYTES"] = int(os.environ.get("UPLOAD_MEMORY_BYTES", 16 * 1024 * 1024))
+# Worker processes for queued analyses (0 runs them on a thread in this process).
+# The queue and its jobs live in this process, so the server runs as a single
+# process for /api/jobs to find them; scale with these workers, or threads
+app.config["ANALYSIS_WORKERS"] = int(os.environ.get("ANALYSIS_WORKERS", os.cpu_count() or 1))
+app.config["ANALYSIS_QUEUE_DEPTH"] = int(os.environ.get("ANALYSIS_QUEUE_DEPTH", 32))
+# Size of the in-memory result cache, and an optional directory to keep results on disk
+app.config["RESULT_CACHE_BYTES"] = int(os.environ.get("RESULT_CACHE_BYTES", 256 * 1024 * 1024))
+app.config["RESULT_CACHE_DIR"] = os.environ.get("RESULT_CACHE_DIR")
+# Preprocess images tile by tile with tiles of this size, to bound the memory
+# used by large scans (unset processes whole images)
+app.config["ANALYSIS_TILE_SIZE"] = int(os.environ.get("ANALYSIS_TILE_SIZE", 0)) or None
+# Limits of a batch upload: number of images, and bytes of images unpacked from zip archives
+app.config["BATCH_MAX_FILES"] = int(os.environ.get("BATCH_MAX_FILES", 200))
+app.config["BATCH_MAX_BYTES"] = int(os.environ.get("BATCH_MAX_BYTES", 1024 * 1024 * 1024))
+# Run every pipeline once on a small image when the server and its workers
+# start, so the first requests do not pay for imports and JIT compilation
+app.config["ANALYSIS_WARM_UP"] = os.environ.get("ANALYSIS_WARM_UP", "1").lower() in ("1", "true")
+# Start the v3 clustering of an image from the centroids of the previous
+# image of the same user and station; off, every image gets the clusters of
+# KMeans(n_clusters=2, random_state=42). The centroids are kept per process:
+# every web worker, and every analysis worker, has its own, so the previous
+# image is the one this process analysed last. As these results depend on
+# it, they are not served from or put in the result cache.
+app.config["CLUSTER_WARM_START"] = os.environ.get("CLUSTER_WARM_START", "").lower() in ("1", "true")
+# Send the time spent in each stage of a request in a Server-Timing header
+app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "").lower() in ("1", "true")
+# Cost of the password hashes (stored hashes of another cost are replaced at
+# login), and the threads checking passwords and the logins they queue
+app.config["BCRYPT_ROUNDS"] = int(os.environ.get("BCRYPT_ROUNDS", BCRYPT_ROUNDS))
+app.config["AUTH_WORKERS"] = int(os.environ.get("AUTH_WORKERS", 2))
+app.config["AUTH_QUEUE_DEPTH"] = int(os.environ.get("AUTH_QUEUE_DEPTH", 64))
+# Users of the tokens of the requests, kept for this many seconds
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 10000))
+app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 300))
 
 jwt = JWTManager(app)
 
+# Synchronous uploads, and jobs when there are no worker processes, run their
+# analysis in this process. It is warmed up in the background so the server
+# starts listening right away, and these analyses wait for it to finish
+# rather than run the first imports and compilations alongside it.
+warmed_up = threading.Event()
+
+
+def warm_up_in_background():
+    try:
+        warm_up()
+    finally:
+        warmed_up.set()
+
+
+def wait_for_warm_up():
+    if app.config["ANALYSIS_WARM_UP"]:
+        warmed_up.wait()
+
+
+if not app.config["ANALYSIS_WARM_UP"]:
+    job_initializer = None
+elif app.config["ANALYSIS_WORKERS"]:
+    job_initializer = warm_up
+else:
+    job_initializer = wait_for_warm_up
+
+jobs = JobQueue(
+    workers=app.config["ANALYSIS_WORKERS"],
+    max_pending=app.config["ANALYSIS_QUEUE_DEPTH"],
+    initializer=job_initializer,
+)
+if app.config["ANALYSIS_WARM_UP"]:
+    # worker processes are forked before the warm-up thread starts
+    jobs.start()
+    threading.Thread(target=warm_up_in_background, name="warm-up", daemon=True).start()
+
+results_cache = ResultCache(
+    max_bytes=app.config["RESULT_CACHE_BYTES"],
+    directory=app.config["RESULT_CACHE_DIR"],
+)
+
+passwords = PasswordHasher(
+    workers=app.config["AUTH_WORKERS"],
+    max_pending=app.config["AUTH_QUEUE_DEPTH"],
+    rounds=app.config["BCRYPT_ROUNDS"],
+)
+
 client = MongoClient("localhost", 27017)
 db = client["cotton"]
 users_collection = db["users"]
 uploads_collection = db["uploads"]
 grid_fs = GridFS(db, collection="files")
 
+# Uploaded files are stored once per content, found by their sha256 (files
+# stored by earlier versions have none)
+files_collection = db["files.files"]
+files_collection.create_index([("sha256", pymongo.ASCENDING)], unique=True, sparse=True)
+
+# An uploads document records who uploaded a file under which name; earlier
+# versions stored its id as filid
+uploads_collection.update_many({"filid": {"$exists": True}}, {"$rename": {"filid": "file_id"}})
+uploads_collection.create_index([("uploaded_by", pymongo.ASCENDING), ("file_id", pymongo.ASCENDING)])
+
+# users by username ({_id, username}), looked up for the token of every
+# protected request
+users_cache = TTLCache(max_entries=app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"])
+
 image_details_collection = db["image_details"]
 image_details_collection.create_index([("user_id", pymongo.ASCENDING)])
+try:
+    image_details_collection.create_index([("test_number", pymongo.ASCENDING)], unique=True)
+except pymongo.errors.OperationFailure:
+    # numbers stored before they were allocated atomically can repeat
+    image_details_collection.create_index([("test_number", pymongo.ASCENDING)])
+
+# A user's tests are listed by test number, optionally filtered on one of
+# these fields; _id breaks ties between legacy duplicate test numbers
+for field in (None, "cotton_type", "station", "lot_number"):
+    image_details_collection.create_index(
+        [("user_id", pymongo.ASCENDING)]
+        + ([(field, pymongo.ASCENDING)] if field else [])
+        + [("test_number", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+    )
+# Within a date range they are listed by date first, so that the range and the
+# order come from one index
+image_details_collection.create_index(
+    [(key, pymongo.ASCENDING) for key in ("user_id", "date", "test_number", "_id")]
+)
+
+# Dates are stored in IST, as str(datetime)
+IST = pytz.timezone("Asia/Kolkata")
+
+# Test numbers are handed out by a counter document, which starts after the
+# largest number already stored
+counters_collection = db["counters"]
+latest_test_number = image_details_collection.find_one(
+    {"test_number": {"$exists": True}}, {"test_number": 1}, sort=[("test_number", -1)]
+)
+counters_collection.update_one(
+    {"_id": "test_number"},
+    {"$max": {"value": latest_test_number["test_number"] if latest_test_number else 0}},
+    upsert=True,
+)
+
+# Pixel-space results of v3 analyses, used to recalibrate without recomputing
+analyses_collection = db["analyses"]
+analyses_collection.create_index(
+    [("user_id", pymongo.ASCENDING), ("test_number", pymongo.ASCENDING)]
+)
+
+# Rollups of the results per user, lot, station, cotton type and day, kept up
+# to date as tests are stored (see stats.py)
+stats_collection = db["stats"]
+stats_collection.create_index([(key, pymongo.ASCENDING) for key in STATS_KEYS], unique=True)
+
+
+def update_stats(details):
+    """Add image details documents to their rollups"""
+    if details:
+        stats_collection.bulk_write(
+            [UpdateOne(rollup_key(d), rollup_update(d), upsert=True) for d in details],
+            ordered=False,
+        )
 
 
-def verify_password(plain_password, hashed_password):
-    return bcrypt.checkpw(
-        plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+def rebuild_stats(user_id=None):
+    """
+    Recompute the rollups of a user, or of every user, from image_details.
+    Tests with the same results are counted together by the aggregation.
+    Each rollup is replaced as a whole and the ones without tests left are
+    deleted, so running it again, or twice at once, gives the same rollups;
+    tests stored while it runs may be missed or counted twice until the
+    next run. Returns the number of rollups.
+    """
+    match = {} if user_id is None else {"user_id": user_id}
+    rows = image_details_collection.aggregate(
+        [
+            {"$match": match},
+            {
+                "$group": {
+                    "_id": {
+                        "user_id": "$user_id",
+                        "lot_number": "$lot_number",
+                        "station": "$station",
+                        "cotton_type": "$cotton_type",
+                        "date": {"$substr": ["$date", 0, 10]},
+                        "msfl": "$msfl",
+                        "ifl": "$ifl",
+                        "ml": "$ml",
+                    },
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
     )
+    groups = {}
+    for row in rows:
+        key = rollup_key(row["_id"])
+        groups.setdefault(tuple(key.values()), (key, []))[1].append((row["_id"], row["count"]))
+    replace_rollups(stats_collection, STATS_KEYS, match, groups, stats_rollup)
+    return len(groups)
+
+
+def replace_rollups(collection, keys, match, groups, rollup):
+    """
+    Replace the rollups of collection matching match with the rollup() of
+    each {key values: (key, items)} group, and delete the other ones.
+    """
+    requests = [
+        ReplaceOne(key, {**key, **rollup(items)}, upsert=True) for key, items in groups.values()
+    ]
+    for document in collection.find(match, dict.fromkeys(keys, 1)):
+        if tuple(document.get(key) for key in keys) not in groups:
+            requests.append(DeleteOne({"_id": document["_id"]}))
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+
+# Histograms of the fiber lengths per user, lot and kind of lengths, kept up
+# to date as analyses are stored (see fibrogram.py)
+fibrograms_collection = db["fibrograms"]
+fibrograms_collection.create_index(
+    [(key, pymongo.ASCENDING) for key in FIBROGRAM_KEYS], unique=True
+)
 
 
-def generate_hashed_password(password):
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-    return hashed_password.decode("utf-8")
+def analysis_histogram(analysis):
+    """
+    Histogram of the stored lengths of an analyses document, in mm, or in
+    pixels for a v1 or v2 analysis stored without a calibration factor.
+    """
+    lengths = from_binary(analysis["arrays"])["lengths"]
+    return histogram(lengths, analysis.get("calibration_factor") or 1.0)
+
+
+def update_fibrograms(analyses):
+    """
+    Add the lengths of analyses documents with a lot_number to their
+    rollups, which are in mm: uncalibrated analyses are left out.
+    """
+    updates = [
+        UpdateOne(fibrogram_key(a), fibrogram_update(*analysis_histogram(a)), upsert=True)
+        for a in analyses
+        if a.get("lot_number") is not None and a.get("calibration_factor") is not None
+    ]
+    if updates:
+        fibrograms_collection.bulk_write(updates, ordered=False)
+
+
+def rebuild_fibrograms(user_id=None):
+    """
+    Recompute the fibrogram rollups of a user, or of every user, from the
+    stored analyses, replacing each rollup as a whole as rebuild_stats does.
+    Returns the number of rollups.
+    """
+    match = {
+        "lot_number": {"$ne": None},
+        "calibration_factor": {"$ne": None},
+        "arrays": {"$exists": True},
+    }
+    if user_id is not None:
+        match["user_id"] = user_id
+    groups = {}
+    projection = dict.fromkeys(["user_id", "lot_number", "version", "calibration_factor", "arrays.lengths"], 1)
+    for analysis in analyses_collection.find(match, projection):
+        key = fibrogram_key(analysis)
+        _, rollup = groups.setdefault(
+            tuple(key.values()), (key, {"tests": 0, "fibers": 0, "hist": {}})
+        )
+        bins, counts = analysis_histogram(analysis)
+        rollup["tests"] += 1
+        rollup["fibers"] += int(counts.sum())
+        for b, n in to_hist(bins, counts).items():
+            rollup["hist"][b] = rollup["hist"].get(b, 0) + n
+
+    replace_rollups(
+        fibrograms_collection,
+        FIBROGRAM_KEYS,
+        {} if user_id is None else {"user_id": user_id},
+        groups,
+        lambda rollup: rollup,
+    )
+    return len(groups)
+
+
+# Metrics served on /metrics
+STAGE_SECONDS = REGISTRY.histogram(
+    "cotton_stage_seconds",
+    "Time spent in each stage of the requests and analyses",
+    ["stage"],
+)
+ANALYSIS_SECONDS = REGISTRY.histogram(
+    "cotton_analysis_seconds", "Time spent in run_analysis", ["version"]
+)
+ANALYSES = REGISTRY.counter(
+    "cotton_analyses_total", "Analyses requested, by result cache outcome", ["version", "cache"]
+)
+STORED_FILES = REGISTRY.counter(
+    "cotton_stored_files_total", "Uploaded files, by whether their content was new", ["content"]
+)
+ANALYSIS_ERRORS = REGISTRY.counter(
+    "cotton_analysis_errors_total", "Analyses that raised an error", ["version"]
+)
+STORE_ERRORS = REGISTRY.counter(
+    "cotton_store_errors_total", "Analyses whose results could not be stored", ["version"]
+)
+IMAGE_PIXELS = REGISTRY.histogram(
+    "cotton_image_pixels",
+    "Size of the analysed images",
+    buckets=(0.25e6, 0.5e6, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6),
+)
+ANALYSIS_ITEMS = REGISTRY.histogram(
+    "cotton_analysis_items",
+    "Endpoints, paths, fibers, ... found in each analysis",
+    ["version", "item"],
+    buckets=(1, 10, 30, 100, 300, 1000, 3000, 10000, 30000),
+)
+PEAK_RSS = REGISTRY.gauge(
+    "cotton_analysis_peak_rss_bytes",
+    "Peak resident memory of the process that ran the last analysis",
+)
+
+
+@contextmanager
+def timed(stage):
+    """Time a stage of the request for /metrics and the Server-Timing header"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(stage, time.perf_counter() - start)
+
+
+def record_timing(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if has_request_context():
+        g.setdefault("timings", []).append((stage, seconds))
+
+
+def record_analysis(version, result):
+    """Feed the timings and stats returned by run_analysis to the metrics"""
+    timings = dict(result.get("timings", {}))
+    total = timings.pop("total", None)
+    for stage, seconds in timings.items():
+        record_timing(stage, seconds)
+    if total is not None:
+        ANALYSIS_SECONDS.observe(total, version=version)
+        if has_request_context():
+            g.setdefault("timings", []).append(("analysis", total))
+
+    stats = dict(result.get("stats", {}))
+    if "height" in stats and "width" in stats:
+        IMAGE_PIXELS.observe(stats.pop("height") * stats.pop("width"))
+    if "peak_rss" in stats:
+        PEAK_RSS.set(stats.pop("peak_rss"))
+    for item, count in stats.items():
+        ANALYSIS_ITEMS.observe(count, version=version, item=item)
+
+
+@app.after_request
+def add_server_timing(response):
+    if app.config["SERVER_TIMING"] and "timings" in g:
+        # stages repeated by the images of a batch are summed
+        totals = {}
+        for stage, seconds in g.timings:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        response.headers.set(
+            "Server-Timing",
+            ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()),
+        )
+    return response
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return (
+        jsonify(
+            {
+                "msg": f"Request too large, at most {request.max_content_length} bytes",
+                "result": "failure",
+            }
+        ),
+        413,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics of this process"""
+    response = make_response(REGISTRY.render())
+    response.headers.set("Content-Type", CONTENT_TYPE)
+    return response
+
+
+def too_many_logins():
+    response = jsonify({"msg": "Too many logins in progress, retry later", "result": "failure"})
+    response.headers.set("Retry-After", "1")
+    return response, 429
+
+
+@jwt.user_lookup_loader
+def load_user(_jwt_header, jwt_data):
+    """User of the token of a protected request, rejected if it no longer exists"""
+    return user_record(jwt_data["sub"])
+
+
+@jwt.user_lookup_error_loader
+def unknown_user(_jwt_header, jwt_data):
+    return jsonify({"msg": "Unknown user", "result": "failure"}), 401
 
 
 @app.route("/")
@@ -71,7 +498,11 @@ def register():
         if existing_user:
             return jsonify({"msg": "Username already exists", "result": "failure"}), 400
 
-        hashed_password = generate_hashed_password(password)
+        try:
+            with timed("password"):
+                hashed_password = passwords.hash(password)
+        except QueueFull:
+            return too_many_logins()
 
         new_user = {"username": username, "password": hashed_password}
 
@@ -96,9 +527,22 @@ def login():
             401,
         )
 
-    user = users_collection.find_one({"username": username})
+    user = users_collection.find_one({"username": username}, {"password": 1})
 
-    if user and verify_password(password, user["password"]):
+    verified = False
+    if user:
+        try:
+            with timed("password"):
+                verified, rehashed = passwords.check(password, user["password"])
+        except QueueFull:
+            return too_many_logins()
+        if rehashed:
+            users_collection.update_one(
+                {"_id": user["_id"], "password": user["password"]},
+                {"$set": {"password": rehashed}},
+            )
+
+    if verified:
         access_token = create_access_token(identity=username)
         return jsonify({"access_token": access_token, "result": "success"}), 200
 
@@ -106,178 +550,925 @@ def login():
         return jsonify({"msg": "Invalid credentials", "result": "failure"}), 401
 
 
-def processImage(filename, operation, scale, method):
-    img = cv.imread(f"uploads/{filename}")
-    if operation == "cgray":
-        imgProcessed = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-        newFilename = f"static/{filename}"
-        cv.imwrite(newFilename, imgProcessed)
-        return newFilename
-
-    elif operation == "resize":
-        scale_percent = 50
-        width = int(img.shape[1] * scale_percent / 100)
-        height = int(img.shape[0] * scale_percent / 100)
-        dim = (width, height)
-        imgProcessed = cv.resize(img, dim, interpolation=cv.INTER_AREA)
-        newFilename = f"static/{filename}"
-        cv.imwrite(newFilename, imgProcessed)
-        return newFilename
-
-    elif operation == "getD":
-        return img.shape
-
-    elif operation == "lines":
-        if method == 1:
-            result = fiber_length_1(f"uploads/{filename}", scale)
-        if method == 2:
-            result = fiber_length_2(f"uploads/{filename}")
-        return result
+def allocate_test_numbers(count=1):
+    """
+    First of count consecutive new test numbers. The counter is incremented
+    atomically, so concurrent uploads and batches never share a number.
+    """
+    counter = counters_collection.find_one_and_update(
+        {"_id": "test_number"},
+        {"$inc": {"value": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["value"] - count + 1
 
-    else:
-        raise ValueError(f"Unknown operation: {operation}")
 
+def current_time():
+    return datetime.now(IST)
+
+
+def image_details_document(current_user, image_details, results, test_number, stored_at):
+    return {
+        "cotton_type": image_details.cotton_type,
+        "station": image_details.station,
+        "lot_number": image_details.lot_number,
+        "test_number": test_number,
+        "date": str(stored_at),
+        "msfl": results.msfl,
+        "ifl": results.ifl,
+        "ml": results.ml,
+        "user_id": current_user,
+    }
+
+
+def analysis_document(current_user, version, file_id, arrays, stored_at, **fields):
+    """
+    The per-fiber arrays of an analysis as binary (see fibers.py), with the
+    fields that select it: its image details, and the test_number and
+    calibration_factor of a v3 test.
+    """
+    return {
+        "user_id": current_user,
+        "version": version,
+        "file_id": file_id,
+        "date": str(stored_at),
+        **fields,
+        "arrays": to_binary(arrays),
+    }
+
+
+def result_arrays(version, result):
+    """The arrays stored for the result of an analysis"""
+    if version == "v3":
+        return load("clustering").analysis_to_arrays(result["analysis"])
+    # v1 and v2 lengths are [filename, lengths]
+    return {"lengths": result["length"][1]}
+
+
+def store_image_details(
+    current_user, image_details_data, results_data, analysis=None, file_id=None
+):
+    """
+    Store the details and results of a v3 test, and its analysis if given.
+    Returns its test number, raises ValidationError for invalid details.
+    """
+    details = image_details(image_details_data)
+    results = Results(**results_data)
+
+    test_number = allocate_test_numbers()
+    stored_at = current_time()
+    new_image_details = image_details_document(
+        current_user, details, results, test_number, stored_at
+    )
+    image_details_collection.insert_one(new_image_details)
+    update_stats([new_image_details])
+
+    if analysis is not None:
+        document = analysis_document(
+            current_user,
+            "v3",
+            file_id,
+            result_arrays("v3", {"analysis": analysis}),
+            stored_at,
+            test_number=test_number,
+            calibration_factor=results_data.get("calibration_factor"),
+            **details.model_dump(),
+        )
+        analyses_collection.insert_one(document)
+        update_fibrograms([document])
+    return test_number
+
+
+def analysis_params(version, form):
+    """
+    Parameters of the analysis of an API version from the request form, and
+    the image details stored along with its results (None if not stored).
+    Returns None, None for an unknown version, raises ValueError for invalid
+    parameters. v2 and v3 take a quality, preview, standard or full (the
+    default); v3 the rendering options of its overlay, format=json for the
+    numbers only. Only v3 results are stored as tests, the image details of
+    v1 and v2 go with their stored fiber lengths, and so does their optional
+    calibration_factor, which converts them to mm for their fibrograms;
+    without it they stay in pixels, out of the fibrograms of their lot.
+    """
+    image_details_data = {
+        "cotton_type": form.get("cotton_type", ""),
+        "lot_number": form.get("lot_number", ""),
+        "station": form.get("station", ""),
+    }
+    calibration = {}
+    if version in ("v1", "v2") and form.get("calibration_factor"):
+        calibration["calibration_factor"] = float(form["calibration_factor"])
+
+    if version == "v1":
+        method = int(form.get("method", 1))  # Default to 1 if not provided
+        return {"method": method, **calibration}, image_details_data
+    if version not in ("v2", "v3"):
+        return None, None
+
+    quality = form.get("quality") or "full"
+    pyramid_levels(quality)  # raises ValueError for an unknown quality
+    if version == "v2":
+        return {"quality": quality, **calibration}, image_details_data
+
+    image_details(image_details_data)  # raises ValidationError for invalid details
+    calibration_factor = float(form.get("calibration_factor", 1.0))
+    params = {
+        "calibration_factor": calibration_factor,
+        "quality": quality,
+        "render": render_options(form),
+    }
+    return params, image_details_data
+
+
+def warm_start_key(current_user, image_details_data):
+    """
+    Warm start key of the v3 clustering of an image, None without a station.
+    The clustering then depends on the images the process analysed before,
+    see cacheable.
+    """
+    if not app.config["CLUSTER_WARM_START"]:
+        return None
+    if not image_details_data.get("station"):
+        return None
+    return current_user, image_details_data["station"]
+
+
+def cacheable(version, warm_start):
+    """Whether the result of an analysis only depends on its image and parameters"""
+    return version != "v3" or warm_start is None
+
+
+@app.route("/api/<version>/upload", methods=["POST"])
+@jwt_required()
+def upload_file(version):
+    """
+    Handle file uploads for different API versions.
+    """
+    current_user = get_jwt_identity()
+
+    # Validate file presence
+    file = request.files.get("file")
+    if not file or file.filename == "":
+        return jsonify({"msg": "No file provided or no selected file"}), 400
 
-def store_image_details(current_user, image_details_data, results_data):
     try:
-        # Validate image details data and results data
-        image_details = ImageDetails(**image_details_data)
-        results = Results(**results_data)
-
-        # Generate Test Number (auto-increment)
-        latest_test_number = image_details_collection.find_one(sort=[("test_number", -1)])
-        test_number = latest_test_number["test_number"] + 1 if latest_test_number else 1
-
-        # Get IST timezone
-        ist = pytz.timezone("Asia/Kolkata")
-
-        # Get current time in IST
-        current_time = datetime.now(ist)
-
-        new_image_details = {
-            "cotton_type": image_details.cotton_type,
-            "station": image_details.station,
-            "lot_number": image_details.lot_number,
-            "test_number": test_number,
-            "date": str(current_time),
-            "msfl": results.msfl,
-            "ifl": results.ifl,
-            "ml": results.ml,
-            "user_id": current_user,
-        }
+        params, image_details_data = analysis_params(version, request.form)
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid parameters: {e}", "result": "failure"}), 400
+    if params is None:
+        return jsonify({"msg": "Invalid API version"}), 400
+
+    with timed("gridfs_put"):
+        file_id, content = store_file(file.stream, file.filename, file.content_type)
+
+    # Record upload in the database
+    with timed("mongo_upload"):
+        uploads_collection.insert_one(
+            {"file_id": file_id, "uploaded_by": user_id(current_user), "filename": file.filename}
+        )
+
+    # Handle different API versions
+    try:
+        # The same image analysed with the same parameters gives the same result
+        warm_start = warm_start_key(current_user, image_details_data)
+        key = result = None
+        if cacheable(version, warm_start):
+            with timed("cache_get"):
+                key = cache_key(content, version, params)
+                result = results_cache.get(key)
+        if result is not None:
+            ANALYSES.inc(version=version, cache="hit")
+            store_analysis(current_user, version, image_details_data, result, params, file_id)
+            response = analysis_response(result)
+            response.headers.set("X-Cache", "HIT")
+            return response
+
+        ANALYSES.inc(version=version, cache="miss" if key else "bypass")
+
+        # the pipelines decode the image from its bytes
+        file.stream.seek(0)
+        data = file.stream.read()
+
+        # Queue the analysis and return the job id right away if asked to
+        if request.form.get("async", "").lower() in ("1", "true"):
+            return submit_job(
+                current_user,
+                version,
+                file.filename,
+                data,
+                params,
+                image_details_data,
+                key,
+                file_id,
+                warm_start,
+            )
+
+        wait_for_warm_up()
+        try:
+            result = run_analysis(
+                version,
+                file.filename,
+                data,
+                params,
+                app.config["ANALYSIS_TILE_SIZE"],
+                warm_start,
+            )
+        except Exception:
+            ANALYSIS_ERRORS.inc(version=version)
+            raise
+        record_analysis(version, result)
+        if key:
+            with timed("cache_put"):
+                results_cache.put(key, result)
+        store_analysis(current_user, version, image_details_data, result, params, file_id)
+        return analysis_response(result)
+    except Exception as e:
+        return jsonify({"msg": f"Processing error: {e}"}), 500
+
+
+def store_analysis(current_user, version, image_details_data, result, params, file_id):
+    """
+    Store the details of a v3 analysis along with its results, the fiber
+    lengths of a v1 or v2 analysis with its image details. A failed store is
+    logged and counted before its error is raised.
+    """
+    try:
+        with timed("mongo_store"):
+            if version == "v3":
+                results_data = {
+                    "msfl": result["msfl"],
+                    "ifl": result["ifl"],
+                    "ml": result["ml"],
+                    "calibration_factor": params["calibration_factor"],
+                }
+                store_image_details(
+                    current_user, image_details_data, results_data, result.get("analysis"), file_id
+                )
+                return
+            try:
+                details = image_details(image_details_data)
+            except ValidationError:
+                # the lengths are kept, as the result sent back, without details
+                details = ImageDetails()
+            document = analysis_document(
+                current_user,
+                version,
+                file_id,
+                result_arrays(version, result),
+                current_time(),
+                calibration_factor=params.get("calibration_factor"),
+                **details.model_dump(),
+            )
+            analyses_collection.insert_one(document)
+            update_fibrograms([document])
+    except Exception:
+        STORE_ERRORS.inc(version=version)
+        app.logger.exception("Storing the %s analysis of %s failed", version, current_user)
+        raise
+
+
+def analysis_response(result):
+    """
+    Send an analysis result to the client: the image of a v3 result, or its
+    numbers when it was not rendered, the lengths of the other versions.
+    """
+    if "image" in result:
+        # the encoded bytes are the body as they are
+        response = make_response(result["image"])
+        response.headers.set("Content-Type", result["mimetype"])
+        response.headers.set(
+            "Content-Disposition", f"inline; filename=result{EXTENSIONS[result['mimetype']]}"
+        )
+        return response
+
+    if "msfl" in result:
+        return jsonify(
+            {
+                "msfl": float(result["msfl"]),
+                "ifl": float(result["ifl"]),
+                "ml": float(result["ml"]),
+                "result": "success",
+            }
+        )
+
+    return jsonify({"length": result["length"]})
+
+
+def submit_job(
+    current_user, version, filename, data, params, image_details_data, key, file_id, warm_start
+):
+    def on_done(result):
+        record_analysis(version, result)
+        if key:
+            results_cache.put(key, result)
+        with app.app_context():
+            store_analysis(current_user, version, image_details_data, result, params, file_id)
+
+    try:
+        job_id = jobs.submit(
+            current_user,
+            run_analysis,
+            version,
+            filename,
+            data,
+            params,
+            app.config["ANALYSIS_TILE_SIZE"],
+            warm_start,
+            on_done=on_done,
+        )
+    except QueueFull:
+        response = jsonify({"msg": "Too many analyses queued, retry later", "result": "failure"})
+        response.headers.set("Retry-After", "5")
+        return response, 429
+    except (BrokenExecutor, RuntimeError) as e:
+        return jsonify({"msg": f"Analysis workers unavailable: {e}", "result": "failure"}), 503
+
+    return (
+        jsonify(
+            {
+                "msg": "Analysis queued",
+                "result": "success",
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": url_for("get_job", job_id=job_id),
+            }
+        ),
+        202,
+    )
+
+
+@app.route("/api/<version>/batch", methods=["POST"])
+@jwt_required()
+def upload_batch(version):
+    """
+    Analyse many images in one request, in parallel on the analysis workers.
+
+    Images are sent as several "file" fields, as zip archives of images, or
+    both. The form fields of /api/<version>/upload apply to every image; a
+    "manifest" field can give the cotton_type, lot_number and station of
+    each file as JSON {filename: {...}}. Returns the numbers of every image,
+    without the v3 overlays (see /api/v3/recalibrate), and a report per
+    lot_number and station. The analyses hold slots of the job queue, 429
+    when none are free.
+    """
+    current_user = get_jwt_identity()
+    # the images of a batch are limited by BATCH_MAX_BYTES rather than MAX_CONTENT_LENGTH
+    request.max_content_length = app.config["BATCH_MAX_BYTES"]
+
+    try:
+        params, _ = analysis_params(version, request.form)
+        if params is not None and "render" in params:
+            # only the numbers of a batch are sent back
+            params["render"] = None
+        manifest = json.loads(request.form.get("manifest") or "{}")
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid parameters: {e}", "result": "failure"}), 400
+    if params is None:
+        return jsonify({"msg": "Invalid API version"}), 400
 
-        image_details_collection.insert_one(new_image_details)
+    # the images of the archives and the other files share BATCH_MAX_BYTES
+    items = []
+    budget = app.config["BATCH_MAX_BYTES"]
+    try:
+        for file in request.files.getlist("file"):
+            if is_zip(file.filename):
+                images = read_zip(file.read(), budget)
+            elif file.filename:
+                images = [(file.filename, file.read())]
+            else:
+                continue
+            budget -= sum(len(data) for _, data in images)
+            if budget < 0:
+                raise ValueError(
+                    f"Images of more than {app.config['BATCH_MAX_BYTES']} bytes in the batch"
+                )
+            items.extend(images)
+    except ValueError as e:
+        return jsonify({"msg": str(e), "result": "failure"}), 400
+    if not items:
+        return jsonify({"msg": "No file provided or no selected file"}), 400
+    if len(items) > app.config["BATCH_MAX_FILES"]:
         return (
             jsonify(
                 {
-                    "msg": "Image details stored successfully",
-                    "result": "success",
-                    "test_number": test_number,
+                    "msg": f"{len(items)} images, at most {app.config['BATCH_MAX_FILES']} per batch",
+                    "result": "failure",
                 }
             ),
-            201,
+            413,
         )
+
+    records = []
+    try:
+        for filename, _ in items:
+            records.append({"filename": filename, **file_details(filename, request.form, manifest)})
     except ValidationError as e:
         return (
-            jsonify({"msg": f"Validation error: {e}", "result": "failure"}),
+            jsonify({"msg": f"Validation error for {filename}: {e}", "result": "failure"}),
             422,
         )
+
+    # the analyses of the batch hold slots of the job queue, as many as the
+    # workers can run at once
+    try:
+        slots = jobs.reserve(min(len(items), jobs.workers))
+    except QueueFull:
+        response = jsonify({"msg": "Too many analyses queued, retry later", "result": "failure"})
+        response.headers.set("Retry-After", "5")
+        return response, 429
+    try:
+        return analyse_batch(current_user, version, params, items, records, slots)
+    finally:
+        jobs.release(slots)
+
+
+def analyse_batch(current_user, version, params, items, records, window):
+    """
+    Store the images of a batch and analyse the ones without a cached
+    result, window at a time on the analysis workers; the response of
+    upload_batch.
+    """
+    file_ids, contents = store_uploads(current_user, items)
+
+    # Cached results are reused, the other images are analysed in parallel
+    warm_starts = [warm_start_key(current_user, record) for record in records]
+    with timed("cache_get"):
+        keys = [
+            cache_key(content, version, params) if cacheable(version, warm_start) else None
+            for content, warm_start in zip(contents, warm_starts)
+        ]
+        results = [key and results_cache.get(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+    bypassed = sum(1 for key in keys if key is None)
+    ANALYSES.inc(len(items) - len(pending), version=version, cache="hit")
+    ANALYSES.inc(len(pending) - bypassed, version=version, cache="miss")
+    ANALYSES.inc(bypassed, version=version, cache="bypass")
+
+    try:
+        with timed("batch"):
+            analysed = run_batch(
+                [items[i] for i in pending],
+                version,
+                params,
+                jobs.executor,
+                app.config["ANALYSIS_TILE_SIZE"],
+                [warm_starts[i] for i in pending],
+                window,
+            )
+    except (BrokenExecutor, RuntimeError) as e:
+        return jsonify({"msg": f"Analysis workers unavailable: {e}", "result": "failure"}), 503
+
+    for i, result in zip(pending, analysed):
+        if isinstance(result, Exception):
+            ANALYSIS_ERRORS.inc(version=version)
+        else:
+            record_analysis(version, result)
+            if keys[i]:
+                with timed("cache_put"):
+                    results_cache.put(keys[i], result)
+        results[i] = result
+
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            record["error"] = str(result)
+        else:
+            record.update(summary(version, result))
+
+    done = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+    try:
+        store_batch(
+            current_user,
+            [records[i] for i in done],
+            [results[i] for i in done],
+            [file_ids[i] for i in done],
+            version,
+            params,
+        )
     except Exception as e:
+        STORE_ERRORS.inc(version=version)
+        app.logger.exception("Storing the %s batch of %s failed", version, current_user)
+        return jsonify({"msg": f"Error storing results: {e}", "result": "failure"}), 500
+
+    return jsonify(
+        {
+            "msg": f"{len(done)} of {len(items)} images analysed",
+            "result": "success",
+            "images": records,
+            "report": report(version, records),
+        }
+    )
+
+
+def user_record(username):
+    """{_id, username} of a user, None if there is none"""
+    user = users_cache.get(username)
+    if user is None:
+        user = users_collection.find_one({"username": username}, {"_id": 1, "username": 1})
+        if user is not None:
+            users_cache.put(username, user)
+    return user
+
+
+def user_id(username):
+    """_id of a user"""
+    user = user_record(username)
+    if user is None:
+        raise ValueError(f"Unknown user {username}")
+    return user["_id"]
+
+
+def store_file(stream, filename, content_type):
+    """
+    Put an uploaded file in GridFS from a file object, chunk by chunk, and
+    hash it on the way. Returns its GridFS id and its hashlib.sha256. If a
+    file with the same sha256 is stored already, the new one is dropped
+    (pymongo buffers the first 32 MB of chunks, so a duplicate image is
+    usually never written) and the id of the stored one is returned.
+    """
+    digest = hashlib.sha256()
+    grid_in = grid_fs.new_file(filename=filename, content_type=content_type)
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(grid_in.chunk_size), b""):
+        digest.update(chunk)
+        grid_in.write(chunk)
+    sha256 = digest.hexdigest()
+
+    stored = files_collection.find_one({"sha256": sha256}, {"_id": 1})
+    if stored is None:
+        grid_in.sha256 = sha256
+        try:
+            grid_in.close()
+            STORED_FILES.inc(content="new")
+            return grid_in._id, digest
+        except FileExists:
+            # the same content was stored concurrently
+            stored = files_collection.find_one({"sha256": sha256}, {"_id": 1})
+    grid_in.abort()
+    STORED_FILES.inc(content="duplicate")
+    return stored["_id"], digest
+
+
+def store_uploads(current_user, items):
+    """
+    Store the (filename, bytes) items (see store_file) and record their
+    uploads in one insert. Returns their GridFS ids and hashlib.sha256.
+    """
+    with timed("gridfs_put"):
+        stored = [
+            store_file(io.BytesIO(data), filename, mimetypes.guess_type(filename)[0])
+            for filename, data in items
+        ]
+    file_ids = [file_id for file_id, _ in stored]
+    with timed("mongo_upload"):
+        uploader = user_id(current_user)
+        if file_ids:
+            uploads_collection.insert_many(
+                [
+                    {"file_id": file_id, "uploaded_by": uploader, "filename": filename}
+                    for file_id, (filename, _) in zip(file_ids, items)
+                ]
+            )
+    return file_ids, [digest for _, digest in stored]
+
+
+def store_batch(current_user, records, results, file_ids, version, params):
+    """
+    Store the details and analyses of the v3 results of a batch, with one
+    insert per collection, and set the test_number of their records; the
+    fiber lengths of v1 and v2 results, with one insert.
+    records are the file_details of the images along with their filename.
+    """
+    if not records:
+        return
+    if version != "v3":
+        stored_at = current_time()
+        analyses = [
+            analysis_document(
+                current_user,
+                version,
+                file_id,
+                result_arrays(version, result),
+                stored_at,
+                calibration_factor=params.get("calibration_factor"),
+                **{key: record[key] for key in DETAILS},
+            )
+            for record, result, file_id in zip(records, results, file_ids)
+        ]
+        with timed("mongo_store"):
+            analyses_collection.insert_many(analyses)
+            update_fibrograms(analyses)
+        return
+    with timed("mongo_store"):
+        first = allocate_test_numbers(len(records))
+        stored_at = current_time()
+        details, analyses = [], []
+        for test_number, record, result, file_id in zip(
+            range(first, first + len(records)), records, results, file_ids
+        ):
+            image_details = ImageDetails(**{key: record[key] for key in DETAILS})
+            results_data = Results(msfl=result["msfl"], ifl=result["ifl"], ml=result["ml"])
+            details.append(
+                image_details_document(current_user, image_details, results_data, test_number, stored_at)
+            )
+            analyses.append(
+                analysis_document(
+                    current_user,
+                    "v3",
+                    file_id,
+                    result_arrays("v3", result),
+                    stored_at,
+                    test_number=test_number,
+                    calibration_factor=params["calibration_factor"],
+                    **image_details.model_dump(),
+                )
+            )
+            record["test_number"] = test_number
+        image_details_collection.insert_many(details)
+        analyses_collection.insert_many(analyses)
+        update_stats(details)
+        update_fibrograms(analyses)
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+@jwt_required()
+def get_job(job_id):
+    """
+    Report the status of a queued analysis, or its result once it is done.
+    Jobs are only known to the server process they were submitted to.
+    """
+    job = jobs.get(job_id)
+    if job is None or job["owner"] != get_jwt_identity():
+        return jsonify({"msg": "Job not found", "result": "failure"}), 404
+
+    if job["status"] == "done":
+        return analysis_response(job["result"])
+
+    if job["status"] == "failed":
         return (
-            jsonify({"msg": f"Error storing image details: {e}", "result": "failure"}),
+            jsonify(
+                {
+                    "msg": f"Processing error: {job['error']}",
+                    "result": "failure",
+                    "job_id": job_id,
+                    "status": "failed",
+                }
+            ),
             500,
         )
 
+    return jsonify({"job_id": job_id, "status": job["status"]}), 200
 
-@app.route("/api/<version>/upload", methods=["POST"])
+
+@app.route("/api/v3/recalibrate/<int:test_number>", methods=["POST"])
 @jwt_required()
-def upload_file(version):
+def recalibrate(test_number):
     """
-    Handle file uploads for different API versions.
+    Recompute MSFL, IFL and ML of a stored v3 test for a new calibration
+    factor, from its stored pixel-space analysis. Returns the overlay like
+    /api/v3/upload, with the same rendering options, or only the numbers
+    with format=json.
     """
     current_user = get_jwt_identity()
 
-    # Validate file presence
-    file = request.files.get("file")
-    if not file or file.filename == "":
-        return jsonify({"msg": "No file provided or no selected file"}), 400
+    try:
+        calibration_factor = float(request.form.get("calibration_factor", 1.0))
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid calibration factor: {e}", "result": "failure"}), 400
+    try:
+        render = render_options(request.values)
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid parameters: {e}", "result": "failure"}), 400
 
-    # Save file locally and to GridFS
-    file_path = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-    file.save(file_path)
-    file_id = grid_fs.put(
-        file.stream, filename=file.filename, content_type=file.content_type
+    document = analyses_collection.find_one(
+        {"user_id": current_user, "test_number": test_number}
     )
+    if document is None:
+        return jsonify({"msg": "Test not found", "result": "failure"}), 404
 
-    # Record upload in the database
-    user = users_collection.find_one({"username": current_user})
-    uploads_collection.insert_one({"filid": file_id, "uploaded_by": user["_id"]})
-
-    # Handle different API versions
     try:
-        if version == "v1":
-            method = int(request.form.get("method", 1))  # Default to 1 if not provided
-            result = processImage(file.filename, "lines", 1, method)
-        elif version == "v2":
-            result = segment_threads(file.filename)
-        elif version == "v3":
-            # Request parameters
-            calibration_factor = float(request.form.get("calibration_factor", 1.0))
-            cotton_type = request.form.get("cotton_type", "")
-            lot_number = request.form.get("lot_number", "")
-            station = request.form.get("station", "")
-            
-            # Generate visualization and return binary stream
-            buf, msfl, ifl, ml = main(file.filename, calibration_factor)
-            
-            # Store the input parameters along with their results
-            image_details_data = {
-                "cotton_type": cotton_type,
-                "lot_number": lot_number,
-                "station": station
-            }
-            results_data = {
-                "msfl": msfl,
-                "ifl": ifl,
-                "ml": ml
-            }
-            store_image_details(current_user, image_details_data, results_data)
-            
-            # Send the results to the client as an image
-            response = make_response(buf.getvalue())
-            response.headers.set("Content-Type", "image/png")
-            response.headers.set("Content-Disposition", "inline; filename=result.png")
-            return response
-        else:
-            return jsonify({"msg": "Invalid API version"}), 400
+        clustering = load("clustering")
+        analysis = clustering.analysis_from_document(document)
+
+        if render is None:
+            msfl, ifl, ml = clustering.measure(analysis, calibration_factor)
+            return jsonify(
+                {
+                    "test_number": test_number,
+                    "calibration_factor": calibration_factor,
+                    "msfl": msfl,
+                    "ifl": ifl,
+                    "ml": ml,
+                    "result": "success",
+                }
+            )
+
+        with timed("gridfs_get"):
+            data = grid_fs.get(document["file_id"]).read()
+        with timed("render"):
+            image, mimetype, msfl, ifl, ml = clustering.render(
+                read_image(data), analysis, calibration_factor, **render
+            )
     except Exception as e:
-        return jsonify({"msg": f"Processing error: {e}"}), 500
+        return jsonify({"msg": f"Processing error: {e}", "result": "failure"}), 500
+
+    return analysis_response({"image": image, "mimetype": mimetype})
+
+
+@app.route("/api/v1/files/<file_id>", methods=["GET"])
+@jwt_required()
+def download_file(file_id):
+    """
+    The original of a file the current user uploaded, streamed from GridFS.
+    Supports conditional requests on its sha256 and Range requests, so a
+    client can resume a download or read part of a large scan.
+    """
+    try:
+        file_id = ObjectId(file_id)
+    except InvalidId:
+        return jsonify({"msg": "File not found", "result": "failure"}), 404
+    upload = uploads_collection.find_one(
+        {"file_id": file_id, "uploaded_by": user_id(get_jwt_identity())}
+    )
+    if upload is None:
+        return jsonify({"msg": "File not found", "result": "failure"}), 404
+    try:
+        grid_out = grid_fs.get(file_id)
+    except NoFile:
+        return jsonify({"msg": "File not found", "result": "failure"}), 404
+
+    response = app.response_class(
+        wrap_file(request.environ, grid_out),
+        mimetype=grid_out.content_type or "application/octet-stream",
+        direct_passthrough=True,
+    )
+    response.content_length = grid_out.length
+    response.last_modified = grid_out.upload_date
+    response.set_etag(getattr(grid_out, "sha256", None) or str(file_id))
+    # the name the user uploaded it with, the file may be shared with others
+    filename = upload.get("filename") or grid_out.filename or str(file_id)
+    response.headers.set("Content-Disposition", "inline", filename=secure_filename(filename))
+    return response.make_conditional(request, accept_ranges=True, complete_length=grid_out.length)
+
+
+# Fields of the image details that can be selected with fields=
+IMAGE_DETAILS_FIELDS = (
+    "cotton_type",
+    "station",
+    "lot_number",
+    "test_number",
+    "date",
+    "msfl",
+    "ifl",
+    "ml",
+    "user_id",
+)
+MAX_PAGE_SIZE = 1000
+
+
+def stored_date(value):
+    """An ISO date or datetime, in IST unless it has a time zone, as dates are stored"""
+    moment = datetime.fromisoformat(value)
+    moment = IST.localize(moment) if moment.tzinfo is None else moment.astimezone(IST)
+    return str(moment)
+
+
+def image_details_filter(current_user, args):
+    """Query of the image details of the user selected by the query string"""
+    query = {"user_id": current_user}
+    for field in ("cotton_type", "station"):
+        if field in args:
+            query[field] = args[field]
+    if "lot_number" in args:
+        query["lot_number"] = int(args["lot_number"])
+
+    dates = {}
+    if "from" in args:
+        dates["$gte"] = stored_date(args["from"])
+    if "to" in args:
+        dates["$lt"] = stored_date(args["to"])
+    if dates:
+        query["date"] = dates
+    return query
+
+
+def image_details_projection(fields):
+    """Projection of comma separated fields, with what the page cursor needs"""
+    if not fields:
+        return None
+    fields = fields.split(",")
+    for field in fields:
+        if field not in IMAGE_DETAILS_FIELDS:
+            raise ValueError(f"Unknown field {field}")
+    return dict.fromkeys(fields + ["test_number", "_id"], 1)
+
 
-    return jsonify({"length": result}), 200
+def page_order(query):
+    """
+    Fields the tests of a query are listed by: their test number, or their
+    date first when the query selects a date range.
+    """
+    return (["date"] if "date" in query else []) + ["test_number", "_id"]
+
+
+def page_cursor(detail):
+    return f"{detail['test_number']}-{detail['_id']}"
+
+
+def after_cursor(cursor, descending, current_user, order):
+    """
+    Query of the tests that come after the one of a page cursor, in order.
+    Raises ValueError if the cursor is not one of the user's tests.
+    """
+    test_number, _, object_id = cursor.partition("-")
+    last = {"test_number": int(test_number), "_id": ObjectId(object_id)}
+    if "date" in order:
+        detail = image_details_collection.find_one(
+            {"_id": last["_id"], "user_id": current_user}, {"date": 1}
+        )
+        if detail is None:
+            raise ValueError(f"Unknown cursor {cursor}")
+        last["date"] = detail["date"]
+    op = "$lt" if descending else "$gt"
+    # after the last test on the first field it differs on
+    return [
+        {**{field: last[field] for field in order[:i]}, order[i]: {op: last[order[i]]}}
+        for i in range(len(order))
+    ]
 
 
 # API to retrieve image details for the current user
 @app.route("/api/v1/image_details", methods=["GET"])
 @jwt_required()
 def get_image_details():
+    """
+    Image details of the current user, ordered by test number, or by date
+    and test number when from or to is given.
+
+    Query string:
+    - cotton_type, station, lot_number: only the tests with these values
+    - from, to: only the tests dated from (included) to (excluded), as ISO
+      dates or datetimes, in IST unless they have a time zone
+    - fields: comma separated fields to return, all by default
+    - order: asc (default) or desc
+    - limit: return pages of at most limit tests, with the cursor of the
+      next page in "next" (null on the last page), to pass as after=;
+      all the tests are returned without a limit
+    - format=ndjson: stream the tests one JSON document per line, for exports
+    """
+    current_user = get_jwt_identity()
+    args = request.args
+
+    try:
+        query = image_details_filter(current_user, args)
+        projection = image_details_projection(args.get("fields"))
+        descending = args.get("order", "asc") == "desc"
+        limit = int(args["limit"]) if "limit" in args else None
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        order = page_order(query)
+        if "after" in args:
+            query["$or"] = after_cursor(args["after"], descending, current_user, order)
+    except (ValueError, InvalidId) as e:
+        return jsonify({"msg": f"Invalid query: {e}", "result": "failure"}), 400
+
+    direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+    cursor = image_details_collection.find(query, projection).sort(
+        [(field, direction) for field in order]
+    )
+
+    if args.get("format") == "ndjson":
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        def lines():
+            for detail in cursor:
+                detail["_id"] = str(detail["_id"])
+                yield json.dumps(detail) + "\n"
+
+        return app.response_class(lines(), mimetype="application/x-ndjson")
+
     try:
-        current_user = get_jwt_identity()
+        if limit is not None:
+            # one more test tells whether there is a next page
+            cursor = cursor.limit(limit + 1)
+        image_details = list(cursor)
 
-        image_details = list(image_details_collection.find({"user_id": current_user}))
+        response = {
+            "msg": "Image details fetched successfully",
+            "result": "success",
+        }
+        if limit is not None:
+            more = len(image_details) > limit
+            image_details = image_details[:limit]
+            response["next"] = page_cursor(image_details[-1]) if more else None
 
         for detail in image_details:
             detail["_id"] = str(detail["_id"])
+        response["data"] = image_details
 
-        return (
-            jsonify(
-                {
-                    "msg": "Image details fetched successfully",
-                    "result": "success",
-                    "data": image_details,
-                }
-            ),
-            200,
-        )
+        return jsonify(response), 200
 
     except Exception as e:
         return (
@@ -288,5 +1479,201 @@ def get_image_details():
         )
 
 
+# Fields of the analyses documents stored as plain lists by earlier versions
+LEGACY_ANALYSIS_FIELDS = ("endpoints", "labels", "centroids", "top_points", "top_distances")
+
+
+@app.route("/api/v1/analyses/export", methods=["GET"])
+@jwt_required()
+def export_analyses():
+    """
+    Stream the per-fiber arrays of the current user's analyses, in the order
+    they were stored, as binary frames (see fibers.py): lengths of every
+    version, and the endpoints, labels and centroids of v3.
+
+    Query string:
+    - cotton_type, station, lot_number, from, to: as for /api/v1/image_details
+    - version: only the analyses of this API version
+    """
+    current_user = get_jwt_identity()
+    args = request.args
+
+    try:
+        query = image_details_filter(current_user, args)
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid query: {e}", "result": "failure"}), 400
+    if "version" in args:
+        # the documents of earlier versions are all v3, without a version
+        versions = [args["version"], None] if args["version"] == "v3" else [args["version"]]
+        query["version"] = {"$in": versions}
+
+    cursor = analyses_collection.find(query, {"user_id": 0}).sort("_id", pymongo.ASCENDING)
+
+    def frames():
+        for document in cursor:
+            binary = document.pop("arrays", None)
+            if binary is None:
+                # stored as lists by an earlier version
+                legacy = {field: document.pop(field) for field in LEGACY_ANALYSIS_FIELDS}
+                analysis = load("clustering").analysis_from_document(legacy)
+                binary = to_binary(result_arrays("v3", {"analysis": analysis}))
+                document["version"] = "v3"
+            document["_id"] = str(document["_id"])
+            yield frame(document, binary)
+
+    return app.response_class(frames(), mimetype=FIBERS_MIMETYPE)
+
+
+@app.route("/api/v1/fibrogram", methods=["GET"])
+@jwt_required()
+def get_fibrogram():
+    """
+    Span lengths (2.5% and 50%, in mm unless their unit is px), uniformity
+    ratio and short fiber content (%) of the fibrogram of the current user's
+    fiber lengths, see fibrogram.py. A v1 or v2 analysis stored without a
+    calibration factor is in px, without short fiber content, and is not part
+    of the fibrograms of its lot.
+
+    Query string, one of:
+    - lot_number: every analysis of the lot, one entry per kind of lengths
+      (length for v1 and v2, span for v3), from its rollups
+    - test_number: a stored v3 test
+    - analysis_id: a stored analysis of any version, the _id of its export
+    """
+    current_user = get_jwt_identity()
+    args = request.args
+
+    try:
+        if "lot_number" in args:
+            query = {"user_id": current_user, "lot_number": int(args["lot_number"])}
+            with timed("mongo_fibrogram"):
+                rollups = list(fibrograms_collection.find(query).sort("kind", pymongo.ASCENDING))
+            data = [
+                {
+                    "lot_number": rollup["lot_number"],
+                    "kind": rollup["kind"],
+                    "tests": rollup["tests"],
+                    "unit": "mm",
+                    **fibrogram_metrics(*from_hist(rollup["hist"]), rollup["kind"]),
+                }
+                for rollup in rollups
+            ]
+        elif "test_number" in args or "analysis_id" in args:
+            query = {"user_id": current_user}
+            if "test_number" in args:
+                query["test_number"] = int(args["test_number"])
+            else:
+                query["_id"] = ObjectId(args["analysis_id"])
+            analysis = analyses_collection.find_one(query)
+            if analysis is None:
+                return jsonify({"msg": "Analysis not found", "result": "failure"}), 404
+            if "arrays" not in analysis:
+                return jsonify({"msg": "No lengths stored for this analysis", "result": "failure"}), 404
+            kind = FIBROGRAM_KINDS[analysis["version"]]
+            metrics = fibrogram_metrics(*analysis_histogram(analysis), kind)
+            calibrated = analysis.get("calibration_factor") is not None
+            if not calibrated and "short_fiber_content" in metrics:
+                # short fibers are defined in mm
+                metrics["short_fiber_content"] = None
+            data = [
+                {
+                    "analysis_id": str(analysis["_id"]),
+                    "test_number": analysis.get("test_number"),
+                    "lot_number": analysis.get("lot_number"),
+                    "kind": kind,
+                    "unit": "mm" if calibrated else "px",
+                    **metrics,
+                }
+            ]
+        else:
+            raise ValueError("lot_number, test_number or analysis_id is required")
+    except (ValueError, InvalidId) as e:
+        return jsonify({"msg": f"Invalid query: {e}", "result": "failure"}), 400
+
+    return jsonify({"msg": "Fibrogram computed successfully", "result": "success", "data": data})
+
+
+@app.route("/api/v1/stats", methods=["GET"])
+@jwt_required()
+def get_stats():
+    """
+    MSFL, IFL and ML statistics of the current user's tests, per group.
+
+    Query string:
+    - by: comma separated fields to group by, among lot_number, station,
+      cotton_type and day (all of them by default, none for one overall group)
+    - cotton_type, station, lot_number: only the tests with these values
+    - from, to: only the tests of the days from (included) to (excluded)
+    - percentiles: comma separated percentiles to compute, 25,50,75 by default
+    """
+    current_user = get_jwt_identity()
+    args = request.args
+
+    try:
+        by = [field for field in args.get("by", ",".join(STATS_GROUPS)).split(",") if field]
+        for field in by:
+            if field not in STATS_GROUPS:
+                raise ValueError(f"Cannot group by {field}")
+        percentiles = [float(p) for p in args.get("percentiles", "25,50,75").split(",") if p]
+        for p in percentiles:
+            if not 0 <= p <= 100:
+                raise ValueError(f"Percentile {p:g} is not between 0 and 100")
+
+        query = {"user_id": current_user}
+        for field in ("cotton_type", "station"):
+            if field in args:
+                query[field] = args[field]
+        if "lot_number" in args:
+            query["lot_number"] = int(args["lot_number"])
+        days = {}
+        if "from" in args:
+            days["$gte"] = date.fromisoformat(args["from"]).isoformat()
+        if "to" in args:
+            days["$lt"] = date.fromisoformat(args["to"]).isoformat()
+        if days:
+            query["day"] = days
+    except ValueError as e:
+        return jsonify({"msg": f"Invalid query: {e}", "result": "failure"}), 400
+
+    try:
+        with timed("mongo_stats"):
+            rollups = list(stats_collection.find(query, {"_id": 0}))
+        groups = stats_report(merge(rollups, by), percentiles)
+        return jsonify(
+            {"msg": "Statistics computed successfully", "result": "success", "data": groups}
+        )
+    except Exception as e:
+        return jsonify({"msg": f"Error computing statistics: {e}", "result": "failure"}), 500
+
+
+@app.route("/api/v1/stats/rebuild", methods=["POST"])
+@jwt_required()
+def rebuild_user_stats():
+    """
+    Recompute the rollups of the current user from their stored tests, and
+    the rollups of their fibrograms from their stored analyses.
+    """
+    try:
+        rollups = rebuild_stats(get_jwt_identity())
+        fibrograms = rebuild_fibrograms(get_jwt_identity())
+    except Exception as e:
+        return jsonify({"msg": f"Error rebuilding statistics: {e}", "result": "failure"}), 500
+    return jsonify(
+        {"msg": "Statistics rebuilt", "result": "success", "rollups": rollups, "fibrograms": fibrograms}
+    )
+
+
+@app.cli.command("rebuild-stats")
+@click.option("--user", default=None, help="Only the rollups of this user.")
+def rebuild_stats_command(user):
+    """
+    Recompute the statistics rollups from the stored tests, and the fibrogram
+    rollups from the stored analyses, once after an upgrade that changes
+    them. Run it while no uploads are stored, or again after them.
+    """
+    click.echo(f"{rebuild_stats(user)} stats rollups")
+    click.echo(f"{rebuild_fibrograms(user)} fibrogram rollups")
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5001, host="0.0.0.0")
@@ -0,0 +1,77 @@
+"""
+Password hashing for registrations and logins.
+
+bcrypt is slow on purpose: a hash or a check takes about a quarter of a
+second of CPU at the default cost of 12 rounds, and doubles with each
+round. Passwords are hashed and checked on a few threads of their own, so a
+burst of logins (at a change of shift) uses at most that many cores and the
+rest keep serving analyses and other requests; the logins waiting beyond
+max_pending are refused rather than queued.
+
+Hashes made with another number of rounds than the configured one are
+replaced on the next successful login, so changing the cost applies to
+every user as they log in.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from jobs import QueueFull
+
+ROUNDS = 12
+
+
+def hash_password(password, rounds=ROUNDS):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def verify_password(plain_password, hashed_password):
+    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+
+def hash_rounds(hashed_password):
+    """Cost of a bcrypt hash ($2b$<rounds>$<salt and hash>)"""
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with the given rounds on its own threads.
+    At most max_pending are queued or running; beyond that hash and check
+    raise QueueFull.
+    """
+
+    def __init__(self, workers=2, max_pending=64, rounds=ROUNDS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+        self.rounds = rounds
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise QueueFull("Too many passwords being checked")
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, password, hashed_password):
+        """
+        (verified, new hash): the new hash of the password with the
+        configured rounds when it is verified and hashed with other rounds,
+        else None.
+        """
+        return self._run(self._check, password, hashed_password)
+
+    def _check(self, password, hashed_password):
+        if not verify_password(password, hashed_password):
+            return False, None
+        if hash_rounds(hashed_password) == self.rounds:
+            return True, None
+        return True, hash_password(password, self.rounds)
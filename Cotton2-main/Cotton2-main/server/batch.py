@@ -0,0 +1,272 @@
+"""
+Analysis of many images at once.
+
+A batch is a list of (filename, bytes) items, from the files of a request, a
+zip archive or a directory. Its analyses run in parallel on a process pool
+and their results are summarized per lot_number and station.
+
+Usage (from the server directory):
+    python batch.py DIRECTORY [--version v3] [--method M] [--calibration-factor F]
+        [--quality full|standard|preview] [--cotton-type T] [--lot-number N] [--station S] [--manifest FILE]
+        [--workers W] [--tile T] [--warm-start] [--store USERNAME] [--output report.json]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from pydantic import ValidationError
+
+from analysis import QUALITY_LEVELS, run_analysis
+from schemas import image_details
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+# stored with every v3 result, given for the whole batch or per file
+DETAILS = ("cotton_type", "lot_number", "station")
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def is_zip(name):
+    return name.lower().endswith(".zip")
+
+
+def read_zip(data, max_bytes=None):
+    """
+    (name, bytes) of the images in a zip archive, by their path in it.
+    Raises ValueError if they would take more than max_bytes uncompressed.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Invalid zip archive: {e}")
+
+    with archive:
+        members = [
+            info
+            for info in archive.infolist()
+            if not info.is_dir() and is_image(info.filename)
+            # resource forks of archives made on macOS
+            and not os.path.basename(info.filename).startswith("._")
+        ]
+        size = sum(info.file_size for info in members)
+        if max_bytes is not None and size > max_bytes:
+            raise ValueError(f"Archive holds {size} bytes of images, more than {max_bytes}")
+        return [(info.filename, archive.read(info)) for info in members]
+
+
+def read_directory(path):
+    """(name, bytes) of the images under a directory, by their relative path"""
+    items = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if is_image(f):
+                full = os.path.join(root, f)
+                with open(full, "rb") as image:
+                    items.append((os.path.relpath(full, path), image.read()))
+    return items
+
+
+def file_details(filename, defaults, manifest=None):
+    """
+    cotton_type, lot_number and station of a file: its entry in the manifest,
+    a {filename: {...}} dict, completed by the defaults of the batch, whose
+    empty form fields are unset.
+    Raises pydantic's ValidationError if they are not valid ImageDetails.
+    """
+    details = {key: defaults.get(key) for key in DETAILS}
+    if manifest:
+        entry = manifest.get(filename, manifest.get(os.path.basename(filename), {}))
+        details.update((key, entry[key]) for key in DETAILS if key in entry)
+    return image_details(details).model_dump()
+
+
+def run_batch(items, version, params, executor, tile=None, warm_starts=None, window=None):
+    """
+    run_analysis of every (filename, data) item, spread over the executor,
+    with the warm start key of each item if given. At most window analyses
+    are queued on the executor at a time, all of them by default.
+    The results are in the order of the items, with the exception raised in
+    place of the result of an analysis that failed.
+    """
+    if warm_starts is None:
+        warm_starts = [None] * len(items)
+    window = window or len(items)
+    results = [None] * len(items)
+    queued = {}
+    for i, ((filename, data), warm_start) in enumerate(zip(items, warm_starts)):
+        if len(queued) >= window:
+            _collect(wait(queued, return_when=FIRST_COMPLETED).done, queued, results)
+        future = executor.submit(run_analysis, version, filename, data, params, tile, warm_start)
+        queued[future] = i
+    _collect(wait(queued).done, queued, results)
+    return results
+
+
+def _collect(done, queued, results):
+    # results of the done futures, in the place of their item
+    for future in done:
+        i = queued.pop(future)
+        try:
+            results[i] = future.result()
+        except Exception as e:
+            results[i] = e
+
+
+def summary(version, result):
+    """The numbers of a result, as sent back for every image of a batch"""
+    if version == "v3":
+        return {key: float(result[key]) for key in ("msfl", "ifl", "ml")}
+    lengths = [float(length) for length in result["length"][1]]
+    return {"fibers": len(lengths), "lengths": lengths}
+
+
+def _describe(values):
+    if not values:
+        return None
+    values = np.asarray(values, float)
+    return {
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def report(version, records):
+    """
+    One entry per lot_number and station of the records of a batch, the
+    dicts of file_details along with the summary of their result, or an
+    error. v3 results are described by their MSFL, IFL and ML, others by
+    the lengths of all their fibers.
+    """
+    groups = OrderedDict()
+    for record in records:
+        groups.setdefault((record["lot_number"], record["station"]), []).append(record)
+
+    entries = []
+    for (lot_number, station), group in groups.items():
+        done = [r for r in group if "error" not in r]
+        entry = {
+            "lot_number": lot_number,
+            "station": station,
+            "images": len(group),
+            "failed": len(group) - len(done),
+        }
+        if version == "v3":
+            for key in ("msfl", "ifl", "ml"):
+                entry[key] = _describe([r[key] for r in done])
+        else:
+            lengths = [length for r in done for length in r["lengths"]]
+            entry["fibers"] = len(lengths)
+            entry["length"] = _describe(lengths)
+        entries.append(entry)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory", help="directory or zip archive of images")
+    parser.add_argument("--version", default="v3", choices=("v1", "v2", "v3"))
+    parser.add_argument("--method", type=int, default=1, help="v1 method")
+    parser.add_argument("--calibration-factor", type=float, default=1.0)
+    parser.add_argument("--quality", default="full", choices=QUALITY_LEVELS, help="v2 and v3 quality")
+    parser.add_argument("--cotton-type")
+    parser.add_argument("--lot-number", type=int)
+    parser.add_argument("--station")
+    parser.add_argument("--manifest", help="JSON file of {filename: {lot_number, station, ...}}")
+    parser.add_argument("--workers", type=int, help="worker processes, all cores by default")
+    parser.add_argument("--tile", type=int, help="preprocess in tiles of this size")
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="start the v3 clustering of an image from the previous one of its station",
+    )
+    parser.add_argument("--store", metavar="USERNAME", help="store the results for this user")
+    parser.add_argument("--output", help="write the results and report to this JSON file")
+    args = parser.parse_args()
+
+    if is_zip(args.directory):
+        with open(args.directory, "rb") as f:
+            items = read_zip(f.read())
+    else:
+        items = read_directory(args.directory)
+    if not items:
+        parser.error(f"no images in {args.directory}")
+
+    if args.version == "v1":
+        params = {"method": args.method}
+    elif args.version == "v3":
+        # only the numbers are reported, the overlays are not rendered
+        params = {
+            "calibration_factor": args.calibration_factor,
+            "quality": args.quality,
+            "render": None,
+        }
+    else:
+        params = {"quality": args.quality}
+
+    manifest = None
+    if args.manifest:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+    defaults = {key: getattr(args, key) for key in DETAILS}
+
+    records = []
+    for filename, _ in items:
+        try:
+            records.append({"filename": filename, **file_details(filename, defaults, manifest)})
+        except ValidationError as e:
+            parser.error(f"invalid details for {filename}: {e}")
+
+    warm_starts = None
+    if args.warm_start:
+        warm_starts = [record["station"] or None for record in records]
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = run_batch(items, args.version, params, executor, args.tile, warm_starts)
+
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            record["error"] = str(result)
+            print(f"{record['filename']}: {result}", file=sys.stderr)
+        else:
+            record.update(summary(args.version, result))
+
+    if args.store:
+        # the app connects to the database of the server; its analysis
+        # workers are not needed here
+        os.environ.setdefault("ANALYSIS_WARM_UP", "0")
+        from app import store_batch, store_uploads
+
+        done = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+        file_ids, _ = store_uploads(args.store, [items[i] for i in done])
+        store_batch(
+            args.store,
+            [records[i] for i in done],
+            [results[i] for i in done],
+            file_ids,
+            args.version,
+            params,
+        )
+
+    output = {"images": records, "report": report(args.version, records)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output["report"], sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the windowed junction matching of segmentation.find_junctions with the
+original all-pairs route_through_array loop on the sample images in lines/.
+
+Usage (from the server directory):
+    python benchmarks/junctions.py [image ...]
+"""
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+from skan import Skeleton
+from skimage import graph
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from segmentation import (  # noqa: E402
+    MAX_ANGLE,
+    MAX_JUNCTION,
+    angle,
+    find_endpoints,
+    find_junctions,
+    skeletonize_threads,
+)
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lines")
+
+
+def find_junctions_all_pairs(endpoints, skeleton):
+    """The original O(E^2) loop: one full-image route per pair of endpoints"""
+    angles = []
+    costs = np.where(skeleton, 1, 255)
+
+    for i1 in range(len(endpoints)):
+        for i2 in range(i1 + 1, len(endpoints)):
+            e1, d1, p1 = endpoints[i1]
+            e2, d2, p2 = endpoints[i2]
+            if p1 != p2:
+                p, c = graph.route_through_array(costs, e1, e2)
+                if c <= MAX_JUNCTION:
+                    deg = angle(d1, d2)
+                    if deg <= MAX_ANGLE:
+                        angles.append((deg, i1, i2, p))
+
+    angles.sort(key=lambda a: a[0])
+    return angles
+
+
+def sample_images():
+    return sorted(
+        os.path.join(SAMPLES, f)
+        for f in os.listdir(SAMPLES)
+        if f.lower().endswith((".png", ".jpg", ".jpeg"))
+    )
+
+
+def main(images):
+    print(f"{'image':<16}{'endpoints':>10}{'merges':>8}{'all-pairs s':>13}{'windowed s':>12}  same")
+    for image in images:
+        skeleton = skeletonize_threads(cv.imread(image))
+        g = Skeleton(skeleton)
+        lengths = np.array(g.path_lengths())
+        paths = [
+            np.array(g.path_coordinates(i)).astype(int)
+            for i in range(g.n_paths)
+            if lengths[i] > MAX_JUNCTION
+        ]
+        endpoints = find_endpoints(paths)
+
+        start = time.perf_counter()
+        expected = find_junctions_all_pairs(endpoints, skeleton)
+        all_pairs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = find_junctions(endpoints, skeleton)
+        windowed = time.perf_counter() - start
+
+        same = [a[:3] for a in expected] == [a[:3] for a in found]
+        print(
+            f"{os.path.basename(image):<16}{len(endpoints):>10}{len(found):>8}"
+            f"{all_pairs:>13.2f}{windowed:>12.3f}  {same}"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or sample_images())
@@ -0,0 +1,98 @@
+"""
+Load test of logins mixed with v3 uploads against a running server.
+
+Registers --users users, then sends concurrent uploads of the same image
+twice: alone, then alongside a burst of logins of these users, as at a
+change of shift. Only the first upload is analysed, the others are result
+cache hits. It reports the throughput, the latency percentiles and the
+status codes of each kind of request in both runs, showing how much the
+logins slow the uploads down.
+
+Usage (from the server directory, with the server running):
+    python benchmarks/logins.py [--url http://localhost:5001] [--logins N]
+        [--uploads N] [--concurrency C] [--users U] [--image lines/lines_3.jpg]
+"""
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from uploads import HERE, login, upload
+
+
+def timed_login(url, credentials):
+    start = time.perf_counter()
+    response = requests.post(f"{url}/login", json=credentials)
+    return response.status_code, time.perf_counter() - start
+
+
+def run(requests_, concurrency):
+    """Run the (kind, fn) requests concurrently, (kind, status, seconds) of each"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(kind, executor.submit(fn)) for kind, fn in requests_]
+        return [(kind, *future.result()) for kind, future in futures]
+
+
+def print_results(title, results, elapsed):
+    print(f"{title}: {len(results)} requests in {elapsed:.2f} s")
+    for kind in sorted({kind for kind, _, _ in results}):
+        statuses = Counter(status for k, status, _ in results if k == kind)
+        latencies = np.array([seconds for k, _, seconds in results if k == kind])
+        print(
+            f"  {kind}: {len(latencies) / elapsed:.1f}/s, latency ms "
+            + ", ".join(f"p{p} {np.percentile(latencies, p) * 1000:.0f}" for p in (50, 90, 99))
+            + f", max {latencies.max() * 1000:.0f}; status codes "
+            + ", ".join(f"{s}: {n}" for s, n in sorted(statuses.items()))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--uploads", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--image", default=os.path.join(HERE, "..", "lines", "lines_3.jpg"))
+    args = parser.parse_args()
+
+    users = [{"username": f"loadtest-{i}", "password": f"loadtest-{i}"} for i in range(args.users)]
+    headers = login(args.url, users[0]["username"], users[0]["password"])
+    for user in users[1:]:
+        login(args.url, user["username"], user["password"])
+
+    with open(args.image, "rb") as f:
+        image = {"name": args.image, "data": f.read()}
+    form = {"calibration_factor": "1", "cotton_type": "loadtest", "lot_number": "1", "station": "loadtest"}
+    status, seconds = upload(args.url, headers, image, form)
+    print(f"first upload (analysed): {status} in {seconds:.3f} s")
+
+    uploads = [("upload", lambda: upload(args.url, headers, image, form))] * args.uploads
+    start = time.perf_counter()
+    results = run(uploads, args.concurrency)
+    print_results("uploads alone", results, time.perf_counter() - start)
+
+    logins = [
+        ("login", lambda user=users[i % len(users)]: timed_login(args.url, user))
+        for i in range(args.logins)
+    ]
+    # logins spread evenly among the uploads
+    mixed = [
+        request
+        for _, request in sorted(
+            [(i / len(uploads), r) for i, r in enumerate(uploads)]
+            + [(i / len(logins), r) for i, r in enumerate(logins)],
+            key=lambda item: item[0],
+        )
+    ]
+    start = time.perf_counter()
+    results = run(mixed, args.concurrency)
+    print_results("uploads and logins", results, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
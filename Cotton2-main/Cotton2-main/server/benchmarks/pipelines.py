@@ -0,0 +1,266 @@
+"""
+Time the analysis pipelines and check their lengths against known ones.
+
+Runs v1 method 1 (lines_1.fiber_length_1), v1 method 2
+(lines_2.fiber_length_2), v2 (segmentation.segment_threads) and v3
+(clustering) through analysis.run_analysis on the sample images in lines/
+and on synthetic images from benchmarks/synthetic.py. For every image and
+method it reports the median time of each stage, the peak memory allocated
+by one run, the counts of the method and, for synthetic images, the error of
+the measured lengths. The report is written as JSON so runs on two commits,
+or at two qualities, can be compared with --compare.
+
+Usage (from the server directory):
+    python benchmarks/pipelines.py [--corpus] [--synthetic N] [--fibers N]
+        [--width W] [--height H] [--beard] [--methods v1.1,v1.2,v2,v3]
+        [--repeat R] [--tile T] [--quality full|standard|preview]
+        [--output report.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import cv2 as cv  # noqa: E402
+import numpy as np  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+from analysis import QUALITY_LEVELS, run_analysis  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+SAMPLES = os.path.join(HERE, "..", "lines")
+
+# method name -> (API version, parameters)
+METHODS = {
+    "v1.1": ("v1", {"method": 1}),
+    "v1.2": ("v1", {"method": 2}),
+    "v2": ("v2", {}),
+    "v3": ("v3", {"calibration_factor": 1.0}),
+}
+
+
+def sample_images():
+    for f in sorted(os.listdir(SAMPLES)):
+        if f.lower().endswith((".png", ".jpg", ".jpeg")):
+            with open(os.path.join(SAMPLES, f), "rb") as image:
+                yield f, image.read(), None
+
+
+def synthetic_images(count, fibers, width, height, thickness, beard):
+    # the name identifies the image, for comparisons between reports
+    layout = "beard" if beard else "random"
+    for seed in range(count):
+        img, lengths = generate(fibers, width, height, thickness=thickness, beard=beard, seed=seed)
+        _, encoded = cv.imencode(".png", img)
+        name = f"{width}x{height}-{layout}-{fibers}x{thickness}px-{seed}"
+        yield name, encoded.tobytes(), lengths
+
+
+def analyse(method, name, data, tile=None, quality="full"):
+    version, params = METHODS[method]
+    if version in ("v2", "v3"):
+        params = dict(params, quality=quality)
+    return run_analysis(version, name, data, params, tile)
+
+
+def measured_lengths(method, result):
+    if method == "v3":
+        return None
+    return [float(length) for length in result["length"][1]]
+
+
+def accuracy(measured, truth):
+    """Count and length errors of measured fiber lengths, relative to the truth"""
+    report = {"count": len(measured), "true_count": len(truth)}
+    if measured:
+        report["mean_error"] = float(np.mean(measured) / np.mean(truth) - 1)
+        report["total_error"] = float(np.sum(measured) / np.sum(truth) - 1)
+    if len(measured) == len(truth):
+        # the lengths are matched by rank when the count is right
+        errors = np.abs(np.sort(measured) / np.sort(truth) - 1)
+        report["sorted_error"] = float(np.mean(errors))
+    return report
+
+
+def benchmark(method, name, data, truth, repeat, tile=None, quality="full"):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = analyse(method, name, data, tile, quality)
+        result["timings"]["wall"] = time.perf_counter() - start
+        timings.append(result["timings"])
+
+    # memory is measured on a separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    analyse(method, name, data, tile, quality)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stages = {
+        stage: float(np.median([t.get(stage, 0.0) for t in timings]))
+        for stage in timings[0]
+    }
+    report = {
+        "image": name,
+        "method": method,
+        "repeat": repeat,
+        "seconds": stages,
+        "peak_alloc": peak,
+        "stats": {k: v for k, v in result["stats"].items() if k != "peak_rss"},
+    }
+    if method == "v3":
+        report["result"] = {k: float(result[k]) for k in ("msfl", "ifl", "ml")}
+    else:
+        lengths = measured_lengths(method, result)
+        report["result"] = {"fibers": len(lengths), "length": float(np.sum(lengths))}
+    if truth is not None and method != "v3":
+        report["accuracy"] = accuracy(measured_lengths(method, result), truth)
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def warm_up(methods):
+    """Run every method once on a small image so JIT compilation is not timed"""
+    img, _ = generate(fibers=3, width=200, height=150, min_length=40, max_length=100)
+    _, encoded = cv.imencode(".png", img)
+    for method in methods:
+        try:
+            analyse(method, "warm-up", encoded.tobytes())
+        except Exception:
+            pass
+
+
+def print_report(results, previous=None):
+    before = {}
+    if previous is not None:
+        before = {(r["image"], r["method"]): r for r in previous["results"]}
+
+    print(f"{'image':<32}{'method':<7}{'time s':>9}{'alloc MB':>10}  {'error':<28}slowest stages")
+    for r in results:
+        wall = r["seconds"]["wall"]
+        if "error" in r:
+            message = r["error"].splitlines()[0] if r["error"] else ""
+            print(f"{r['image']:<32}{r['method']:<7}{'':>9}{'':>10}  failed: {message}")
+            continue
+        accuracy = r.get("accuracy", {})
+        error = f"count {accuracy['count']}/{accuracy['true_count']}" if accuracy else ""
+        if "mean_error" in accuracy:
+            error += f" mean {accuracy['mean_error']:+.1%}"
+        stages = sorted(
+            (s for s in r["seconds"].items() if s[0] not in ("wall", "total")),
+            key=lambda s: -s[1],
+        )
+        slowest = ", ".join(f"{s} {t * 1000:.0f}ms" for s, t in stages[:3])
+        line = f"{r['image']:<32}{r['method']:<7}{wall:>9.3f}{r['peak_alloc'] / 2**20:>10.1f}  {error:<28}{slowest}"
+        old = before.get((r["image"], r["method"]))
+        if old is not None and "error" not in old:
+            line += f"  ({wall / old['seconds']['wall']:.2f}x of {previous['commit']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", action="store_true", help="run on the sample images")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic images")
+    parser.add_argument("--fibers", type=int, default=10)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--thickness", type=int, default=4)
+    parser.add_argument("--beard", action="store_true")
+    parser.add_argument("--methods", default=",".join(METHODS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tile", type=int, help="preprocess in tiles of this size")
+    parser.add_argument("--quality", default="full", choices=QUALITY_LEVELS, help="v2 and v3 quality")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if not args.corpus and not args.synthetic:
+        args.corpus = True
+    methods = args.methods.split(",")
+    for method in methods:
+        if method not in METHODS:
+            parser.error(f"unknown method {method}, expected one of {', '.join(METHODS)}")
+
+    images = []
+    if args.corpus:
+        images.extend(sample_images())
+    if args.synthetic:
+        images.extend(
+            synthetic_images(
+                args.synthetic,
+                fibers=args.fibers,
+                width=args.width,
+                height=args.height,
+                thickness=args.thickness,
+                beard=args.beard,
+            )
+        )
+
+    warm_up(methods)
+
+    results = []
+    for name, data, truth in images:
+        for method in methods:
+            try:
+                results.append(
+                    benchmark(method, name, data, truth, args.repeat, args.tile, args.quality)
+                )
+            except Exception as e:
+                # some methods fail on some images, e.g. v3 without enough endpoints
+                results.append({"image": name, "method": method, "seconds": {"wall": None}, "error": str(e)})
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": vars(args),
+        "peak_rss": peak_rss(),
+        "results": results,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Synthetic fiber images with known lengths.
+
+Fibers are smooth curves whose heading oscillates along their length, drawn
+as dark anti-aliased strokes on a light background like the photos in
+lines/. The length of every fiber is known exactly, so the measured lengths
+of the pipelines can be checked against it.
+
+Usage (from the server directory), to look at an image:
+    python benchmarks/synthetic.py out.png [--fibers N] [--width W] [--height H] [--beard]
+"""
+import argparse
+
+import cv2 as cv
+import numpy as np
+
+STEP = 0.25  # arc length between the points of a drawn curve, in pixels
+
+
+def fiber_curve(rng, length, start, heading, bend):
+    """
+    Points of a curve of the given arc length: the heading oscillates around
+    its initial value with an amplitude of bend radians.
+    """
+    n = max(2, int(round(length / STEP)) + 1)
+    s = np.linspace(0.0, length, n)
+    wavelength = rng.uniform(0.5, 1.5) * length
+    phase = rng.uniform(0, 2 * np.pi)
+    theta = heading + bend * np.sin(2 * np.pi * s / wavelength + phase)
+
+    # integrate the unit tangent over the arc length, midpoint rule
+    mid = (theta[1:] + theta[:-1]) / 2
+    ds = np.diff(s)
+    points = np.zeros((n, 2))
+    points[1:, 0] = np.cumsum(np.cos(mid) * ds)
+    points[1:, 1] = np.cumsum(np.sin(mid) * ds)
+    return points + start
+
+
+def generate(
+    fibers=10,
+    width=800,
+    height=600,
+    min_length=150,
+    max_length=450,
+    thickness=4,
+    bend=0.6,
+    beard=False,
+    seed=0,
+    max_tries=1000,
+):
+    """
+    Draw fibers on a width x height BGR image.
+
+    With beard=True the fibers start on a common clamp line on the left and
+    run to the right, like a fiber beard; otherwise they are placed and
+    oriented at random. Returns the image and the arc length of every fiber
+    in pixels, in drawing order.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, np.uint8)
+    margin = thickness + 2
+    lengths = []
+
+    for _ in range(fibers):
+        for _ in range(max_tries):
+            length = rng.uniform(min_length, max_length)
+            if beard:
+                start = np.array([margin, rng.uniform(margin, height - margin)])
+                heading = rng.normal(0, 0.15)
+            else:
+                start = rng.uniform([margin, margin], [width - margin, height - margin])
+                heading = rng.uniform(0, 2 * np.pi)
+            points = fiber_curve(rng, length, start, heading, bend)
+            inside = (
+                (points >= margin).all()
+                and (points[:, 0] < width - margin).all()
+                and (points[:, 1] < height - margin).all()
+            )
+            if inside:
+                break
+        else:
+            raise ValueError(f"Could not fit a fiber of {min_length}-{max_length} px in the image")
+
+        # polylines takes fixed point coordinates, 4 fractional bits
+        cv.polylines(
+            img,
+            [np.round(points * 16).astype(np.int32)],
+            isClosed=False,
+            color=(40, 40, 40),
+            thickness=thickness,
+            lineType=cv.LINE_AA,
+            shift=4,
+        )
+        lengths.append(float(length))
+
+    return img, lengths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output")
+    parser.add_argument("--fibers", type=int, default=10)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--thickness", type=int, default=4)
+    parser.add_argument("--beard", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    img, lengths = generate(
+        args.fibers,
+        args.width,
+        args.height,
+        thickness=args.thickness,
+        beard=args.beard,
+        seed=args.seed,
+    )
+    cv.imwrite(args.output, img)
+    print(" ".join(f"{length:.1f}" for length in lengths))
+
+
+if __name__ == "__main__":
+    main()
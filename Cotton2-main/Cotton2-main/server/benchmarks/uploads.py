@@ -0,0 +1,108 @@
+"""
+Load test of concurrent v3 uploads against a running server.
+
+Logs in (registering the user if needed) and sends the same image as many
+concurrent v3 uploads. Only the first upload is analysed; the others are
+result cache hits, so the test measures the storage path of an upload:
+GridFS, the test number counter and the image_details/analyses inserts.
+It reports the throughput, the latency percentiles and the status codes,
+then checks that the stored test numbers are unique.
+
+Usage (from the server directory, with the server running):
+    python benchmarks/uploads.py [--url http://localhost:5001] [--uploads N]
+        [--concurrency C] [--image lines/lines_3.jpg] [--username U] [--password P]
+"""
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def login(url, username, password):
+    credentials = {"username": username, "password": password}
+    requests.post(f"{url}/register", json=credentials)
+    response = requests.post(f"{url}/login", json=credentials)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def upload(url, headers, image, form):
+    start = time.perf_counter()
+    response = requests.post(
+        f"{url}/api/v3/upload",
+        headers=headers,
+        files={"file": (os.path.basename(image["name"]), image["data"])},
+        data=form,
+    )
+    return response.status_code, time.perf_counter() - start
+
+
+def test_numbers(url, headers):
+    response = requests.get(f"{url}/api/v1/image_details", headers=headers)
+    response.raise_for_status()
+    return [detail["test_number"] for detail in response.json()["data"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--uploads", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=300)
+    parser.add_argument("--image", default=os.path.join(HERE, "..", "lines", "lines_3.jpg"))
+    parser.add_argument("--username", default="loadtest")
+    parser.add_argument("--password", default="loadtest")
+    parser.add_argument("--lot-number", type=int, default=1)
+    parser.add_argument("--station", default="loadtest")
+    args = parser.parse_args()
+
+    headers = login(args.url, args.username, args.password)
+    with open(args.image, "rb") as f:
+        image = {"name": args.image, "data": f.read()}
+    form = {
+        "calibration_factor": "1",
+        "cotton_type": "loadtest",
+        "lot_number": str(args.lot_number),
+        "station": args.station,
+    }
+
+    before = len(test_numbers(args.url, headers))
+    status, seconds = upload(args.url, headers, image, form)
+    print(f"first upload (analysed): {status} in {seconds:.3f} s")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda _: upload(args.url, headers, image, form), range(args.uploads)
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter(status for status, _ in results)
+    latencies = np.array([seconds for _, seconds in results])
+    print(
+        f"{args.uploads} uploads, {args.concurrency} concurrent: {elapsed:.2f} s, "
+        f"{args.uploads / elapsed:.1f} uploads/s"
+    )
+    print(
+        "latency ms: "
+        + ", ".join(
+            f"p{p} {np.percentile(latencies, p) * 1000:.0f}" for p in (50, 90, 99)
+        )
+        + f", max {latencies.max() * 1000:.0f}"
+    )
+    print("status codes: " + ", ".join(f"{s}: {n}" for s, n in sorted(statuses.items())))
+
+    numbers = test_numbers(args.url, headers)
+    duplicates = sum(n - 1 for n in Counter(numbers).values() if n > 1)
+    print(f"{len(numbers) - before} tests stored, {duplicates} duplicate test numbers")
+
+
+if __name__ == "__main__":
+    main()
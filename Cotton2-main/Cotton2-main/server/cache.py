@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def cache_key(data, version, params):
+    """
+    Content address of an analysis: hash of the uploaded bytes (bytes or a
+    seekable file object) together with the API version and its parameters.
+    data can also be the hashlib.sha256 of the bytes, when it is needed for
+    other uses too, so they are only hashed once. v1 and v2 results are in
+    pixels, calibrated after the lookup, so their calibration_factor is not
+    part of the key.
+    """
+    if version in ("v1", "v2"):
+        params = {k: v for k, v in params.items() if k != "calibration_factor"}
+    if hasattr(data, "hexdigest"):
+        digest = data.copy()
+    elif hasattr(data, "read"):
+        digest = hashlib.sha256()
+        data.seek(0)
+        for chunk in iter(lambda: data.read(1 << 20), b""):
+            digest.update(chunk)
+        data.seek(0)
+    else:
+        digest = hashlib.sha256(data)
+
+    digest.update(json.dumps([version, params], sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+_LENGTH = struct.Struct(">I")
+
+
+def dumps(result):
+    """
+    Bytes of a result: the length of a JSON header as 4 bytes (big-endian),
+    the header, then the raw bytes of its arrays, as the export frames of
+    fibers.py. The header holds its dicts, lists and other values, with its
+    arrays, numpy scalars and bytes replaced by their index in the arrays
+    and their dtype and shape. Unlike a pickle, loading it runs no code.
+    """
+    arrays = []
+
+    def encode(value):
+        if isinstance(value, dict):
+            return {str(k): encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        if isinstance(value, bytes):
+            arrays.append(np.frombuffer(value, np.uint8))
+            return {"__bytes__": len(arrays) - 1}
+        if isinstance(value, (np.ndarray, np.generic)):
+            array = np.asarray(value)
+            if array.dtype.hasobject:
+                raise TypeError("Arrays of objects cannot be cached")
+            arrays.append(array)
+            # numpy scalars come back as they are, from 0-d arrays
+            return {"__array__": len(arrays) - 1, "scalar": isinstance(value, np.generic)}
+        return value
+
+    value = encode(result)
+    header = json.dumps(
+        {"value": value, "arrays": [[a.dtype.str, a.shape] for a in arrays]}
+    ).encode("utf-8")
+    return b"".join([_LENGTH.pack(len(header)), header] + [a.tobytes() for a in arrays])
+
+
+def loads(data):
+    """Inverse of dumps, raises ValueError for bytes it did not write"""
+    (size,) = _LENGTH.unpack_from(data)
+    header = json.loads(bytes(data[_LENGTH.size : _LENGTH.size + size]))
+    offset = _LENGTH.size + size
+    arrays = []
+    for dtype, shape in header["arrays"]:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        array = np.frombuffer(data, dtype, count, offset).reshape(shape)
+        arrays.append(array.copy())
+        offset += count * dtype.itemsize
+
+    def decode(value):
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if "__bytes__" in value:
+            return arrays[value["__bytes__"]].tobytes()
+        if "__array__" in value:
+            array = arrays[value["__array__"]]
+            return array[()] if value["scalar"] else array
+        return {k: decode(v) for k, v in value.items()}
+
+    return decode(header["value"])
+
+
+class ResultCache:
+    """
+    Cache of analysis results keyed by cache_key.
+
+    Results are kept in memory in LRU order until the size of their dumps()
+    exceeds max_bytes. If a directory is given, every result is also written
+    there and looked up on a memory miss, so hits survive restarts and are
+    shared by processes on the same host. The files are read with loads(),
+    which cannot run code, so whoever can write to the directory can only
+    change results.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return loads(self.entries[key])
+
+        data = self._read(key)
+        if data is None:
+            return None
+        try:
+            result = loads(data)
+        except (ValueError, KeyError, TypeError, struct.error):
+            # a file that is not a result is a miss
+            return None
+        self._remember(key, data)
+        return result
+
+    def put(self, key, result):
+        data = dumps(result)
+        self._remember(key, data)
+        self._write(key, data)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.bin")
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key, data):
+        if not self.directory:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+class TTLCache:
+    """
+    Bounded mapping whose entries expire ttl seconds after they are put, the
+    least recently used ones going first when it is full.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
@@ -1,76 +1,72 @@
 import cv2 as cv
 import numpy as np
-from io import BytesIO
-from skimage import morphology
-from skan import Skeleton
-from scipy.ndimage import convolve
-from sklearn.cluster import KMeans
 
+from fibers import from_binary
+from pipeline import as_pipeline, downsample
+from rendering import downscale, encode
+from topology import coordinates, degrees, long_paths, path_ends
+from twomeans import TwoMeans
 
-def preprocess(img_path):
+# keeps the last centroids of every warm start key, in this process
+ENGINE = TwoMeans()
+
+
+PREPROCESS = (
+    ("decode", {}),
+    ("gray", {}),
+    ("dilate", {"kernel": 2}),
+    ("adaptive_threshold", {"block_size": 29, "c": -2}),
+    ("remove_small_objects", {"min_size": 200}),
+    ("skeletonize", {}),
+    ("remove_small_objects", {"min_size": 200}),
+)
+
+
+def preprocess(image, levels=0):
     """
     Step 1: Extracting endpoints of fibers
     Skeletonizes the input image and identifies terminal endpoints.
+    The image can be a path, encoded bytes, a decoded BGR array or an
+    ImagePipeline shared with other methods.
+    With levels, the image is skeletonized downsampled by that many levels
+    of its pyramid, with the thresholds in pixels scaled to match; the
+    endpoints are still in pixels of the full image.
     """
-    img = cv.imread(img_path)
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-
-    # Preprocessing
-    kernel = np.ones((2, 2), np.uint8)
-    dilated = cv.dilate(gray, kernel, iterations=1)
+    scale = 0.5**levels
+    steps = downsample(PREPROCESS, levels)
+    pipeline = as_pipeline(image)
+    img = pipeline.run(PREPROCESS[:1])
+    skeleton = pipeline.run(steps)
 
-    thresh = cv.adaptiveThreshold(
-        dilated, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 29, -2
-    )
-    thresh = morphology.remove_small_objects(thresh.astype(bool), 200, connectivity=2)
+    # Extract endpoints
+    MAX_JUNCTION = 12 * scale
+    MIN_PATH_LENGTH = 12 * scale
 
-    # Skeletonization
-    skeleton = morphology.skeletonize(thresh.astype(bool), method="lee")
-    skeleton = morphology.remove_small_objects(
-        skeleton.astype(bool), 200, connectivity=2
-    )
+    g = pipeline.skeleton(steps)
+    paths = long_paths(g, MAX_JUNCTION, MIN_PATH_LENGTH)
+    ends = path_ends(g, paths)
 
-    # Extract endpoints
-    structuring_element = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]])
-    neighbor_count = convolve(
-        skeleton.astype(int), structuring_element, mode="constant", cval=0
-    )
+    # keep the endpoints with exactly one neighbour, their degree in the
+    # graph of the skeleton
+    if len(ends):
+        valid_endpoints = coordinates(g, ends[degrees(g, ends) == 1]) * 2**levels
+    else:
+        valid_endpoints = np.array([])
 
-    MAX_JUNCTION = 12
-    MIN_PATH_LENGTH = 12
-
-    g = Skeleton(skeleton)
-    lengths = np.array(g.path_lengths())
-    paths = [
-        list(np.array(g.path_coordinates(i)).astype(int))
-        for i in range(g.n_paths)
-        if lengths[i] > MAX_JUNCTION
-    ]
-    paths = [p for p in paths if len(p) > MIN_PATH_LENGTH]
-    method2_endpoints = [p[0] for p in paths if len(p) > 0] + [
-        p[-1] for p in paths if len(p) > 0
-    ]
-    method2_endpoints = np.array(method2_endpoints)
-
-    valid_endpoints = []
-    for ep in method2_endpoints:
-        y, x = ep
-        if skeleton[y, x] and neighbor_count[y, x] == 1:
-            valid_endpoints.append(ep)
-    valid_endpoints = np.array(valid_endpoints)
+    pipeline.count("paths", len(paths))
+    pipeline.count("endpoints", len(valid_endpoints))
 
     return img, skeleton, valid_endpoints
 
 
-def cluster_endpoints(endpoints):
+def cluster_endpoints(endpoints, warm_start=None):
     """
     Step 2: Dividing Endpoints into Two Clusters
-    Uses k-means clustering to separate endpoints into two clusters.
+    Uses 2-means clustering to separate endpoints into two clusters, the
+    clusters of KMeans(n_clusters=2, random_state=42). With a warm_start key,
+    it starts from the centroids last found for that key (see twomeans).
     """
-    kmeans = KMeans(n_clusters=2, random_state=42)
-    labels = kmeans.fit_predict(endpoints)
-    centroids = kmeans.cluster_centers_
-    return labels, centroids
+    return ENGINE.fit(endpoints, warm_start)
 
 
 def calculate_fiber_length(centroids, calibration_factor):
@@ -89,16 +85,22 @@ def visualize_results(
     refined_cluster_2,
     msfl,
     mean_length,
+    scale=1.0,
 ):
     """
     Visualizes the clusters and centroids, along with the calculated distance.
-    Returns the image as a binary stream for serving.
+    Draws on img, an image scaled by scale from the one the points are in.
     """
+
+    def size(pixels):
+        # marks keep their size relative to the image
+        return max(1, round(pixels * scale))
+
     for point in refined_cluster_1:
         cv.circle(
             img,
-            (int(point[1]), int(point[0])),
-            radius=5,
+            (int(point[1] * scale), int(point[0] * scale)),
+            radius=size(5),
             color=(0, 0, 255),
             thickness=-1,
         )
@@ -106,8 +108,8 @@ def visualize_results(
     for point in refined_cluster_2:
         cv.circle(
             img,
-            (int(point[1]), int(point[0])),
-            radius=5,
+            (int(point[1] * scale), int(point[0] * scale)),
+            radius=size(5),
             color=(255, 0, 0),
             thickness=-1,
         )
@@ -115,32 +117,32 @@ def visualize_results(
     for centroid in centroids:
         cv.circle(
             img,
-            (int(centroid[1]), int(centroid[0])),
-            radius=8,
+            (int(centroid[1] * scale), int(centroid[0] * scale)),
+            radius=size(8),
             color=(0, 255, 0),
             thickness=-1,
         )
 
-    x1, y1 = centroids[0]
-    x2, y2 = centroids[1]
+    x1, y1 = centroids[0] * scale
+    x2, y2 = centroids[1] * scale
     mid_x, mid_y = (x1 + x2) / 2, (y1 + y2) / 2
 
     if x1 == x2:
         # Vertical line case
-        pt1 = (int(mid_y - 200), int(mid_x))
-        pt2 = (int(mid_y + 200), int(mid_x))
+        pt1 = (int(mid_y - 200 * scale), int(mid_x))
+        pt2 = (int(mid_y + 200 * scale), int(mid_x))
     else:
         # Compute slope and perpendicular slope
         slope = (y2 - y1) / (x2 - x1)
         perp_slope = -1 / slope
 
         # Generate two points along the perpendicular line
-        dx = 200  # Arbitrary length for drawing
+        dx = 200 * scale  # Arbitrary length for drawing
         dy = perp_slope * dx
         pt1 = (int(mid_x - dx), int(mid_y - dy))
         pt2 = (int(mid_x + dx), int(mid_y + dy))
 
-    cv.line(img, (pt1[1], pt1[0]), (pt2[1], pt2[0]), color=(0, 255, 255), thickness=2)
+    cv.line(img, (pt1[1], pt1[0]), (pt2[1], pt2[0]), color=(0, 255, 255), thickness=size(2))
 
     text1 = f"Machine Setting Fiber Length (MSFL) = {msfl:.2f} mm"
     text2 = f"Image-Based Fiber Length (IFL) = {msfl + 2:.2f} mm"
@@ -151,43 +153,39 @@ def visualize_results(
     cv.putText(
         img,
         text1,
-        (50, 50),
+        (size(50), size(50)),
         fontFace=cv.FONT_HERSHEY_SIMPLEX,
         fontScale=font_scale,
         color=(255, 255, 255),
-        thickness=2,
+        thickness=size(2),
     )
 
     cv.putText(
         img,
         text2,
-        (50, 100),
+        (size(50), size(100)),
         fontFace=cv.FONT_HERSHEY_SIMPLEX,
         fontScale=font_scale,
         color=(255, 255, 255),
-        thickness=2,
+        thickness=size(2),
     )
 
     cv.putText(
         img,
         text3,
-        (50, 150),
+        (size(50), size(150)),
         fontFace=cv.FONT_HERSHEY_SIMPLEX,
         fontScale=font_scale,
         color=(255, 255, 255),
-        thickness=2,
+        thickness=size(2),
     )
 
-    # Encode the image to PNG format
-    _, encoded_img = cv.imencode(".png", img)
+    return img
 
-    buf = BytesIO(encoded_img.tobytes())
-    buf.seek(0)
-    return buf
 
-
-def compute_perpendicular_distance(point, cluster_center1, cluster_center2):
-    x0, y0 = point
+def compute_perpendicular_distance(points, cluster_center1, cluster_center2):
+    """Distances of (row, col) points, one or an array of them, from the perpendicular bisector"""
+    x0, y0 = np.asarray(points, dtype=float).T
     x1, y1 = cluster_center1
     x2, y2 = cluster_center2
     xm, ym = (cluster_center1 + cluster_center2) / 2.0
@@ -198,49 +196,152 @@ def compute_perpendicular_distance(point, cluster_center1, cluster_center2):
     b = -1
     c = ym - m * xm
 
-    num = abs(a * x0 + b * y0 + c)
+    num = np.abs(a * x0 + b * y0 + c)
     den = np.sqrt(a**2 + b**2)
     return num / den
 
 
 def filter_top(endpoints, cluster_center1, cluster_center2):
+    endpoints = np.asarray(endpoints)
     # Compute distances of each endpoint from the perpendicular bisector
-    distances = [
-        compute_perpendicular_distance(p, cluster_center1, cluster_center2)
-        for p in endpoints
-    ]
+    distances = compute_perpendicular_distance(endpoints, cluster_center1, cluster_center2)
 
     num_to_select = max(1, int(0.025 * len(endpoints)))
 
-    top_indices = np.argsort(distances)[-num_to_select:]
-
-    msfl_half = np.min(np.array(distances)[top_indices])
+    # the furthest endpoints, without sorting all of them, in increasing order
+    top_indices = np.argpartition(distances, -num_to_select)[-num_to_select:]
+    top_indices = top_indices[np.argsort(distances[top_indices])]
 
-    return np.array(endpoints)[top_indices], msfl_half
+    # the smallest of these distances is half of the MSFL
+    return endpoints[top_indices], distances[top_indices]
 
 
-def main(image_path, calibration_factor):
+def analyze(image, levels=0, warm_start=None):
     """
-    Main function to execute the fiber length estimation algorithm.
+    Steps 1-3 in pixel units, independent of the calibration factor.
+    Returns the image and the endpoints, their cluster labels, the centroids
+    and the top 2.5% endpoints of each cluster with their distances.
+    The endpoints are found on the image downsampled by levels of its
+    pyramid (see preprocess), the results are in pixels of the full image.
+    warm_start is the key of the clustering (see cluster_endpoints).
     """
+    pipeline = as_pipeline(image)
+
     # Step 1: Extract endpoints
-    img, _, endpoints = preprocess(f"uploads/{image_path}")
+    img, _, endpoints = preprocess(pipeline, levels)
 
     # Step 2: Cluster endpoints
-    labels, centroids = cluster_endpoints(endpoints)
-
-    _, mean_length = calculate_fiber_length(centroids, calibration_factor)
+    with pipeline.timer("kmeans"):
+        labels, centroids = cluster_endpoints(endpoints, warm_start)
 
     # Step 3: Compute top 2.5% endpoints for each cluster
-    cluster_1 = endpoints[labels == 0]
-    cluster_2 = endpoints[labels == 1]
-
-    refined_cluster_1, msfl1 = filter_top(cluster_1, centroids[0], centroids[1])
-    refined_cluster_2, msfl2 = filter_top(cluster_2, centroids[0], centroids[1])
+    top_points = []
+    top_distances = []
+    with pipeline.timer("filter_top"):
+        for label in (0, 1):
+            refined_cluster, distances = filter_top(
+                endpoints[labels == label], centroids[0], centroids[1]
+            )
+            top_points.append(refined_cluster)
+            top_distances.append(distances)
+
+    analysis = {
+        "endpoints": endpoints,
+        "labels": labels,
+        "centroids": centroids,
+        "top_points": top_points,
+        "top_distances": top_distances,
+    }
+    return img, analysis
+
+
+def measure(analysis, calibration_factor):
+    """
+    Step 4: MSFL, IFL and ML in real-world units from a pixel-space analysis.
+    """
+    _, mean_length = calculate_fiber_length(analysis["centroids"], calibration_factor)
 
+    msfl1, msfl2 = (np.min(d) for d in analysis["top_distances"])
     msfl = (msfl1 + msfl2) * calibration_factor
 
+    return msfl, msfl + 2, mean_length
+
+
+def render(img, analysis, calibration_factor, format="png", quality=None, max_dim=None):
+    """
+    Draws an analysis on its image for a calibration factor, scaled down to
+    max_dim, and encodes it (see rendering.encode).
+    Returns the encoded image and its mimetype along with MSFL, IFL and ML.
+    """
+    msfl, ifl, mean_length = measure(analysis, calibration_factor)
+    small, scale = downscale(img, max_dim)
+    # draw on a copy, the decoded image may be shared with other methods;
+    # a scaled down image is a new one already
+    img = img.copy() if small is img else small
+    refined_cluster_1, refined_cluster_2 = analysis["top_points"]
+    visualize_results(
+        img,
+        analysis["centroids"],
+        refined_cluster_1,
+        refined_cluster_2,
+        msfl,
+        mean_length,
+        scale,
+    )
+    data, mimetype = encode(img, format, quality)
+    return data, mimetype, msfl, ifl, mean_length
+
+
+def analysis_to_arrays(analysis):
+    """
+    The arrays of an analysis stored for it (see fibers.py), with the
+    distances of all its endpoints from the perpendicular bisector as the
+    lengths of its fibers.
+    """
+    centroids = analysis["centroids"]
+    return {
+        "lengths": compute_perpendicular_distance(analysis["endpoints"], centroids[0], centroids[1]),
+        "endpoints": analysis["endpoints"],
+        "labels": analysis["labels"],
+        "centroids": centroids,
+        "top_points_0": analysis["top_points"][0],
+        "top_points_1": analysis["top_points"][1],
+        "top_distances_0": analysis["top_distances"][0],
+        "top_distances_1": analysis["top_distances"][1],
+    }
+
+
+def analysis_from_document(document):
+    """
+    The analysis of a document of the analyses collection, with its arrays
+    stored as binary, or as plain lists by earlier versions.
+    """
+    if "arrays" in document:
+        arrays = from_binary(document["arrays"])
+        return {
+            "endpoints": arrays["endpoints"].astype(int),
+            "labels": arrays["labels"].astype(int),
+            "centroids": arrays["centroids"],
+            "top_points": [arrays["top_points_0"].astype(int), arrays["top_points_1"].astype(int)],
+            "top_distances": [arrays["top_distances_0"], arrays["top_distances_1"]],
+        }
+    return {
+        "endpoints": np.array(document["endpoints"], dtype=int),
+        "labels": np.array(document["labels"], dtype=int),
+        "centroids": np.array(document["centroids"], dtype=float),
+        "top_points": [np.array(p, dtype=int) for p in document["top_points"]],
+        "top_distances": [np.array(d, dtype=float) for d in document["top_distances"]],
+    }
+
+
+def main(image, calibration_factor):
+    """
+    Main function to execute the fiber length estimation algorithm.
+    A filename is read from the uploads folder; bytes or arrays are used as is.
+    """
+    if isinstance(image, str):
+        image = f"uploads/{image}"
+    img, analysis = analyze(image)
+
     # Visualization
-    return visualize_results(
-        img, centroids, refined_cluster_1, refined_cluster_2, msfl, mean_length
-    ), msfl, msfl + 2, mean_length
+    return render(img, analysis, calibration_factor)
@@ -0,0 +1,96 @@
+"""
+Per-fiber data of analyses, stored and exported as raw binary arrays.
+
+Every analysis stores its arrays in its document of the analyses collection:
+the lengths of its fibers (for v3, the distances of the endpoints from the
+perpendicular bisector of the centroids, in pixels), and for v3 the
+endpoints, their labels, the centroids and the top endpoints of each cluster
+with their distances. Each array is one BSON binary field of its raw
+little-endian bytes, with its dtype and the shape of its items fixed here by
+its name, a few bytes of overhead instead of a BSON element per number.
+
+The export streams many analyses as frames: the length of a JSON header as 4
+bytes (big-endian), the header, with the name, dtype and shape of the
+arrays of the frame in its "arrays", then the bytes of these arrays one
+after another. read_frames reads them back.
+"""
+import json
+import struct
+
+import numpy as np
+
+# name -> dtype and shape of the items of the arrays of an analysis
+ARRAYS = {
+    "lengths": ("<f4", ()),
+    "endpoints": ("<i4", (2,)),
+    "labels": ("u1", ()),
+    "centroids": ("<f8", (2,)),
+    "top_points_0": ("<i4", (2,)),
+    "top_points_1": ("<i4", (2,)),
+    "top_distances_0": ("<f8", ()),
+    "top_distances_1": ("<f8", ()),
+}
+
+MIMETYPE = "application/octet-stream"
+
+_LENGTH = struct.Struct(">I")
+
+
+def to_binary(arrays):
+    """The bytes of each array, with the dtype of its name"""
+    binary = {}
+    for name, values in arrays.items():
+        dtype, shape = ARRAYS[name]
+        values = np.asarray(values, dtype=dtype)
+        if values.shape[1:] != shape:
+            values = values.reshape((-1,) + shape)
+        binary[name] = values.tobytes()
+    return binary
+
+
+def from_binary(binary):
+    """Inverse of to_binary, arrays reading the stored bytes without a copy"""
+    arrays = {}
+    for name, data in binary.items():
+        dtype, shape = ARRAYS[name]
+        arrays[name] = np.frombuffer(data, dtype=dtype).reshape((-1,) + shape)
+    return arrays
+
+
+def _shape(name, data):
+    dtype, shape = ARRAYS[name]
+    return [len(data) // (np.dtype(dtype).itemsize * int(np.prod(shape))), *shape]
+
+
+def frame(header, binary):
+    """One frame of an export: a header dict and the bytes of to_binary"""
+    header = dict(
+        header, arrays=[[name, ARRAYS[name][0], _shape(name, data)] for name, data in binary.items()]
+    )
+    encoded = json.dumps(header, default=str).encode("utf-8")
+    return b"".join([_LENGTH.pack(len(encoded)), encoded, *binary.values()])
+
+
+def read_frames(stream):
+    """(header, arrays) of every frame of an export read from a file object"""
+    while True:
+        prefix = stream.read(_LENGTH.size)
+        if not prefix:
+            return
+        prefix += _read(stream, _LENGTH.size - len(prefix))
+        header = json.loads(_read(stream, _LENGTH.unpack(prefix)[0]))
+        arrays = {}
+        for name, dtype, shape in header.pop("arrays"):
+            data = _read(stream, np.dtype(dtype).itemsize * int(np.prod(shape)))
+            arrays[name] = np.frombuffer(data, dtype=dtype).reshape(shape)
+        yield header, arrays
+
+
+def _read(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("Truncated export")
+        data += chunk
+    return data
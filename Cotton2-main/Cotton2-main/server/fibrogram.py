@@ -0,0 +1,127 @@
+"""
+Fibrograms of the stored fiber lengths, and their span lengths, uniformity
+ratio and short fiber content.
+
+v1 and v2 measure whole fibers: the fibrogram of their lengths is the one of
+a beard catching them at random points, the fraction of the length of the
+fibers extending x beyond the clamp, G(x) = sum((l - x) for l > x) / sum(l).
+v3 measures the distance of every fiber end from the perpendicular bisector
+of its beard, which is the clamp line: its fibrogram is the fraction of the
+ends at least x from it. The p% span length is where the fibrogram falls to
+p%, the uniformity ratio is the 50% span length over the 2.5% one, and the
+short fiber content is the percentage of fibers shorter than 12.7 mm; it
+needs whole fibers, so v3 has none.
+
+Lengths are in mm (pixels times the calibration factor) and counted in a
+histogram of BIN mm bins, kept as a {bin: count} dict where only the bins of
+measured lengths appear. A rollup document holds the histogram of the tests
+of a user that share a lot_number and kind, updated with $inc as analyses
+are stored, so the metrics of a lot are computed from one document whatever
+its number of tests.
+"""
+import numpy as np
+
+# width of the bins of the histograms, in mm
+BIN = 0.1
+
+# fibers shorter than this are short fibers, in mm (half an inch)
+SHORT_FIBER = 12.7
+
+# kind of the lengths of each API version
+KINDS = {"v1": "length", "v2": "length", "v3": "span"}
+
+# fields a rollup is keyed by
+KEYS = ("user_id", "lot_number", "kind")
+
+
+def histogram(lengths, calibration_factor=1.0):
+    """Bins and counts of lengths in pixels, for a calibration factor in mm per pixel"""
+    lengths = np.asarray(lengths, dtype=float) * calibration_factor
+    bins = np.floor(lengths[np.isfinite(lengths)] / BIN).astype(np.int64)
+    return np.unique(bins, return_counts=True)
+
+
+def to_hist(bins, counts):
+    """{bin: count} dict of a histogram, with str keys as stored in MongoDB"""
+    return {str(b): int(n) for b, n in zip(bins, counts)}
+
+
+def from_hist(hist):
+    """Sorted bins and counts of a {bin: count} dict"""
+    bins = np.fromiter((int(b) for b in hist), np.int64, len(hist))
+    counts = np.fromiter(hist.values(), np.int64, len(hist))
+    order = np.argsort(bins)
+    return bins[order], counts[order]
+
+
+def rollup_key(analysis):
+    """Key of the rollup of a document of the analyses collection"""
+    return {
+        "user_id": analysis["user_id"],
+        "lot_number": analysis.get("lot_number"),
+        "kind": KINDS[analysis["version"]],
+    }
+
+
+def rollup_update(bins, counts, tests=1):
+    """Update of a rollup adding a histogram of tests tests"""
+    inc = {"tests": tests, "fibers": int(np.sum(counts))}
+    for b, n in zip(bins, counts):
+        inc[f"hist.{b}"] = int(n)
+    return {"$inc": inc}
+
+
+def fibrogram(bins, counts, kind):
+    """
+    The fibrogram of a histogram as points (x in mm, fraction), decreasing
+    from 1 at 0 to 0, linear between them.
+    """
+    counts = counts.astype(float)
+    # number of lengths in every bin and the bins after it
+    after = np.cumsum(counts[::-1])[::-1]
+
+    if kind == "span":
+        # ends spread evenly within their bin
+        lower, upper = bins * BIN, (bins + 1) * BIN
+        x = np.stack([lower, upper], axis=1).ravel()
+        g = np.stack([after, np.append(after[1:], 0.0)], axis=1).ravel() / after[0]
+    else:
+        # lengths at the center of their bin
+        centers = (bins + 0.5) * BIN
+        length_after = np.cumsum((centers * counts)[::-1])[::-1]
+        x = centers
+        g = (length_after - centers * after) / length_after[0]
+
+    if x[0] > 0:
+        x, g = np.append(0.0, x), np.append(1.0, g)
+    return x, g
+
+
+def span_length(x, g, percent):
+    """Where a fibrogram falls to percent %, interpolated linearly"""
+    level = percent / 100
+    j = int(np.argmax(g <= level))
+    if j == 0:
+        return float(x[0])
+    return float(x[j - 1] + (g[j - 1] - level) * (x[j] - x[j - 1]) / (g[j - 1] - g[j]))
+
+
+def metrics(bins, counts, kind):
+    """Span lengths, uniformity ratio and short fiber content of a histogram"""
+    fibers = int(np.sum(counts))
+    if fibers == 0:
+        return {"fibers": 0}
+
+    x, g = fibrogram(bins, counts, kind)
+    span_2_5 = span_length(x, g, 2.5)
+    span_50 = span_length(x, g, 50)
+    short = None
+    if kind == "length":
+        short = 100 * float(counts[(bins + 0.5) * BIN < SHORT_FIBER].sum()) / fibers
+    return {
+        "fibers": fibers,
+        "span_length_2_5": span_2_5,
+        "span_length_50": span_50,
+        "uniformity_ratio": 100 * span_50 / span_2_5 if span_2_5 > 0 else None,
+        "short_fiber_content": short,
+    }
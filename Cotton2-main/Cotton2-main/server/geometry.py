@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def pack_paths(paths):
+    """
+    Concatenate paths into one (n, 2) coordinate array.
+    Path i is coords[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(paths) + 1, dtype=np.intp)
+    np.cumsum([len(p) for p in paths], out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.empty((0, 2)), offsets
+    coords = np.concatenate([np.asarray(p).reshape(-1, 2) for p in paths])
+    return coords, offsets
+
+
+def polyline_lengths(coords, offsets):
+    """
+    Length of every path packed by pack_paths, computed in one pass:
+    one diff/hypot over all consecutive points, then a reduceat per path.
+    """
+    lengths = np.zeros(len(offsets) - 1)
+    if len(coords) < 2:
+        return lengths
+
+    steps = np.hypot(*np.diff(coords, axis=0).T)
+
+    # steps from the last point of one path to the first point of the next
+    boundaries = offsets[1:-1]
+    boundaries = boundaries[(boundaries > 0) & (boundaries < len(coords))]
+    steps[boundaries - 1] = 0
+
+    # paths with less than two points have no length and would confuse reduceat
+    measured = np.diff(offsets) > 1
+    if measured.any():
+        lengths[measured] = np.add.reduceat(steps, offsets[:-1][measured])
+    return lengths
+
+
+def path_lengths(paths):
+    """Length of every path in a list of coordinate arrays"""
+    return polyline_lengths(*pack_paths(paths))
+
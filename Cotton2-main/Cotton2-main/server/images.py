@@ -0,0 +1,22 @@
+import cv2 as cv
+import numpy as np
+
+
+def read_image(source, flags=cv.IMREAD_COLOR):
+    """
+    Load an image from a file path, from encoded bytes (e.g. an upload) or
+    pass through an already decoded array.
+    """
+    if isinstance(source, np.ndarray):
+        if flags == cv.IMREAD_GRAYSCALE and source.ndim == 3:
+            return cv.cvtColor(source, cv.COLOR_BGR2GRAY)
+        return source
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        img = cv.imdecode(np.frombuffer(source, np.uint8), flags)
+    else:
+        img = cv.imread(str(source), flags)
+
+    if img is None:
+        raise ValueError("Could not read image")
+    return img
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at its depth limit."""
+
+
+class JobQueue:
+    """
+    Bounded queue of analysis jobs.
+
+    Jobs run on a process pool so a slow image does not hold a request thread
+    and the skimage/skan work of concurrent uploads is not serialized by the GIL.
+    With workers=0 jobs run on a single in-process thread instead, which is
+    what tests and small deployments should use.
+
+    At most max_pending jobs can be queued or running; submit raises QueueFull
+    beyond that, and so does reserve for work that holds some of them.
+    on_done runs on a thread of the queue, one job after another, so slow
+    stores do not hold the thread that hands the executor's results back.
+
+    Jobs live in the memory of the process that submitted them: their status
+    can only be fetched from that process, so a server answering /api/jobs
+    must run as a single process (threads are fine). Finished jobs are kept
+    for ttl seconds so clients can fetch their result.
+
+    initializer() runs in every worker when it starts; start() starts the
+    workers right away instead of with the first jobs.
+    """
+
+    def __init__(self, workers=None, max_pending=32, ttl=600, executor=None, initializer=None):
+        if executor is None:
+            if workers == 0:
+                executor = ThreadPoolExecutor(max_workers=1, initializer=initializer)
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer)
+        self.executor = executor
+        self.workers = 1 if workers == 0 else workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs-done")
+
+    def submit(self, owner, fn, *args, on_done=None):
+        """
+        Queue fn(*args) and return the job id.
+        on_done(result) is called in this process when the job succeeds, on
+        the thread of the queue.
+        """
+        with self.lock:
+            self._prune()
+            if self.pending >= self.max_pending:
+                raise QueueFull(f"{self.pending} jobs pending")
+            self.pending += 1
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "id": job_id,
+                "owner": owner,
+                "status": "queued",
+                "result": None,
+                "error": None,
+                "finished": None,
+                "future": None,
+            }
+            self.jobs[job_id] = job
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+                del self.jobs[job_id]
+            raise
+
+        job["future"] = future
+        future.add_done_callback(lambda f: self.finisher.submit(self._finish, job, f, on_done))
+        return job_id
+
+    def reserve(self, n):
+        """
+        Hold n of the max_pending slots for analyses submitted to the executor
+        directly, as a batch does, until release(n). Raises QueueFull if fewer
+        are free.
+        """
+        with self.lock:
+            self._prune()
+            if self.pending + n > self.max_pending:
+                raise QueueFull(f"{self.pending} jobs pending")
+            self.pending += n
+        return n
+
+    def release(self, n):
+        with self.lock:
+            self.pending -= n
+
+    def start(self):
+        """Start every worker now, so they are initialized before the first job"""
+        for _ in range(self.workers):
+            self.executor.submit(int)
+
+    def get(self, job_id):
+        """Return a snapshot of the job, or None if it is unknown or expired."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = job["status"]
+            if status == "queued" and job["future"] is not None and job["future"].running():
+                status = "running"
+            return {
+                "id": job["id"],
+                "owner": job["owner"],
+                "status": status,
+                "result": job["result"],
+                "error": job["error"],
+            }
+
+    def _finish(self, job, future, on_done):
+        try:
+            result = future.result()
+        except Exception as e:
+            status, result, error = "failed", None, str(e)
+        else:
+            status, error = "done", None
+            if on_done is not None:
+                try:
+                    on_done(result)
+                except Exception as e:
+                    status, error = "failed", f"Error storing result: {e}"
+
+        with self.lock:
+            job["status"] = status
+            job["result"] = result
+            job["error"] = error
+            job["finished"] = time.monotonic()
+            job["future"] = None
+            self.pending -= 1
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job["finished"] is not None and now - job["finished"] > self.ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
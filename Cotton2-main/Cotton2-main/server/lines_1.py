@@ -1,19 +1,30 @@
 from plantcv import plantcv as pcv
-import matplotlib.pyplot as plt
 import cv2 as cv
 
+from pipeline import SKELETON_HALO, as_pipeline, stage
 
-# define a custom class to read filename from cv.imread
-class MyImage:
-    def __init__(self, img_name):
-        self.img = cv.imread(img_name, cv.IMREAD_GRAYSCALE)
-        self.__name = img_name
 
-    def __str__(self):
-        return self.__name
+@stage("pcv_skeletonize", halo=SKELETON_HALO)
+def pcv_skeletonize(img):
+    # pcv skeletonize returns 0 and 1 img / skimage skel returns True and False values
+    return pcv.morphology.skeletonize(img)
 
 
-def scale_calibration(img):
+MEASURE = (
+    ("decode", {"flags": cv.IMREAD_GRAYSCALE}),
+    # invert background to get white pixels on black background
+    ("invert", {}),
+    # dilate then erode to connect disconnected pixels
+    ("dilate", {}),
+    ("erode", {}),
+    # threshold and binarize img in one step, transforming pixel values to 0s and 1s
+    ("threshold", {"thresh": 100, "maxval": 1}),
+    # skeletonize img
+    ("pcv_skeletonize", {}),
+)
+
+
+def scale_calibration(img, plot=False):
     # read img
     scale = cv.imread(img, cv.IMREAD_GRAYSCALE)
     # invert background
@@ -25,85 +36,65 @@ def scale_calibration(img):
     # define calibration (known distance / distance in pixels of scale)
     calibration = 0.5 / w
     # plot bounding rectangle to debug
-    plt.imshow(cv.rectangle(scale, cv.boundingRect(scale_bin), (255, 255, 0), 2))
+    if plot is True:
+        import matplotlib.pyplot as plt
+
+        plt.imshow(cv.rectangle(scale, (x, y, w, h), (255, 255, 0), 2))
 
     return calibration
 
 
-def fiber_length_1(img, calibration, plot=True):
+def fiber_length_1(img, calibration, plot=False, image=None):
 
-    # read img
-    fiber = MyImage(img)
+    # read img, from memory if the image is given, possibly shared with other methods
+    pipeline = as_pipeline(img if image is None else image)
 
     # store filename
     filename = str(img)
 
-    # invert background to get white pixels on black background
-    fiber = 255 - fiber.img
+    fiber_skel = pipeline.run(MEASURE)
 
-    # dilate then erode to connect disconnected pixels
-    fiber = cv.dilate(fiber, None, iterations=1)
-    fiber = cv.erode(fiber, None, iterations=1)
+    with pipeline.timer("contours"):
+        # get contours
+        contours, hierarchy = cv.findContours(
+            fiber_skel, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+        )
 
-    # threshold image
-    _, fiber_bin = cv.threshold(fiber, 100, 255, cv.THRESH_BINARY)
+        # get only contours of fibers (which usually will be greater than 200)
+        perimeters = [cv.arcLength(c, False) for c in contours]
 
-    # binarize img transforming pixel values to 0s and 1s
-    height, width = fiber_bin.shape
-    for i in range(height):
-        for j in range(width):
-            fiber_bin[i][j] = 1 if fiber_bin[i][j] == 255 else 0
+        # get contour perimeter, divide it by 2 and multiply by calibration factor
+        measurement = [float(p / 2) * calibration for p in perimeters if p > 200]
 
-    # skeletonize img
-    fiber_skel = pcv.morphology.skeletonize(
-        fiber_bin
-    )  # pcv skeletonize returns 0 and 1 img / skimage skel returns True and False values
-
-    # get contours
-    contours, hierarchy = cv.findContours(
-        fiber_skel, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
-    )
-
-    # get only contours of fibers (which usually will be greater than 200)
-    fiber_contours = [c for c in contours if cv.arcLength(c, False) > 200]
-
-    # initialize lists to store variables
-    measurement = []
-    label_coord_x = []
-    label_coord_y = []
-
-    # get contour perimeter, divide it by 2 and multiply by calibration factor
-    for i, cnt in enumerate(fiber_contours):
-        measurement.append(
-            float(cv.arcLength(fiber_contours[i], False) / 2) * calibration
-        )
-        # get coordinates if plot is True
-        if plot is True:
-            label_coord_x.append(
-                fiber_contours[i][0][0][0]
-            )  # get first pixel of contours
-            label_coord_y.append(
-                fiber_contours[i][0][0][1]
-            )  # get second pixel of contours
-
-    # plot fiber measurements if plot is True
+    pipeline.count("contours", len(contours))
+    pipeline.count("fibers", len(measurement))
+
+    # plot fiber measurements if plot is True, on the inverted, dilated and eroded img
     if plot is True:
-        fiber_copy = fiber.copy()
-        # loop through measurement values
-        for i, value in enumerate(measurement):
-            text = "{:.2f}".format(value)
-            x = label_coord_x[i]
-            y = label_coord_y[i]
-            # put measurement labels in image
-            cv.putText(
-                fiber_copy,
-                text=text,
-                org=(x, y),
-                fontFace=cv.FONT_HERSHEY_SIMPLEX,
-                fontScale=1,
-                color=(150, 150, 150),
-                thickness=2,
-            )
-        plt.imshow(fiber_copy)
+        fiber_contours = [c for c, p in zip(contours, perimeters) if p > 200]
+        plot_measurements(pipeline.run(MEASURE[:4]), fiber_contours, measurement)
 
     return [filename, measurement]
+
+
+def plot_measurements(fiber, contours, measurement):
+    # imported here, the analyses do not plot
+    import matplotlib.pyplot as plt
+
+    fiber_copy = fiber.copy()
+    # loop through measurement values
+    for cnt, value in zip(contours, measurement):
+        text = "{:.2f}".format(value)
+        # label at the first pixel of the contour
+        x, y = cnt[0][0]
+        # put measurement labels in image
+        cv.putText(
+            fiber_copy,
+            text=text,
+            org=(int(x), int(y)),
+            fontFace=cv.FONT_HERSHEY_SIMPLEX,
+            fontScale=1,
+            color=(150, 150, 150),
+            thickness=2,
+        )
+    plt.imshow(fiber_copy)
@@ -0,0 +1,270 @@
+import time
+from contextlib import contextmanager
+
+import cv2 as cv
+import numpy as np
+from skan import Skeleton
+from skimage import morphology
+
+from images import read_image
+
+# name -> function(image, **params) of every preprocessing stage
+STAGES = {}
+
+# name -> pixels around a tile that a stage reads, as a number or a function
+# of the stage params; None if the stage needs the whole image
+HALOS = {}
+
+# skeletonization thins objects from their borders, so its result in a tile
+# only depends on objects closer than their thickness
+SKELETON_HALO = 32
+
+
+def stage(name, halo=0):
+    """Register a function as a preprocessing stage"""
+
+    def register(fn):
+        STAGES[name] = fn
+        HALOS[name] = halo
+        return fn
+
+    return register
+
+
+def _uint8(img):
+    # binary masks are passed on as 0/255 images to the OpenCV stages
+    if img.dtype == bool:
+        return img.astype(np.uint8) * 255
+    return img
+
+
+def _kernel(size):
+    # None is OpenCV's default 3x3 kernel
+    return None if size is None else np.ones((size, size), np.uint8)
+
+
+@stage("gray")
+def gray(img):
+    return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+
+@stage("invert")
+def invert(img):
+    return 255 - img
+
+
+@stage("invert_bright", halo=None)
+def invert_bright(img, threshold=128):
+    """Invert the image if Otsu's threshold says its background is white"""
+    _, otsu_thresh = cv.threshold(img, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    if np.mean(otsu_thresh) >= threshold:
+        return 255 - img
+    return img
+
+
+@stage("dilate", halo=lambda kernel=None, iterations=1: (kernel or 3) * iterations)
+def dilate(img, kernel=None, iterations=1):
+    return cv.dilate(_uint8(img), _kernel(kernel), iterations=iterations)
+
+
+@stage("erode", halo=lambda kernel=None, iterations=1: (kernel or 3) * iterations)
+def erode(img, kernel=None, iterations=1):
+    return cv.erode(_uint8(img), _kernel(kernel), iterations=iterations)
+
+
+@stage("close", halo=lambda kernel=3: 2 * kernel)
+def close(img, kernel=3):
+    return cv.morphologyEx(_uint8(img), cv.MORPH_CLOSE, _kernel(kernel))
+
+
+@stage("threshold")
+def threshold(img, thresh, maxval=255):
+    _, binary = cv.threshold(img, thresh, maxval, cv.THRESH_BINARY)
+    return binary
+
+
+@stage("adaptive_threshold", halo=lambda block_size, c: block_size // 2 + 1)
+def adaptive_threshold(img, block_size, c):
+    return cv.adaptiveThreshold(
+        img, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, block_size, c
+    )
+
+
+@stage("pyr_down", halo=None)
+def pyr_down(img, levels=1):
+    """Level of the Gaussian pyramid of the image, halved levels times"""
+    for _ in range(levels):
+        img = cv.pyrDown(_uint8(img))
+    return img
+
+
+@stage("remove_small_objects", halo=None)
+def remove_small_objects(img, min_size):
+    return morphology.remove_small_objects(img.astype(bool), min_size, connectivity=2)
+
+
+@stage("skeletonize", halo=SKELETON_HALO)
+def skeletonize(img, method="lee"):
+    return morphology.skeletonize(img.astype(bool), method=method)
+
+
+# stages that thin objects to lines one pixel wide
+THINNING = ("skeletonize", "pcv_skeletonize")
+
+
+def downsample(steps, levels):
+    """
+    The chain of stages for the image downsampled by levels of its Gaussian
+    pyramid: a pyr_down step after decode, and the sizes in pixels of the
+    stages scaled to match. Kernels and blocks scale with the side of the
+    image; the minimum size of objects with their area, or with their
+    length once they are thinned to lines.
+    """
+    if not levels:
+        return steps
+    scale = 0.5**levels
+    scaled = [steps[0], ("pyr_down", {"levels": levels})]
+    thin = False
+    for name, params in steps[1:]:
+        params = dict(params)
+        if params.get("kernel"):
+            params["kernel"] = max(1, round(params["kernel"] * scale))
+        if "block_size" in params:
+            params["block_size"] = max(3, round(params["block_size"] * scale) | 1)
+        if "min_size" in params:
+            area = scale if thin else scale * scale
+            params["min_size"] = max(1, round(params["min_size"] * area))
+        thin = thin or name in THINNING
+        scaled.append((name, params))
+    return tuple(scaled)
+
+
+def _key(steps):
+    # steps are (name, params) pairs; params are made hashable to key the cache
+    return tuple((name, tuple(sorted(params.items()))) for name, params in steps)
+
+
+class ImagePipeline:
+    """
+    Preprocessing of one image, shared by the analysis methods.
+
+    A chain of stages is given as (name, params) pairs and starts with a
+    ("decode", {...}) step reading the source image. The result of every
+    chain that is run is kept, and so are the prefixes given to keep(), so a
+    chain that starts with one of them only computes its remaining stages,
+    and running a chain again, or building a skan Skeleton of the same
+    skeleton, costs nothing. The other intermediates are dropped once the
+    next stage has run, so a long chain does not hold every one of them.
+    The time spent in each stage is summed in timings; the methods add their
+    own steps with timer() and record their counts (endpoints, paths, ...)
+    in stats with count().
+
+    With a tile size, chains run tile by tile (see tiling.py) and only their
+    final result is kept, so large images do not need every intermediate at
+    full size. The source is decoded once and its tiles are read from that.
+    A chain run with whole=True is computed on the whole image anyway, for
+    chains whose objects are too large for a tile (see SKELETON_HALO).
+    """
+
+    def __init__(self, source, tile=None, workdir=None):
+        self.source = source
+        self.tile = tile
+        self.workdir = workdir
+        self.results = {}
+        self.rasters = {}
+        self.shared = set()
+        self.skeletons = {}
+        self.timings = {}
+        self.stats = {}
+
+    def keep(self, steps):
+        """Keep the result of a prefix of the chains to run, for later chains"""
+        self.shared.add(_key(steps))
+
+    def run(self, steps, whole=False):
+        """Result of the chain of stages, reusing the longest kept prefix"""
+        key = _key(steps)
+        if self.tile and not whole:
+            if key not in self.results:
+                self.results[key] = self._run_tiled(steps)
+            return self.results[key]
+
+        done = len(key)
+        while done > 0 and key[:done] not in self.results:
+            done -= 1
+
+        img = self.results[key[:done]] if done else None
+        for i in range(done, len(key)):
+            name, params = steps[i]
+            start = time.perf_counter()
+            if name == "decode":
+                if self.tile:
+                    # the source as decoded for the tiled chains
+                    img = self._raster(params).read()
+                else:
+                    img = read_image(self.source, **params)
+                self.stats["height"], self.stats["width"] = img.shape[:2]
+            else:
+                img = STAGES[name](img, **params)
+            self._time(name, start)
+            if i + 1 == len(key) or key[: i + 1] in self.shared:
+                self.results[key[: i + 1]] = img
+        return img
+
+    def skeleton(self, steps, source_image=None, whole=False):
+        """skan Skeleton of the result of steps, built once per chain"""
+        key = (_key(steps), None if source_image is None else _key(source_image))
+        if key not in self.skeletons:
+            skeleton = self.run(steps, whole)
+            image = None if source_image is None else self.run(source_image, whole)
+            start = time.perf_counter()
+            self.skeletons[key] = Skeleton(skeleton, source_image=image)
+            self._time("skan", start)
+        return self.skeletons[key]
+
+    def _raster(self, params):
+        # the source opened once per decode params, encoded images decoded once
+        key = _key([("decode", params)])
+        if key not in self.rasters:
+            # imported here, tiling uses the stages registered in this module
+            from tiling import open_raster
+
+            self.rasters[key] = open_raster(self.source, **params)
+        return self.rasters[key]
+
+    def _run_tiled(self, steps):
+        from tiling import run_tiled
+
+        (name, params), steps = steps[0], steps[1:]
+        if name != "decode":
+            raise ValueError("A chain of stages starts with decode")
+        with self.timer("decode"):
+            raster = self._raster(params)
+        if steps:
+            img = run_tiled(raster, steps, self.tile, self.timings, self.workdir)
+        else:
+            img = raster.read()
+        self.stats["height"], self.stats["width"] = img.shape[:2]
+        return img
+
+    @contextmanager
+    def timer(self, name):
+        """Add the time spent in the block to timings[name]"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._time(name, start)
+
+    def count(self, name, value):
+        self.stats[name] = value
+
+    def _time(self, name, start):
+        self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def as_pipeline(image, tile=None):
+    """The pipeline of an image given as a path, bytes, array or pipeline"""
+    if isinstance(image, ImagePipeline):
+        return image
+    return ImagePipeline(image, tile=tile)
@@ -0,0 +1,89 @@
+"""
+Encoding of the result images sent to clients.
+
+A request chooses the format of its image (PNG, JPEG or WebP), the
+image_quality of lossy formats and a maximum dimension; format=json asks
+for the numbers only, and nothing is rendered. Overlays are drawn with
+OpenCV on an image already scaled down to the requested size, so a small
+preview of a large scan neither copies nor encodes the full resolution.
+"""
+import cv2 as cv
+
+# format -> (extension given to cv.imencode, mimetype)
+FORMATS = {
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+}
+ALIASES = {"jpg": "jpeg"}
+
+# format of the requests that only want numbers, nothing is rendered
+NUMBERS = "json"
+
+QUALITY_FLAGS = {
+    "jpeg": cv.IMWRITE_JPEG_QUALITY,
+    "webp": cv.IMWRITE_WEBP_QUALITY,
+}
+
+# extension of the filename an image is sent with, by mimetype
+EXTENSIONS = {mimetype: extension for extension, mimetype in FORMATS.values()}
+
+
+def _positive_int(values, name, high=None):
+    value = values.get(name)
+    if value in (None, ""):
+        return None
+    value = int(value)
+    if value < 1 or (high is not None and value > high):
+        raise ValueError(f"{name} must be between 1 and {high}" if high else f"{name} must be positive")
+    return value
+
+
+def options(values):
+    """
+    Rendering options of a request, from its form or query values: format,
+    image_quality (1-100, JPEG and WebP only) and max_dim. Returns None for
+    format=json. Raises ValueError for an unknown format or invalid values.
+    """
+    format = values.get("format") or "png"
+    format = ALIASES.get(format.lower(), format.lower())
+    if format == NUMBERS:
+        return None
+    if format not in FORMATS:
+        raise ValueError(
+            f"Unknown format {format}, expected one of {', '.join((*FORMATS, NUMBERS))}"
+        )
+    return {
+        "format": format,
+        "quality": _positive_int(values, "image_quality", 100),
+        "max_dim": _positive_int(values, "max_dim"),
+    }
+
+
+def downscale(img, max_dim=None):
+    """
+    The image scaled down so its largest side is at most max_dim, along with
+    the scale. The image itself is returned, with scale 1, if it is small
+    enough already.
+    """
+    height, width = img.shape[:2]
+    if not max_dim or max(height, width) <= max_dim:
+        return img, 1.0
+    scale = max_dim / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv.resize(img, size, interpolation=cv.INTER_AREA), scale
+
+
+def encode(img, format="png", quality=None):
+    """
+    Encode an image. Returns the encoded bytes, which are sent as the body of
+    a response as they are, and their mimetype.
+    """
+    extension, mimetype = FORMATS[format]
+    params = []
+    if quality is not None and format in QUALITY_FLAGS:
+        params = [QUALITY_FLAGS[format], int(quality)]
+    ok, encoded = cv.imencode(extension, img, params)
+    if not ok:
+        raise ValueError(f"Could not encode the image as {format}")
+    return encoded.tobytes(), mimetype
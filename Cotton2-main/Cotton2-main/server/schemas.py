@@ -6,6 +6,11 @@ class ImageDetails(BaseModel):
     lot_number: int | None = None
     
 class Results(BaseModel):
-    msfl: int | None = None
-    ifl: int | None = None
-    ml: int | None = None
\ No newline at end of file
+    msfl: float | None = None
+    ifl: float | None = None
+    ml: float | None = None
+
+
+def image_details(data):
+    """ImageDetails of form fields, the empty ones left unset"""
+    return ImageDetails(**{key: value for key, value in data.items() if value != ""})
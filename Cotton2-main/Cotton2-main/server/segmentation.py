@@ -1,8 +1,10 @@
 import numpy as np
-import cv2 as cv
-from skan import Skeleton
-from skimage import graph, morphology
-from scipy.spatial.distance import euclidean
+from skimage import graph
+from scipy.spatial import cKDTree
+
+from geometry import path_lengths
+from pipeline import as_pipeline, downsample
+from topology import long_paths, path_coordinates
 
 MAX_JUNCTION = 10  # maximal size of junctions
 MAX_ANGLE = 80  # maximal angle in junction
@@ -20,99 +22,197 @@ def angle(v1, v2):
 
 def calculate_path_length(path):
     """Calculate the length of a path given its coordinates"""
-    length = 0
-    for i in range(1, len(path)):
-        length += euclidean(path[i - 1], path[i])
-    return length
+    return path_lengths([path])[0]
+
+
+class PathMerger:
+    """
+    Disjoint-set of paths that merges fibers across junctions.
+
+    Every set keeps its pieces (paths and junction segments) as a linked list in
+    merge order, so a merge is O(1) and the coordinates of each fiber are only
+    concatenated once, in fibers(). The merges are recorded as
+    (path 1, path 2, junction segment) in the order they were made.
+    """
+
+    def __init__(self, paths):
+        n = len(paths)
+        self.pieces = list(paths)  # paths first, then junction segments
+        self.parent = list(range(n))
+        self.head = list(range(n))
+        self.tail = list(range(n))
+        self.next = [-1] * n
+        self.closed = [False] * n
+        self.merges = []
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:  # path compression
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def merge(self, p1, p2, junction):
+        """Append path 2 and the junction to path 1"""
+        r1, r2 = self.find(p1), self.find(p2)
+        j = len(self.pieces)
+        self.pieces.append(junction)
+        self.next.append(-1)
+        self.merges.append((r1, r2, j))
+
+        if r1 == r2:
+            # both ends of one fiber meet at a junction: the loop is dropped
+            self.closed[r1] = True
+            return
+
+        self.next[self.tail[r1]] = self.head[r2]
+        self.next[self.tail[r2]] = j
+        self.tail[r1] = j
+        self.parent[r2] = r1
+
+    def fibers(self):
+        """Coordinates of every merged fiber as an (n, 2) int array"""
+        fibers = []
+        for root in range(len(self.parent)):
+            if self.parent[root] != root or self.closed[root]:
+                continue
+            pieces = []
+            piece = self.head[root]
+            while piece != -1:
+                pieces.append(np.asarray(self.pieces[piece], dtype=int).reshape(-1, 2))
+                piece = self.next[piece]
+            fibers.append(np.concatenate(pieces))
+        return fibers
+
+
+def find_junctions(endpoints, skeleton, max_junction=MAX_JUNCTION):
+    """
+    Find pairs of endpoints of distinct paths that meet at a junction.
+    Returns (deg, i1, i2, junction) tuples sorted by deviation of angle.
+
+    Every step of a route costs at least 1, so two endpoints can only be joined
+    within max_junction if they are at most max_junction pixels apart (Chebyshev
+    distance) and the whole route stays inside a max_junction window around
+    both of them. Candidate pairs come from a KD-tree and each route is searched
+    on that window only, instead of the full image for every pair.
+    """
+    if not endpoints:
+        return []
+
+    points = np.array([e[0] for e in endpoints])
+    tree = cKDTree(points)
+    pairs = sorted(tree.query_pairs(max_junction, p=np.inf))
+
+    height, width = skeleton.shape
+    angles = []
+    for i1, i2 in pairs:
+        e1, d1, p1 = endpoints[i1]
+        e2, d2, p2 = endpoints[i2]
+        if p1 == p2:
+            continue
+
+        deg = angle(d1, d2)  # get deviation of directions at junction
+        if deg > MAX_ANGLE:
+            continue
+
+        # window that contains every route of cost <= max_junction
+        y0 = max(max(e1[0], e2[0]) - max_junction, 0)
+        x0 = max(max(e1[1], e2[1]) - max_junction, 0)
+        y1 = min(min(e1[0], e2[0]) + max_junction + 1, height)
+        x1 = min(min(e1[1], e2[1]) + max_junction + 1, width)
+        costs = np.where(skeleton[y0:y1, x0:x1], 1, 255)
+
+        p, c = graph.route_through_array(
+            costs, (e1[0] - y0, e1[1] - x0), (e2[0] - y0, e2[1] - x0)
+        )  # check connectivity of endpoints at junction
+        if c <= max_junction:
+            angles.append((deg, i1, i2, [(y + y0, x + x0) for y, x in p]))
+
+    # least deviation of angle first
+    angles.sort(key=lambda a: a[0])
+    return angles
+
+
+# Threshold the image and reduce the threads to a one pixel wide skeleton
+SKELETONIZE = (
+    ("decode", {}),
+    ("gray", {}),
+    # invert the grayscale image if needed
+    ("invert_bright", {"threshold": BRIGHTNESS_THRESHOLD}),
+    # dilate and apply adaptive thresholding to handle non-uniform lighting
+    ("dilate", {"kernel": 2}),
+    ("adaptive_threshold", {"block_size": 11, "c": -2}),
+    ("remove_small_objects", {"min_size": 200}),
+    ("dilate", {"kernel": 2, "iterations": 3}),
+    ("skeletonize", {}),
+    ("remove_small_objects", {"min_size": 200}),
+    # closing
+    ("close", {"kernel": 3}),
+    ("close", {"kernel": 3}),
+    ("close", {"kernel": 3}),
+    ("remove_small_objects", {"min_size": 200}),
+)
+
+
+def skeletonize_threads(image):
+    """Threshold the image and reduce the threads to a one pixel wide skeleton"""
+    return as_pipeline(image).run(SKELETONIZE)
+
+
+def find_endpoints(paths, delta=DELTA):
+    """Get endpoints of paths and vector to inner point to estimate direction at endpoint"""
+    return [
+        [p[0], np.subtract(p[0], p[delta]), i] for i, p in enumerate(paths)
+    ] + [[p[-1], np.subtract(p[-1], p[-1 - delta]), i] for i, p in enumerate(paths)]
 
 
-def segment_threads(filename: str):
-    """Segment threads and return their lengths"""
+def segment_threads(filename: str, image=None, levels=0):
+    """
+    Segment threads and return their lengths.
+    The image is read from the uploads folder unless it is given as encoded
+    bytes, a decoded array or an ImagePipeline shared with other methods.
+    With levels, the threads are segmented on the image downsampled by that
+    many levels of its pyramid, with the thresholds in pixels scaled to
+    match, and their lengths are given in pixels of the full image.
+    """
+    scale = 0.5**levels
+    steps = downsample(SKELETONIZE, levels)
+    max_junction = max(2, round(MAX_JUNCTION * scale))
+    delta = max(1, round(DELTA * scale))
+    min_path_length = MIN_PATH_LENGTH * scale
+
     # Load and preprocess image
-    img = cv.imread(f"uploads/{filename}")
-
-    # Convert the image into grayscale
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-    
-    # Invert the grayscale image if needed
-    _, otsu_thresh = cv.threshold(gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
-    if np.mean(otsu_thresh) >= BRIGHTNESS_THRESHOLD:
-        gray = 255 - gray
-    
-    # Dilate and threshold
-    kernel = np.ones((2, 2), np.uint8)
-    dilated = cv.dilate(gray, kernel, iterations=1)
-    
-    # Apply adaptive thresholding to handle non-uniform lighting
-    thresh = cv.adaptiveThreshold(dilated, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 11, -2)
-    thresh = morphology.remove_small_objects(thresh.astype(bool), 200, connectivity=2)
-    thresh = thresh.astype(np.uint8) * 255
-    thresh = cv.dilate(thresh, kernel, iterations=3)
-    
-    # Skeletonize
-    skeleton = morphology.skeletonize(thresh.astype(bool), method="lee")
-    skeleton = morphology.remove_small_objects(skeleton.astype(bool), 200, connectivity=2)
-    skeleton = skeleton.astype(np.uint8) * 255
-    # closing
-    skeleton = cv.morphologyEx(skeleton, cv.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    skeleton = cv.morphologyEx(skeleton, cv.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    skeleton = cv.morphologyEx(skeleton, cv.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    skeleton = morphology.remove_small_objects(skeleton.astype(bool), 200, connectivity=2)
-
-    # Split skeleton into paths, for each path longer than MAX_JUNCTION get list of point coordinates
-    g = Skeleton(skeleton)
-    lengths = np.array(g.path_lengths())
-    paths = [
-        list(np.array(g.path_coordinates(i)).astype(int))
-        for i in range(g.n_paths)
-        if lengths[i] > MAX_JUNCTION
-    ]
-
-    # Get endpoints of path and vector to inner point to estimate direction at endpoint
-    endpoints = [
-        [p[0], np.subtract(p[0], p[DELTA]), i] for i, p in enumerate(paths)
-    ] + [[p[-1], np.subtract(p[-1], p[-1 - DELTA]), i] for i, p in enumerate(paths)]
+    pipeline = as_pipeline(f"uploads/{filename}" if image is None else image)
+    skeleton = pipeline.run(steps)
+
+    # Split skeleton into paths, for each path longer than max_junction get its point coordinates
+    g = pipeline.skeleton(steps)
+    paths = path_coordinates(g, long_paths(g, max_junction))
+
+    endpoints = find_endpoints(paths, delta)
 
     # Get each pair of distinct endpoints with the same junction and calculate deviation of angle
-    angles = []
-    costs = np.where(skeleton, 1, 255)  # cost array for route_through_array
-
-    for i1 in range(len(endpoints)):
-        for i2 in range(i1 + 1, len(endpoints)):
-            e1, d1, p1 = endpoints[i1]
-            e2, d2, p2 = endpoints[i2]
-            if p1 != p2:
-                p, c = graph.route_through_array(
-                    costs, e1, e2
-                )  # check connectivity of endpoints at junction
-                if c <= MAX_JUNCTION:
-                    deg = angle(d1, d2)  # get deviation of directions at junction
-                    if deg <= MAX_ANGLE:
-                        angles.append((deg, i1, i2, p))
+    with pipeline.timer("junctions"):
+        angles = find_junctions(endpoints, skeleton, max_junction)
 
     # Merge paths, with least deviation of angle first
-    angles.sort(key=lambda a: a[0])
+    with pipeline.timer("merge"):
+        merger = PathMerger(paths)
+        active = [True] * len(endpoints)
+        for deg, i1, i2, p in angles:
+            if active[i1] and active[i2]:
+                # merge path 2 into path 1, add junction from route_through_array
+                merger.merge(endpoints[i1][2], endpoints[i2][2], p)
+                active[i1] = active[i2] = False  # disable merged endpoints
+
+        filtered_paths = [p for p in merger.fibers() if len(p) > min_path_length]
+
+    fiber_lengths = (path_lengths(filtered_paths) / scale).tolist()
+
+    pipeline.count("paths", len(paths))
+    pipeline.count("endpoints", len(endpoints))
+    pipeline.count("junctions", len(merger.merges))
+    pipeline.count("fibers", len(fiber_lengths))
 
-    for deg, i1, i2, p in angles:
-        e1, e2 = endpoints[i1], endpoints[i2]
-        if e1 and e2:
-            p1, p2 = e1[2], e2[2]
-            paths[p1] = (
-                paths[p1] + paths[p2] + p
-            )  # merge path 2 into path 1, add junction from route_through_array
-            for i, e in enumerate(
-                endpoints
-            ):  # switch path 2 at other endpoint to new merged path 1
-                if e and e[2] == p2:
-                    endpoints[i][2] = p1
-            paths[p2], endpoints[i1], endpoints[i2] = (
-                [],
-                [],
-                [],
-            )  # disable merged path and endpoints
-
-    filtered_paths = [p for p in paths if len(p) > MIN_PATH_LENGTH]
-
-    path_lengths = [calculate_path_length(path) for path in filtered_paths]
-
-    return [filename, path_lengths]
+    return [filename, fiber_lengths]
@@ -0,0 +1,184 @@
+"""
+Rollups of the stored test results, for statistics per lot, station, cotton
+type and day.
+
+A rollup document holds the tests of a user that share a lot_number,
+station, cotton_type and day: their count and, for each of MSFL, IFL and
+ML, the count, sum, sum of squares, min, max and a histogram of the values.
+The histogram counts the values rounded to bins of BIN, keyed by the index
+of their bin, so percentiles are within BIN / 2 of the exact ones; the count,
+mean, std, min and max are exact. Rollups are updated with $inc, $min and
+$max as tests are stored, and merged into coarser groups when queried, so a
+query reads one document per group and day instead of every test. A rebuild
+replaces them with the rollup() of their tests.
+"""
+import math
+
+METRICS = ("msfl", "ifl", "ml")
+
+# width of the histogram bins, in the unit of the results (mm when calibrated)
+BIN = 0.01
+
+# fields a rollup is keyed by, and that queries can group by
+KEYS = ("user_id", "lot_number", "station", "cotton_type", "day")
+GROUPS = KEYS[1:]
+
+DEFAULT_PERCENTILES = (25, 50, 75)
+
+
+def day(date):
+    """Day of a stored date, str(datetime) in IST"""
+    return date[:10]
+
+
+def rollup_key(detail):
+    return {
+        "user_id": detail["user_id"],
+        "lot_number": detail.get("lot_number"),
+        "station": detail.get("station"),
+        "cotton_type": detail.get("cotton_type"),
+        "day": day(detail["date"]),
+    }
+
+
+def to_bin(value):
+    """Index of the histogram bin of a value, the nearest multiple of BIN"""
+    return round(value / BIN)
+
+
+def rollup_update(detail, count=1):
+    """Update of the rollup of an image details document, for count such tests"""
+    inc = {"count": count}
+    low, high = {}, {}
+    for metric in METRICS:
+        value = detail.get(metric)
+        if value is None:
+            continue
+        inc[f"{metric}.count"] = count
+        inc[f"{metric}.sum"] = value * count
+        inc[f"{metric}.sumsq"] = value * value * count
+        inc[f"{metric}.hist.{to_bin(value)}"] = count
+        low[f"{metric}.min"] = value
+        high[f"{metric}.max"] = value
+
+    update = {"$inc": inc}
+    if low:
+        update["$min"] = low
+        update["$max"] = high
+    return update
+
+
+def rollup(tests):
+    """
+    Fields of the rollup of (detail, count) pairs, count tests with the
+    results of detail each, as rollup_update would have made them.
+    """
+    document = {"count": 0}
+    for detail, count in tests:
+        document["count"] += count
+        for metric in METRICS:
+            value = detail.get(metric)
+            if value is None:
+                continue
+            values = document.setdefault(
+                metric, {"count": 0, "sum": 0, "sumsq": 0, "min": value, "max": value, "hist": {}}
+            )
+            values["count"] += count
+            values["sum"] += value * count
+            values["sumsq"] += value * value * count
+            values["min"] = min(values["min"], value)
+            values["max"] = max(values["max"], value)
+            index = str(to_bin(value))
+            values["hist"][index] = values["hist"].get(index, 0) + count
+    return document
+
+
+def merge(rollups, by):
+    """
+    Merge rollup documents into groups of the fields of by, e.g.
+    ("lot_number", "station"). Returns a list of dicts with those fields,
+    count and the merged metrics.
+    """
+    groups = {}
+    for rollup in rollups:
+        key = tuple(rollup.get(field) for field in by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = dict(zip(by, key), count=0)
+        group["count"] += rollup.get("count", 0)
+
+        for metric in METRICS:
+            values = rollup.get(metric)
+            if not values:
+                continue
+            merged = group.get(metric)
+            if merged is None:
+                group[metric] = {**values, "hist": dict(values["hist"])}
+                continue
+            for field in ("count", "sum", "sumsq"):
+                merged[field] += values[field]
+            merged["min"] = min(merged["min"], values["min"])
+            merged["max"] = max(merged["max"], values["max"])
+            for value, n in values["hist"].items():
+                merged["hist"][value] = merged["hist"].get(value, 0) + n
+
+    return [groups[key] for key in sorted(groups, key=_sort_key)]
+
+
+def _sort_key(key):
+    # groups can have missing (None) fields next to set ones
+    return tuple((value is not None, str(value)) for value in key)
+
+
+def percentile(hist, p):
+    """
+    p-th percentile of the values counted in a {bin: count} histogram,
+    interpolated linearly between ranks as numpy.percentile does.
+    """
+    values = sorted((int(index) * BIN, n) for index, n in hist.items())
+    total = sum(n for _, n in values)
+    rank = p / 100 * (total - 1)
+    below, above = math.floor(rank), math.ceil(rank)
+
+    low = high = None
+    seen = 0
+    for value, n in values:
+        seen += n
+        if low is None and seen > below:
+            low = value
+        if seen > above:
+            high = value
+            break
+    return low + (high - low) * (rank - below)
+
+
+def describe(values, percentiles=DEFAULT_PERCENTILES):
+    """Count, mean, std, min, max and percentiles of merged metric values"""
+    count = values["count"]
+    mean = values["sum"] / count
+    variance = max(values["sumsq"] / count - mean * mean, 0.0)
+    description = {
+        "count": count,
+        "mean": mean,
+        "std": math.sqrt(variance),
+        "min": values["min"],
+        "max": values["max"],
+    }
+    for p in percentiles:
+        description[f"p{p:g}"] = percentile(values["hist"], p)
+    return description
+
+
+def report(groups, percentiles=DEFAULT_PERCENTILES):
+    """The merged groups with their metrics described"""
+    return [
+        {
+            **{k: v for k, v in group.items() if k not in METRICS},
+            **{
+                metric: describe(group[metric], percentiles)
+                for metric in METRICS
+                if metric in group
+            },
+        }
+        for group in groups
+    ]
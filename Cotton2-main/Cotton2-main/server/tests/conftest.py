@@ -0,0 +1,57 @@
+import os
+import sys
+import uuid
+from unittest import mock
+
+# the server modules are imported as top-level modules, as app.py does
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER)
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def sample():
+    """Bytes of an image of lines/, by name"""
+
+    def read(name):
+        with open(os.path.join(SERVER, "lines", name), "rb") as f:
+            return f.read()
+
+    return read
+
+
+@pytest.fixture(scope="session")
+def server():
+    """
+    The app module, on mongomock instead of a MongoDB server, with its
+    analyses on a thread of the test process and cheap password hashes.
+    """
+    mongomock = pytest.importorskip("mongomock")
+    import mongomock.gridfs
+    import pymongo
+
+    mongomock.gridfs.enable_gridfs_integration()
+    env = {"ANALYSIS_WORKERS": "0", "ANALYSIS_WARM_UP": "0", "BCRYPT_ROUNDS": "4"}
+    with mock.patch.dict(os.environ, env), mock.patch.object(pymongo, "MongoClient", mongomock.MongoClient):
+        import app
+    return app
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """Register and log in a new user, returns the headers of their requests"""
+
+    def login(username=None, password="password"):
+        username = username or f"user-{uuid.uuid4().hex}"
+        credentials = {"username": username, "password": password}
+        client.post("/register", json=credentials)
+        response = client.post("/login", json=credentials)
+        return {"Authorization": f"Bearer {response.json['access_token']}"}
+
+    return login
@@ -0,0 +1,37 @@
+import json
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import batch
+
+
+@pytest.mark.parametrize("version", ["v2", "v3"])
+def test_cli_store(server, login, sample, tmp_path, monkeypatch, version):
+    for name in ("image-2.jpg", "lines_2.jpeg"):
+        (tmp_path / name).write_bytes(sample(name))
+    user = f"batch-{uuid.uuid4().hex}"
+    login(user)
+    output = tmp_path / "report.json"
+    argv = ["batch.py", str(tmp_path), "--version", version, "--calibration-factor", "0.05"]
+    argv += ["--lot-number", "7", "--store", user, "--output", str(output)]
+    monkeypatch.setattr(sys, "argv", argv)
+    # the analyses on threads of the test process, as the app fixture runs them
+    monkeypatch.setattr(batch, "ProcessPoolExecutor", ThreadPoolExecutor)
+    batch.main()
+
+    images = json.loads(output.read_text())["images"]
+    assert [image["filename"] for image in images] == ["image-2.jpg", "lines_2.jpeg"]
+    assert not any("error" in image for image in images)
+    uploads = list(server.uploads_collection.find({"uploaded_by": server.user_id(user)}))
+    analyses = list(server.analyses_collection.find({"user_id": user}))
+    assert len(uploads) == len(analyses) == 2
+    assert {analysis["file_id"] for analysis in analyses} == {upload["file_id"] for upload in uploads}
+    details = list(server.image_details_collection.find({"user_id": user}))
+    if version == "v3":
+        assert sorted(d["test_number"] for d in details) == sorted(a["test_number"] for a in analyses)
+        assert {d["lot_number"] for d in details} == {7}
+    else:
+        assert details == []
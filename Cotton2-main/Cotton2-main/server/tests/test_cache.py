@@ -0,0 +1,86 @@
+import io
+import os
+import pickle
+import struct
+import uuid
+
+import numpy as np
+import pytest
+
+from analysis import run_analysis
+from cache import ResultCache, cache_key, dumps, loads
+from warmup import sample_image
+
+
+def assert_same(restored, result):
+    assert type(restored) is type(result)
+    if isinstance(result, dict):
+        assert restored.keys() == result.keys()
+        for key in result:
+            assert_same(restored[key], result[key])
+    elif isinstance(result, (list, tuple)):
+        assert len(restored) == len(result)
+        for a, b in zip(restored, result):
+            assert_same(a, b)
+    elif isinstance(result, np.ndarray):
+        assert restored.dtype == result.dtype
+        np.testing.assert_array_equal(restored, result)
+    else:
+        assert restored == result
+
+
+@pytest.mark.parametrize(
+    "version, params",
+    [("v1", {"method": 1}), ("v2", {}), ("v3", {"calibration_factor": 0.05, "render": {}})],
+)
+def test_results_round_trip(sample, version, params):
+    result = run_analysis(version, "lines_2.jpeg", sample("lines_2.jpeg"), params)
+    assert_same(loads(dumps(result)), result)
+
+
+def test_directory(tmp_path):
+    key = cache_key(b"image", "v2", {})
+    result = {"length": ["a.jpg", [1.5, 2.0]], "array": np.arange(3), "image": b"\x00\x01"}
+    ResultCache(directory=str(tmp_path)).put(key, result)
+    # another process on the same host
+    assert_same(ResultCache(directory=str(tmp_path)).get(key), result)
+
+
+def test_directory_runs_no_code(tmp_path):
+    cache = ResultCache(directory=str(tmp_path))
+    key = cache_key(b"image", "v2", {})
+    path = cache._path(key)
+    os.makedirs(os.path.dirname(path))
+
+    # an object array, a plain pickle and a partial file
+    header = b'{"value": {"__array__": 0, "scalar": false}, "arrays": [["|O", [1]]]}'
+    entries = [struct.pack(">I", len(header)) + header + bytes(8), pickle.dumps({"length": []}), b"\x00\x00"]
+    for data in entries:
+        with open(path, "wb") as f:
+            f.write(data)
+        assert cache.get(key) is None
+
+
+def test_key_of_calibrated_pixels():
+    assert cache_key(b"image", "v1", {"method": 1, "calibration_factor": 0.05}) == cache_key(
+        b"image", "v1", {"method": 1}
+    )
+    assert cache_key(b"image", "v1", {"method": 1}) != cache_key(b"image", "v1", {"method": 2})
+    # v3 results are in mm
+    assert cache_key(b"image", "v3", {"calibration_factor": 0.05}) != cache_key(
+        b"image", "v3", {"calibration_factor": 0.1}
+    )
+
+
+def test_recalibrated_upload_hits(server, client, login):
+    user = f"cache-{uuid.uuid4().hex}"
+    headers = login(user)
+    # an image no other test analyses
+    data = sample_image(width=433)
+    for calibration_factor, cache in (("0.05", None), ("0.1", "HIT")):
+        form = {"file": (io.BytesIO(data), "fibers.png"), "calibration_factor": calibration_factor}
+        response = client.post("/api/v2/upload", data=form, headers=headers, content_type="multipart/form-data")
+        assert response.status_code == 200
+        assert response.headers.get("X-Cache") == cache
+    analyses = server.analyses_collection.find({"user_id": user}).sort("_id")
+    assert [a["calibration_factor"] for a in analyses] == [0.05, 0.1]
@@ -0,0 +1,80 @@
+import io
+import uuid
+
+import numpy as np
+import pytest
+
+import fibrogram
+
+
+def test_histogram():
+    bins, counts = fibrogram.histogram([100, 101, 250, np.nan], 0.1)
+    np.testing.assert_array_equal(bins, [100, 101, 250])
+    np.testing.assert_array_equal(counts, [1, 1, 1])
+    assert fibrogram.to_hist(bins, counts) == {"100": 1, "101": 1, "250": 1}
+    for restored, array in zip(fibrogram.from_hist({"250": 1, "100": 1, "101": 1}), (bins, counts)):
+        np.testing.assert_array_equal(restored, array)
+
+
+def test_equal_lengths():
+    # every fiber 20.05 mm long: the fibrogram falls linearly to 0 at their length
+    bins, counts = fibrogram.histogram(np.full(10, 20.05))
+    metrics = fibrogram.metrics(bins, counts, "length")
+    assert metrics["fibers"] == 10
+    assert metrics["span_length_50"] == pytest.approx(20.05 / 2)
+    assert metrics["span_length_2_5"] == pytest.approx(20.05 * 0.975)
+    assert metrics["uniformity_ratio"] == pytest.approx(100 * 0.5 / 0.975)
+    assert metrics["short_fiber_content"] == 0
+
+    bins, counts = fibrogram.histogram([10.05, 10.05, 20.05, 30.05])
+    assert fibrogram.metrics(bins, counts, "length")["short_fiber_content"] == 50
+
+
+def test_evenly_spread_ends():
+    # one end in every bin up to 30 mm: the fibrogram falls linearly to 0 at 30 mm
+    bins, counts = fibrogram.histogram(np.arange(300) * fibrogram.BIN + fibrogram.BIN / 2)
+    metrics = fibrogram.metrics(bins, counts, "span")
+    assert metrics["span_length_50"] == pytest.approx(15)
+    assert metrics["span_length_2_5"] == pytest.approx(29.25)
+    assert metrics["short_fiber_content"] is None
+
+
+def test_rollup_of_histograms():
+    first, second = [12.3, 25.1, 25.1, 30.0], [8.2, 25.1, 41.7]
+    hist = {}
+    for lengths in (first, second):
+        for path, n in fibrogram.rollup_update(*fibrogram.histogram(lengths))["$inc"].items():
+            if path.startswith("hist."):
+                hist[path[5:]] = hist.get(path[5:], 0) + n
+    bins, counts = fibrogram.from_hist(hist)
+    expected = fibrogram.histogram(first + second)
+    assert fibrogram.metrics(bins, counts, "length") == fibrogram.metrics(*expected, "length")
+
+
+def upload(client, headers, sample, **form):
+    form["file"] = (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg")
+    response = client.post("/api/v2/upload", data=form, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 200
+
+
+def test_uncalibrated_lengths_not_rolled_up(server, client, login, sample):
+    user = f"fibrogram-{uuid.uuid4().hex}"
+    headers = login(user)
+    upload(client, headers, sample, lot_number="5")
+    (analysis,) = server.analyses_collection.find({"user_id": user})
+    assert analysis["calibration_factor"] is None
+
+    response = client.get(f"/api/v1/fibrogram?analysis_id={analysis['_id']}", headers=headers)
+    (pixels,) = response.json["data"]
+    assert pixels["unit"] == "px"
+    assert pixels["short_fiber_content"] is None
+    assert client.get("/api/v1/fibrogram?lot_number=5", headers=headers).json["data"] == []
+
+    upload(client, headers, sample, lot_number="5", calibration_factor="0.05")
+    (lot,) = client.get("/api/v1/fibrogram?lot_number=5", headers=headers).json["data"]
+    assert (lot["unit"], lot["tests"]) == ("mm", 1)
+    assert lot["span_length_50"] == pytest.approx(pixels["span_length_50"] * 0.05, abs=fibrogram.BIN)
+
+    result = server.app.test_cli_runner().invoke(args=["rebuild-stats", "--user", user])
+    assert "1 fibrogram rollups" in result.output
+    assert client.get("/api/v1/fibrogram?lot_number=5", headers=headers).json["data"] == [lot]
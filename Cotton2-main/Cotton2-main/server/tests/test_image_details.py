@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def tests(server, login):
+    """Tests of a new user, one a day from May 1st, as (headers, tests)"""
+    user = f"user-{uuid.uuid4().hex}"
+    headers = login(user)
+    # the first number is left for a test stored out of order
+    first = server.allocate_test_numbers(8)
+    tests = [
+        {
+            "user_id": user,
+            "test_number": first + 1 + i,
+            "date": f"2024-05-{1 + i:02d} 10:00:00+05:30",
+            "lot_number": i % 2,
+            "msfl": 20.0 + i,
+        }
+        for i in range(7)
+    ]
+    server.image_details_collection.insert_many([dict(test) for test in tests])
+    return headers, tests
+
+
+def pages(client, headers, query, limit):
+    """Test numbers of every page of a query"""
+    numbers, after = [], None
+    while True:
+        url = f"/api/v1/image_details?{query}&limit={limit}" + (f"&after={after}" if after else "")
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        numbers.append([detail["test_number"] for detail in response.json["data"]])
+        after = response.json["next"]
+        if after is None:
+            return numbers
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_pages(client, tests, order):
+    headers, stored = tests
+    expected = [test["test_number"] for test in stored]
+    if order == "desc":
+        expected.reverse()
+    numbers = pages(client, headers, f"order={order}", 3)
+    assert numbers == [expected[:3], expected[3:6], expected[6:]]
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_date_range_pages(server, client, tests, order):
+    headers, stored = tests
+    # a test stored on a later day with an earlier number, as numbers of
+    # tests stored before they were allocated atomically can be
+    late = dict(stored[0], test_number=stored[0]["test_number"] - 1, date="2024-05-04 12:00:00+05:30")
+    server.image_details_collection.insert_one(late)
+
+    in_range = [test for test in stored + [late] if "2024-05-02" <= test["date"] < "2024-05-06"]
+    expected = [
+        test["test_number"] for test in sorted(in_range, key=lambda t: (t["date"], t["test_number"]))
+    ]
+    if order == "desc":
+        expected.reverse()
+    numbers = pages(client, headers, f"from=2024-05-02&to=2024-05-06&order={order}", 2)
+    assert sum(numbers, []) == expected
+    assert [len(page) for page in numbers] == [2, 2, 1]
+
+    numbers = pages(client, headers, "from=2024-05-02&lot_number=1", 2)
+    assert numbers == [[stored[1]["test_number"], stored[3]["test_number"]], [stored[5]["test_number"]]]
+
+
+def test_unknown_cursor(client, tests, login):
+    headers, stored = tests
+    first = client.get("/api/v1/image_details?from=2024-05-01&limit=1", headers=headers).json["next"]
+    response = client.get(f"/api/v1/image_details?from=2024-05-01&limit=1&after={first}", headers=login())
+    assert response.status_code == 400
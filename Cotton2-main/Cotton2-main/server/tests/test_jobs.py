@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+
+@pytest.fixture
+def queue():
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="analysis")
+    yield JobQueue(workers=2, max_pending=2, ttl=60, executor=executor)
+    executor.shutdown()
+
+
+def wait(queue, job_id, timeout=10):
+    """The job once it is finished"""
+    deadline = time.monotonic() + timeout
+    while (job := queue.get(job_id))["status"] in ("queued", "running"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return job
+
+
+def test_job_done(queue):
+    stored = []
+
+    def on_done(result):
+        stored.append((result, threading.current_thread().name))
+
+    job = wait(queue, queue.submit("alice", pow, 2, 10, on_done=on_done))
+    assert (job["status"], job["result"], job["owner"]) == ("done", 1024, "alice")
+    # stored off the threads of the analyses
+    ((result, thread),) = stored
+    assert result == 1024 and thread.startswith("jobs-done")
+    assert queue.pending == 0
+
+
+def test_job_failures(queue):
+    job = wait(queue, queue.submit("alice", int, "x"))
+    assert job["status"] == "failed" and "invalid literal" in job["error"]
+
+    def fail(result):
+        raise RuntimeError("no primary")
+
+    job = wait(queue, queue.submit("alice", int, "1", on_done=fail))
+    assert (job["status"], job["error"]) == ("failed", "Error storing result: no primary")
+    assert queue.pending == 0
+
+
+def test_queue_depth(queue):
+    release = threading.Event()
+    running = [queue.submit("alice", release.wait) for _ in range(2)]
+    assert queue.get(running[0])["status"] in ("queued", "running")
+    with pytest.raises(QueueFull):
+        queue.submit("alice", int)
+    with pytest.raises(QueueFull):
+        queue.reserve(1)
+    release.set()
+    assert [wait(queue, job_id)["status"] for job_id in running] == ["done", "done"]
+
+    assert queue.reserve(2) == 2
+    with pytest.raises(QueueFull):
+        queue.submit("alice", int)
+    queue.release(2)
+    assert wait(queue, queue.submit("alice", int))["status"] == "done"
+
+
+def test_finished_jobs_expire(queue):
+    job_id = queue.submit("alice", int)
+    assert wait(queue, job_id)["status"] == "done"
+    queue.ttl = 0
+    queue.submit("alice", int)
+    assert queue.get(job_id) is None
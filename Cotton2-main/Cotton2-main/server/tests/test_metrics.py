@@ -0,0 +1,86 @@
+import io
+import math
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from metrics import CONTENT_TYPE, Registry
+from warmup import sample_image
+
+
+def test_exposition():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", ["path"])
+    gauge = registry.gauge("rss_bytes", "Memory")
+    histogram = registry.histogram("seconds", "Time", ["stage"], buckets=(0.1, 1))
+    counter.inc(path='/a"b\\')
+    counter.inc(2, path='/a"b\\')
+    gauge.set(1024)
+    for value in (0.05, 0.5, 0.1, 3):
+        histogram.observe(value, stage="decode")
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        r'requests_total{path="/a\"b\\"} 3.0',
+        "# HELP rss_bytes Memory",
+        "# TYPE rss_bytes gauge",
+        "rss_bytes 1024.0",
+        "# HELP seconds Time",
+        "# TYPE seconds histogram",
+        'seconds_bucket{stage="decode",le="0.1"} 2',
+        'seconds_bucket{stage="decode",le="1.0"} 3',
+        'seconds_bucket{stage="decode",le="+Inf"} 4',
+        'seconds_sum{stage="decode"} 3.65',
+        'seconds_count{stage="decode"} 4',
+    ]
+    assert histogram.buckets[-1] == math.inf
+
+
+def test_labels_checked():
+    counter = Registry().counter("requests_total", "Requests", ["path"])
+    with pytest.raises(ValueError, match="expects labels"):
+        counter.inc(method="GET")
+
+
+def samples(client):
+    """{sample: value} of the /metrics of the app"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == CONTENT_TYPE
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in response.data.decode().splitlines()
+        if not line.startswith("#")
+    }
+
+
+def test_analysis_metrics(client, login):
+    # an image no other test analyses, so it is not in the result cache
+    data = sample_image(width=451)
+    height, width = cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR).shape[:2]
+    before = samples(client)
+    form = {"file": (io.BytesIO(data), "fibers.png")}
+    response = client.post("/api/v2/upload", data=form, headers=login(), content_type="multipart/form-data")
+    assert response.status_code == 200
+    after = samples(client)
+
+    def added(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert added("cotton_image_pixels_count") == 1
+    assert added("cotton_image_pixels_sum") == height * width
+    assert added('cotton_analysis_seconds_count{version="v2"}') == 1
+    # the 12 fibers of the image
+    assert added('cotton_analysis_items_bucket{version="v2",item="fibers",le="10.0"}') == 0
+    assert added('cotton_analysis_items_bucket{version="v2",item="fibers",le="30.0"}') == 1
+    assert added('cotton_analysis_items_sum{version="v2",item="fibers"}') == 12
+    # in bytes: the process holds the pipelines' dependencies, far more than 20 MB
+    assert after["cotton_analysis_peak_rss_bytes"] > 20e6
+    # every bucket of a histogram counts the values up to its bound
+    buckets = [
+        value for name, value in after.items() if name.startswith('cotton_stage_seconds_bucket{stage="decode"')
+    ]
+    assert buckets == sorted(buckets)
+    assert buckets[-1] == after['cotton_stage_seconds_count{stage="decode"}']
@@ -0,0 +1,139 @@
+"""
+Results of every method on the sample images of lines/, pinned to the ones
+of the original implementations, so optimizations of the pipelines cannot
+change them unnoticed.
+"""
+import numpy as np
+import pytest
+
+import clustering
+import lines_1
+import lines_2
+import segmentation
+from fibers import to_binary
+from pipeline import ImagePipeline, _key
+
+# image -> number of fibers and sum of their lengths in pixels
+LINES_1 = {
+    "04-lines.png": (3, 1576.3641294240952),
+    "08-lines.png": (1, 1860.7682375907898),
+    "image-1.png": (2, 1925.2743312716484),
+    "image-2.jpg": (2, 3165.259785950184),
+    "image-3.png": (2, 1254.2478608489037),
+    "lines_1.jpg": (0, 0.0),
+    "lines_2.jpeg": (12, 11277.352671802044),
+    "lines_3.jpg": (9, 3691.300363242626),
+}
+LINES_2 = {
+    "04-lines.png": (1, 272.0),
+    "08-lines.png": (1, 87.0),
+    "image-1.png": (1, 36.0),
+    "image-2.jpg": (1, 662.0),
+    "image-3.png": (1, 193.0),
+    "lines_1.jpg": (1, 486.0),
+    "lines_2.jpeg": (6, 3798.305191658007),
+    "lines_3.jpg": (1, 257.0),
+}
+SEGMENTATION = {
+    "04-lines.png": (4, 2456.8570811434474),
+    "08-lines.png": (5, 3929.1170617206594),
+    "image-1.png": (6, 5488.89290000797),
+    "image-2.jpg": (5, 7208.608529260525),
+    "image-3.png": (9, 3828.2422401634644),
+    "lines_1.jpg": (4, 1089.1369708642105),
+    "lines_2.jpeg": (108, 70242.60889968817),
+    "lines_3.jpg": (5, 1655.538238691624),
+}
+# image -> number of endpoints, MSFL, IFL and ML in pixels (calibration 1)
+CLUSTERING = {
+    "image-2.jpg": (7, 1027.0136625731502, 1029.0136625731502, 819.7596234737216),
+    "lines_1.jpg": (12, 377.3953922564131, 379.3953922564131, 196.9940017733887),
+    "lines_2.jpeg": (4, 468.201373539382, 470.201373539382, 350.9366039614563),
+    "lines_3.jpg": (5, 531.0328255811925, 533.0328255811925, 448.51935422132135),
+}
+# images with fewer than 2 endpoints, which cannot be clustered
+NO_CLUSTERS = ["04-lines.png", "08-lines.png", "image-1.png", "image-3.png"]
+
+
+def assert_lengths(lengths, expected):
+    count, total = expected
+    assert len(lengths) == count
+    assert float(np.sum(lengths)) == pytest.approx(total, rel=1e-9, abs=1e-9)
+
+
+@pytest.mark.parametrize("name", sorted(LINES_1))
+def test_lines_1(sample, name):
+    filename, lengths = lines_1.fiber_length_1(name, 1, image=sample(name))
+    assert filename == name
+    assert_lengths(lengths, LINES_1[name])
+
+
+def test_lines_1_plot(sample):
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.close("all")
+    _, lengths = lines_1.fiber_length_1("lines_3.jpg", 1, plot=True, image=sample("lines_3.jpg"))
+    assert_lengths(lengths, LINES_1["lines_3.jpg"])
+    (image,) = plt.gca().get_images()
+    assert image.get_array().shape == (465, 720)
+    plt.close("all")
+
+
+@pytest.mark.parametrize("name", sorted(LINES_2))
+def test_lines_2(sample, name):
+    filename, lengths = lines_2.fiber_length_2(name, image=sample(name))
+    assert filename == name
+    assert all(type(length) is float for length in lengths)
+    assert_lengths(lengths, LINES_2[name])
+
+
+@pytest.mark.parametrize("name", sorted(SEGMENTATION))
+def test_segmentation(sample, name):
+    filename, lengths = segmentation.segment_threads(name, image=sample(name))
+    assert filename == name
+    assert_lengths(lengths, SEGMENTATION[name])
+
+
+@pytest.mark.parametrize("name", sorted(CLUSTERING))
+def test_clustering(sample, name):
+    endpoints, *expected = CLUSTERING[name]
+    _, analysis = clustering.analyze(sample(name))
+    assert len(analysis["endpoints"]) == endpoints
+    assert clustering.measure(analysis, 1.0) == pytest.approx(expected, rel=1e-9)
+    assert clustering.measure(analysis, 0.05) == pytest.approx(
+        [expected[0] * 0.05, expected[0] * 0.05 + 2, expected[2] * 0.05], rel=1e-9
+    )
+
+
+@pytest.mark.parametrize("name", NO_CLUSTERS)
+def test_clustering_too_few_endpoints(sample, name):
+    with pytest.raises(ValueError, match="at least 2 are needed"):
+        clustering.analyze(sample(name))
+
+
+def test_stored_analysis_round_trip(sample):
+    _, analysis = clustering.analyze(sample("lines_2.jpeg"))
+    document = {"arrays": to_binary(clustering.analysis_to_arrays(analysis))}
+    restored = clustering.analysis_from_document(document)
+    assert clustering.measure(restored, 0.1) == pytest.approx(clustering.measure(analysis, 0.1))
+    for key in ("endpoints", "labels", "centroids"):
+        np.testing.assert_array_equal(restored[key], analysis[key])
+
+
+def test_pipeline_keeps_chain_results(sample):
+    pipeline = ImagePipeline(sample("lines_2.jpeg"))
+    # the decoded image, for a later chain
+    pipeline.keep(lines_2.DECODE)
+    filename, lengths = lines_2.fiber_length_2("lines_2.jpeg", image=pipeline)
+    assert_lengths(lengths, LINES_2["lines_2.jpeg"])
+    # the chain run and the kept prefix
+    kept = [lines_2.DECODE, lines_2.SKELETONIZE]
+    assert set(pipeline.results) == {_key(steps) for steps in kept}
+
+    # a longer chain starts from the longest kept prefix
+    before = dict(pipeline.timings)
+    pipeline.run(lines_2.SKELETONIZE + (("dilate", {}),))
+    assert pipeline.timings["decode"] == before["decode"]
+    assert pipeline.timings["skeletonize"] == before["skeletonize"]
@@ -0,0 +1,58 @@
+import io
+import uuid
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from test_pipelines import CLUSTERING
+
+
+@pytest.fixture
+def stored_test(server, client, login, sample):
+    """A v3 test of lines_2.jpeg, uncalibrated; returns its owner's headers and test number"""
+    user = f"recalibrate-{uuid.uuid4().hex}"
+    headers = login(user)
+    form = {"file": (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg"), "format": "json"}
+    response = client.post("/api/v3/upload", data=form, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 200
+    (analysis,) = server.analyses_collection.find({"user_id": user})
+    return headers, analysis["test_number"]
+
+
+def test_recalibrate(client, stored_test):
+    headers, test_number = stored_test
+    _, msfl, ifl, ml = CLUSTERING["lines_2.jpeg"]
+    response = client.post(
+        f"/api/v3/recalibrate/{test_number}",
+        data={"calibration_factor": "0.05", "format": "json"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.json["test_number"] == test_number
+    assert response.json["calibration_factor"] == 0.05
+    assert [response.json[key] for key in ("msfl", "ifl", "ml")] == pytest.approx(
+        [msfl * 0.05, msfl * 0.05 + 2, ml * 0.05], rel=1e-9
+    )
+
+
+def test_recalibrate_overlay(client, stored_test):
+    headers, test_number = stored_test
+    response = client.post(
+        f"/api/v3/recalibrate/{test_number}",
+        data={"calibration_factor": "0.05", "format": "jpeg", "max_dim": "300"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    image = cv.imdecode(np.frombuffer(response.data, np.uint8), cv.IMREAD_COLOR)
+    assert max(image.shape[:2]) == 300
+
+
+def test_recalibrate_errors(client, login, stored_test):
+    headers, test_number = stored_test
+    url = f"/api/v3/recalibrate/{test_number}"
+    assert client.post(url, data={"calibration_factor": "x"}, headers=headers).status_code == 400
+    assert client.post(url, data={"format": "gif"}, headers=headers).status_code == 400
+    # only the owner of a test can recalibrate it
+    assert client.post(url, data={"format": "json"}, headers=login()).status_code == 404
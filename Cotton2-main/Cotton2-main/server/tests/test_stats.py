@@ -0,0 +1,118 @@
+import io
+
+import numpy as np
+import pytest
+
+import stats
+
+TESTS = [
+    {"user_id": "u", "lot_number": 1, "station": "a", "date": "2024-05-01 10:00:00", "msfl": 28.537, "ifl": 30.537, "ml": 21.1},
+    {"user_id": "u", "lot_number": 1, "station": "a", "date": "2024-05-01 11:00:00", "msfl": 27.1, "ifl": 29.1, "ml": 20.25},
+    {"user_id": "u", "lot_number": 1, "station": "b", "date": "2024-05-02 09:00:00", "msfl": 31.004, "ifl": 33.004, "ml": 24.0},
+    {"user_id": "u", "lot_number": 2, "station": "b", "date": "2024-05-02 12:00:00", "msfl": 26.49, "ifl": None, "ml": 19.5},
+]
+
+
+def rollups(tests):
+    """Rollup documents of tests, applying their updates as MongoDB would"""
+    documents = {}
+    for test in tests:
+        key = stats.rollup_key(test)
+        document = documents.setdefault(tuple(key.values()), dict(key))
+        update = stats.rollup_update(test)
+        for path, n in update["$inc"].items():
+            *parents, field = path.split(".")
+            target = document
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[field] = target.get(field, 0) + n
+        for op, pick in (("$min", min), ("$max", max)):
+            for path, value in update.get(op, {}).items():
+                metric, field = path.split(".")
+                values = document[metric]
+                values[field] = pick(values.get(field, value), value)
+    return list(documents.values())
+
+
+def test_bins():
+    assert stats.to_bin(28.537) == 2854
+    assert stats.to_bin(28) == 2800
+    update = stats.rollup_update(TESTS[0], count=3)
+    assert update["$inc"]["msfl.hist.2854"] == 3
+    assert update["$inc"]["msfl.sum"] == pytest.approx(28.537 * 3)
+    assert update["$min"]["msfl.min"] == 28.537
+
+
+def test_merged_statistics():
+    (group,) = stats.report(stats.merge(rollups(TESTS), []), percentiles=(0, 25, 50, 90, 100))
+    assert group["count"] == 4
+    msfl = np.array([test["msfl"] for test in TESTS])
+    described = group["msfl"]
+    assert described["count"] == 4
+    assert described["mean"] == pytest.approx(msfl.mean())
+    assert described["std"] == pytest.approx(msfl.std())
+    assert (described["min"], described["max"]) == (msfl.min(), msfl.max())
+    for p in (0, 25, 50, 90, 100):
+        assert described[f"p{p}"] == pytest.approx(np.percentile(msfl, p), abs=stats.BIN / 2)
+    # metrics missing from a test are not counted
+    assert group["ifl"]["count"] == 3
+
+
+def test_groups():
+    groups = stats.merge(rollups(TESTS), ["lot_number", "station"])
+    assert [(g["lot_number"], g["station"], g["count"]) for g in groups] == [
+        (1, "a", 2),
+        (1, "b", 1),
+        (2, "b", 1),
+    ]
+    assert groups[0]["msfl"]["hist"] == {"2854": 1, "2710": 1}
+
+
+def test_fractional_results_stored(server, client, login, sample):
+    headers = login()
+    form = {
+        "file": (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg"),
+        "calibration_factor": "0.05",
+        "format": "json",
+        "lot_number": "",
+        "station": "s1",
+    }
+    response = client.post("/api/v3/upload", data=form, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/image_details", headers=headers)
+    (stored,) = response.json["data"]
+    assert stored["msfl"] == pytest.approx(468.201373539382 * 0.05)
+    assert stored["lot_number"] is None
+
+    response = client.get("/api/v1/stats?by=station", headers=headers)
+    (group,) = response.json["data"]
+    assert group["msfl"]["p50"] == pytest.approx(stored["msfl"], abs=stats.BIN / 2)
+
+
+def test_invalid_details_rejected(server, client, login, sample):
+    headers = login()
+    form = {"file": (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg"), "lot_number": "twelve"}
+    response = client.post("/api/v3/upload", data=form, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 400
+    assert client.get("/api/v1/image_details", headers=headers).json["data"] == []
+
+
+def test_rebuild(server):
+    user = "rebuild-user"
+    tests = [{**test, "user_id": user, "test_number": -i} for i, test in enumerate(TESTS, 1)]
+    server.image_details_collection.insert_many([dict(test) for test in tests])
+    # a rollup counted twice, and one of tests that are gone
+    server.stats_collection.insert_one({**stats.rollup_key(tests[0]), "count": 2})
+    server.stats_collection.insert_one({**stats.rollup_key({**tests[0], "lot_number": 9}), "count": 1})
+
+    def stored():
+        return sorted(server.stats_collection.find({"user_id": user}, {"_id": 0}), key=str)
+
+    result = server.app.test_cli_runner().invoke(args=["rebuild-stats", "--user", user])
+    assert result.exit_code == 0
+    assert "3 stats rollups" in result.output
+    rebuilt = stored()
+    assert rebuilt == sorted(rollups(tests), key=str)
+    server.rebuild_stats(user)
+    assert stored() == rebuilt
@@ -0,0 +1,51 @@
+"""
+Every version and method gives the same results with a tile size as on the
+whole image.
+"""
+import cv2 as cv
+import pytest
+
+from analysis import run_analysis
+from pipeline import ImagePipeline
+from test_pipelines import CLUSTERING, LINES_1
+
+METHODS = [
+    ("v1", {"method": 1}),
+    ("v1", {"method": 2}),
+    ("v2", {}),
+    ("v3", {"render": None}),
+]
+
+
+def numbers(version, result):
+    if version == "v3":
+        return [result[key] for key in ("msfl", "ifl", "ml")]
+    return result["length"][1]
+
+
+@pytest.mark.parametrize("tile", [97, 128])
+@pytest.mark.parametrize("version, params", METHODS, ids=["v1-1", "v1-2", "v2", "v3"])
+@pytest.mark.parametrize("name", sorted(LINES_1))
+def test_tiled_results(sample, name, version, params, tile):
+    if version == "v3" and name not in CLUSTERING:
+        pytest.skip("too few endpoints to cluster")
+    data = sample(name)
+    whole = run_analysis(version, name, data, params)
+    tiled = run_analysis(version, name, data, params, tile=tile)
+    assert numbers(version, tiled) == numbers(version, whole)
+
+
+def test_decoded_once(sample, monkeypatch):
+    decoded = []
+    imdecode = cv.imdecode
+
+    def count(*args):
+        decoded.append(args)
+        return imdecode(*args)
+
+    monkeypatch.setattr(cv, "imdecode", count)
+    pipeline = ImagePipeline(sample("lines_2.jpeg"), tile=128)
+    for version, params in METHODS:
+        run_analysis(version, "lines_2.jpeg", pipeline, params)
+    # once in color, and once in grayscale for v1 method 1
+    assert sorted(flags for _, flags in decoded) == [cv.IMREAD_GRAYSCALE, cv.IMREAD_COLOR]
@@ -0,0 +1,64 @@
+"""
+Paths, ends and degrees read by topology.py from skan's CSR arrays, pinned on
+the v3 skeletons of the sample images and checked against skan's own
+per-path accessors.
+"""
+import io
+
+import numpy as np
+import pytest
+
+import clustering
+import topology
+from pipeline import ImagePipeline
+from test_pipelines import SEGMENTATION, assert_lengths
+
+# image -> paths of the v3 skeleton, paths longer than 12 pixels with more
+# than 12 points, and ends of those paths of degree 1
+SKELETONS = {
+    "04-lines.png": (6, 6, 0),
+    "08-lines.png": (5, 3, 0),
+    "image-1.png": (6, 3, 0),
+    "image-2.jpg": (399, 97, 7),
+    "image-3.png": (8, 5, 1),
+    "lines_1.jpg": (281, 56, 12),
+    "lines_2.jpeg": (188, 87, 4),
+    "lines_3.jpg": (274, 65, 5),
+}
+
+
+def skeleton(data):
+    return ImagePipeline(data).skeleton(clustering.PREPROCESS)
+
+
+@pytest.mark.parametrize("name", sorted(SKELETONS))
+def test_skeleton_topology(sample, name):
+    g = skeleton(sample(name))
+    paths = topology.long_paths(g, 12, 12)
+    ends = topology.path_ends(g, paths)
+    assert (g.n_paths, len(paths), int(np.sum(topology.degrees(g, ends) == 1))) == SKELETONS[name]
+
+    lengths = g.path_lengths()
+    expected = [i for i in range(g.n_paths) if lengths[i] > 12 and len(g.path(i)) > 12]
+    np.testing.assert_array_equal(paths, expected)
+    np.testing.assert_array_equal(ends, [g.path(i)[0] for i in paths] + [g.path(i)[-1] for i in paths])
+    np.testing.assert_array_equal(topology.degrees(g, ends), g.degrees[ends])
+    for path, coords in zip(paths, topology.path_coordinates(g, paths)):
+        np.testing.assert_array_equal(coords, g.path_coordinates(path).astype(int))
+
+
+def test_no_paths(sample):
+    g = skeleton(sample("lines_2.jpeg"))
+    paths = topology.long_paths(g, np.inf)
+    assert len(paths) == 0
+    assert len(topology.path_ends(g, paths)) == 0
+    assert topology.path_coordinates(g, paths) == []
+
+
+def test_v2_upload(client, login, sample):
+    form = {"file": (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg")}
+    response = client.post("/api/v2/upload", data=form, headers=login(), content_type="multipart/form-data")
+    assert response.status_code == 200
+    filename, lengths = response.json["length"]
+    assert filename == "lines_2.jpeg"
+    assert_lengths(lengths, SEGMENTATION["lines_2.jpeg"])
@@ -0,0 +1,82 @@
+"""
+TwoMeans against sklearn's KMeans(n_clusters=2, random_state=42), which the
+v3 analyses were clustered with, and its warm starts.
+"""
+import io
+import uuid
+
+import numpy as np
+import pytest
+
+import clustering
+from test_pipelines import CLUSTERING
+from twomeans import TwoMeans
+
+KMeans = pytest.importorskip("sklearn.cluster").KMeans
+
+
+def assert_same_clusters(points, labels, centroids):
+    kmeans = KMeans(n_clusters=2, random_state=42).fit(points)
+    np.testing.assert_array_equal(labels, kmeans.labels_)
+    np.testing.assert_allclose(centroids, kmeans.cluster_centers_, rtol=1e-9)
+
+
+@pytest.mark.parametrize("name", sorted(CLUSTERING))
+def test_sample_endpoints_as_sklearn(sample, name):
+    _, _, endpoints = clustering.preprocess(sample(name))
+    assert_same_clusters(endpoints, *TwoMeans().fit(endpoints))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_points_as_sklearn(seed):
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 1000, (int(rng.integers(2, 400)), 2))
+    assert_same_clusters(points, *TwoMeans().fit(points))
+
+
+def blobs(rng, n=50):
+    left = rng.normal((100, 100), 10, (n, 2))
+    right = rng.normal((100, 900), 10, (n, 2))
+    return np.concatenate([left, right])
+
+
+def test_warm_start_keeps_cluster_order():
+    rng = np.random.default_rng(0)
+    engine = TwoMeans()
+    labels, centroids = engine.fit(blobs(rng))
+    assert engine.starts == {}
+
+    # the clusters of the key in the other order
+    engine.starts["station"] = centroids[::-1]
+    points = blobs(rng)
+    cold, _ = TwoMeans().fit(points)
+    warm, warm_centroids = engine.fit(points, "station")
+    np.testing.assert_array_equal(warm, 1 - cold)
+    np.testing.assert_array_equal(engine.starts["station"], warm_centroids)
+    assert warm_centroids[0][1] > warm_centroids[1][1]
+
+
+def test_warm_starts_evicted_least_recently_used():
+    rng = np.random.default_rng(1)
+    engine = TwoMeans(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        engine.fit(blobs(rng), key)
+    assert list(engine.starts) == ["a", "c"]
+
+
+def test_too_few_points():
+    with pytest.raises(ValueError, match="at least 2 are needed"):
+        TwoMeans().fit([[1, 2]])
+    with pytest.raises(ValueError, match="same point"):
+        TwoMeans().fit([[1, 2], [1, 2], [1, 2]])
+
+
+def test_upload_warm_starts_station(server, client, login, sample, monkeypatch):
+    monkeypatch.setitem(server.app.config, "CLUSTER_WARM_START", True)
+    user = f"warm-{uuid.uuid4().hex}"
+    headers = login(user)
+    form = {"file": (io.BytesIO(sample("lines_2.jpeg")), "lines_2.jpeg"), "station": "s1", "format": "json"}
+    response = client.post("/api/v3/upload", data=form, headers=headers, content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert response.json["msfl"] == pytest.approx(CLUSTERING["lines_2.jpeg"][1])
+    assert (user, "s1") in clustering.ENGINE.starts
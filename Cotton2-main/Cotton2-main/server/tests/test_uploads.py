@@ -0,0 +1,211 @@
+import hashlib
+import io
+import time
+import zipfile
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+
+def upload(client, headers, data, filename="lines_1.jpg", version="v2", **form):
+    form["file"] = (io.BytesIO(data), filename)
+    return client.post(
+        f"/api/{version}/upload", data=form, headers=headers, content_type="multipart/form-data"
+    )
+
+
+def stored_file(server, data):
+    return server.files_collection.find_one({"sha256": hashlib.sha256(data).hexdigest()})
+
+
+def test_same_image_stored_once(server, client, login, sample):
+    data = sample("lines_3.jpg")
+    alice, bob = login(), login()
+    assert upload(client, alice, data, "a.jpg").status_code == 200
+    assert upload(client, bob, data, "b.jpg").status_code == 200
+
+    stored = stored_file(server, data)
+    assert server.files_collection.count_documents({"sha256": stored["sha256"]}) == 1
+    assert server.db["files.chunks"].count_documents({"files_id": stored["_id"]}) == 1
+    uploads = list(server.uploads_collection.find({"file_id": stored["_id"]}))
+    assert sorted(u["filename"] for u in uploads) == ["a.jpg", "b.jpg"]
+
+
+def test_concurrent_duplicate_leaves_no_chunks(server, sample):
+    data = sample("image-2.jpg")
+    file_id, digest = server.store_file(io.BytesIO(data), "first.jpg", "image/jpeg")
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+
+    # the other upload is not found before it is stored
+    find_one = server.files_collection.find_one
+    misses = []
+
+    def miss_once(*args, **kwargs):
+        if args and "sha256" in args[0] and not misses:
+            misses.append(args[0])
+            return None
+        return find_one(*args, **kwargs)
+
+    server.files_collection.find_one = miss_once
+    try:
+        again, _ = server.store_file(io.BytesIO(data), "second.jpg", "image/jpeg")
+    finally:
+        server.files_collection.find_one = find_one
+    assert misses and again == file_id
+    assert server.files_collection.count_documents({"sha256": digest.hexdigest()}) == 1
+    # no chunks without their file
+    file_ids = {f["_id"] for f in server.files_collection.find({}, {"_id": 1})}
+    assert {c["files_id"] for c in server.db["files.chunks"].find({}, {"files_id": 1})} <= file_ids
+
+
+def test_download(server, client, login, sample):
+    data = sample("lines_1.jpg")
+    headers = login()
+    upload(client, headers, data, "mine.jpg")
+    file_id = stored_file(server, data)["_id"]
+    url = f"/api/v1/files/{file_id}"
+
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "mine.jpg" in response.headers["Content-Disposition"]
+
+    response = client.get(url, headers={**headers, "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.data == data[100:200]
+
+    etag = f'"{hashlib.sha256(data).hexdigest()}"'
+    assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    assert client.get(url, headers=login()).status_code == 404
+    assert client.get("/api/v1/files/nope", headers=headers).status_code == 404
+
+
+@pytest.fixture
+def limits(server):
+    config = server.app.config
+    saved = {key: config[key] for key in ("MAX_CONTENT_LENGTH", "UPLOAD_MEMORY_BYTES", "BATCH_MAX_BYTES")}
+    yield config
+    config.update(saved)
+
+
+def test_body_limits(server, client, login, sample, limits):
+    data = sample("lines_1.jpg")
+    headers = login()
+    limits["MAX_CONTENT_LENGTH"] = len(data) // 2
+    response = upload(client, headers, data)
+    assert response.status_code == 413
+    assert response.json["result"] == "failure"
+
+    # batches are limited by BATCH_MAX_BYTES instead
+    response = client.post(
+        "/api/v2/batch",
+        data={"file": [(io.BytesIO(data), "lines_1.jpg")]},
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+
+
+def batch(client, headers, *files):
+    return client.post(
+        "/api/v2/batch",
+        data={"file": [(io.BytesIO(data), name) for name, data in files]},
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+
+
+def test_batch_files_share_byte_budget(server, client, login, sample, limits):
+    # an archive far smaller than its images, so the body is within the limit
+    _, bmp = cv.imencode(".bmp", np.zeros((400, 400, 3), np.uint8))
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("blank.bmp", bmp.tobytes())
+    image = sample("lines_1.jpg")
+    limits["BATCH_MAX_BYTES"] = bmp.size + len(image) - 1
+    response = batch(client, login(), ("images.zip", archive.getvalue()), ("lines_1.jpg", image))
+    assert response.status_code == 400
+    assert "bytes in the batch" in response.json["msg"]
+
+
+def test_batch_holds_job_slots(server, client, login, sample):
+    headers = login()
+    free = server.jobs.max_pending - server.jobs.pending
+    server.jobs.reserve(free)
+    try:
+        response = batch(client, headers, ("lines_1.jpg", sample("lines_1.jpg")))
+        assert response.status_code == 429
+    finally:
+        server.jobs.release(free)
+    assert batch(client, headers, ("lines_1.jpg", sample("lines_1.jpg"))).status_code == 200
+    assert server.jobs.max_pending - server.jobs.pending == free
+
+
+def test_large_bodies_spooled(server, client, login, sample, limits):
+    streams = []
+    get_file_stream = server.UploadRequest._get_file_stream
+
+    def spy(self, *args, **kwargs):
+        stream = get_file_stream(self, *args, **kwargs)
+        streams.append(type(stream).__name__)
+        return stream
+
+    data = sample("lines_1.jpg")
+    headers = login()
+    limits["UPLOAD_MEMORY_BYTES"] = len(data) // 2
+    server.UploadRequest._get_file_stream = spy
+    try:
+        assert upload(client, headers, data).status_code == 200
+        limits["UPLOAD_MEMORY_BYTES"] = 2 * len(data)
+        assert upload(client, headers, data).status_code == 200
+    finally:
+        server.UploadRequest._get_file_stream = get_file_stream
+    assert streams == ["SpooledTemporaryFile", "BytesIO"]
+
+
+def test_failed_store_reported(server, client, login, sample, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("no primary")
+
+    monkeypatch.setattr(server.analyses_collection, "insert_one", fail)
+    failed = server.STORE_ERRORS.values.get(("v2",), 0)
+    response = upload(client, login(), sample("lines_1.jpg"))
+    assert response.status_code == 500
+    assert "no primary" in response.json["msg"]
+    assert server.STORE_ERRORS.values[("v2",)] == failed + 1
+
+
+def test_warm_started_results_not_cached(server, client, login, sample, monkeypatch):
+    monkeypatch.setitem(server.app.config, "CLUSTER_WARM_START", True)
+    headers = login()
+    data = sample("lines_2.jpeg")
+    bypassed = server.ANALYSES.values.get(("v3", "bypass"), 0)
+    for _ in range(2):
+        response = upload(client, headers, data, "a.jpeg", "v3", station="s1", format="json")
+        assert response.status_code == 200
+        assert "X-Cache" not in response.headers
+    assert server.ANALYSES.values[("v3", "bypass")] == bypassed + 2
+
+    # without a station there is no warm start
+    upload(client, headers, data, "a.jpeg", "v3", format="json")
+    response = upload(client, headers, data, "a.jpeg", "v3", format="json")
+    assert response.headers["X-Cache"] == "HIT"
+
+
+def test_async_upload(server, client, login, sample):
+    headers = login()
+    response = upload(client, headers, sample("image-2.jpg"), "async.jpg", "v3", format="json", **{"async": "1"})
+    assert response.status_code == 202
+    url = response.json["status_url"]
+    assert client.get(url, headers=login()).status_code == 404
+    for _ in range(1000):
+        response = client.get(url, headers=headers)
+        if response.json.get("status") not in ("queued", "running"):
+            break
+        time.sleep(0.01)
+    assert response.status_code == 200
+    assert response.json["msfl"] == pytest.approx(1027.0136625731502)
+    assert len(client.get("/api/v1/image_details", headers=headers).json["data"]) == 1
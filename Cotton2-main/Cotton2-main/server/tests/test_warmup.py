@@ -0,0 +1,98 @@
+import io
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+import warmup
+from analysis import load
+
+# pipeline -> v3 MSFL, IFL and ML, or the number and total length of the
+# fibers of the other versions, on the warm-up image
+RESULTS = {
+    "v3": (359.5406439151151, 361.5406439151151, 281.3094528530153),
+    "v2": (11, 3257.9869401394035),
+    "v1.1": (13, 4993.054599881172),
+    "v1.2": (12, 3446.1290757631364),
+}
+
+IMPORT_APP = """
+import sys
+from unittest import mock
+
+import mongomock
+import mongomock.gridfs
+import pymongo
+
+mongomock.gridfs.enable_gridfs_integration()
+with mock.patch.object(pymongo, "MongoClient", mongomock.MongoClient):
+    import app
+print(" ".join(sorted(sys.modules)))
+"""
+
+
+def test_app_imports_no_pipelines():
+    pytest.importorskip("mongomock")
+    env = dict(os.environ, ANALYSIS_WORKERS="0", ANALYSIS_WARM_UP="0", PYTHONWARNINGS="ignore")
+    server = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_APP], cwd=server, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    modules = set(output.split())
+    assert "app" in modules
+    pipelines = {"pipeline", "clustering", "segmentation", "lines_1", "lines_2"}
+    assert not modules & (pipelines | {"sklearn", "skan", "skimage", "plantcv"})
+
+
+def test_warm_up_runs_every_pipeline(caplog):
+    timings = warmup.warm_up()
+    assert list(timings) == list(RESULTS)
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+
+@pytest.mark.parametrize("version, params", warmup.PIPELINES)
+def test_warm_up_image(version, params):
+    result = warmup.run_analysis(version, "warm-up", warmup.sample_image(), params)
+    if version == "v3":
+        assert [result[key] for key in ("msfl", "ifl", "ml")] == pytest.approx(RESULTS["v3"], rel=1e-9)
+    else:
+        count, total = RESULTS[f"{version}.{params['method']}" if "method" in params else version]
+        assert len(result["length"][1]) == count
+        assert float(np.sum(result["length"][1])) == pytest.approx(total, rel=1e-9)
+
+
+def test_concurrent_loads():
+    modules = []
+    threads = [threading.Thread(target=lambda: modules.append(load("segmentation"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(modules) == 4 and all(module is modules[0] for module in modules)
+
+
+def test_upload_waits_for_warm_up(server, login, monkeypatch):
+    monkeypatch.setitem(server.app.config, "ANALYSIS_WARM_UP", True)
+    monkeypatch.setattr(server, "warmed_up", threading.Event())
+    headers = login()
+    # an image not in the result cache, which would answer without analysing
+    data = warmup.sample_image(width=417)
+    responses = []
+
+    def upload():
+        form = {"file": (io.BytesIO(data), "fibers.png"), "format": "json"}
+        response = server.app.test_client().post(
+            "/api/v3/upload", data=form, headers=headers, content_type="multipart/form-data"
+        )
+        responses.append(response)
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()
+    server.warmed_up.set()
+    thread.join()
+    assert responses[0].status_code == 200
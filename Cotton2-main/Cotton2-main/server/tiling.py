@@ -0,0 +1,314 @@
+"""
+Tiled preprocessing of images too large to hold several full-size copies of.
+
+A chain of stages is run tile by tile: every tile is read with a halo wide
+enough for the local stages of the chain (their HALOS), processed, and only
+its core is written to the output. Stages that need the whole image have
+tiled implementations here: remove_small_objects labels every tile and joins
+the labels across tile borders, invert_bright sums the histograms of the
+tiles, pyr_down halves the image one tile at a time. The result is the same
+as running the chain on the whole image, as long as objects are thinner than
+SKELETON_HALO for the skeletonize stages.
+
+Only the input of the current stage and its output are kept at full size,
+as 1 byte per pixel arrays, or memory-mapped files in workdir if one is
+given. .npy and uncompressed .tif images are read with memory mapping, other
+formats are decoded in one go.
+"""
+import os
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from images import read_image
+from pipeline import HALOS, STAGES
+
+TILE = 2048
+
+
+class Raster:
+    """Windowed read access to an image in memory or mapped from a file"""
+
+    def __init__(self, array, rgb=False, gray=False):
+        self.array = array
+        self.rgb = rgb  # channels are in RGB order, as tifffile reads them
+        self.gray = gray  # convert color windows to grayscale
+        self.shape = array.shape[:2]
+
+    def window(self, y0, y1, x0, x1):
+        img = np.asarray(self.array[y0:y1, x0:x1])
+        if img.ndim == 3:
+            if self.gray:
+                code = cv.COLOR_RGB2GRAY if self.rgb else cv.COLOR_BGR2GRAY
+                return cv.cvtColor(np.ascontiguousarray(img), code)
+            if self.rgb:
+                img = img[..., ::-1]
+        return np.ascontiguousarray(img)
+
+    def read(self):
+        return self.window(0, self.shape[0], 0, self.shape[1])
+
+
+def open_raster(source, flags=cv.IMREAD_COLOR):
+    """
+    Raster of an image given as a path, encoded bytes or an array.
+    .npy files and uncompressed TIFF files are memory-mapped.
+    """
+    gray = flags == cv.IMREAD_GRAYSCALE
+    if isinstance(source, np.ndarray):
+        return Raster(source, gray=gray)
+
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".npy":
+            return Raster(np.load(path, mmap_mode="r"), gray=gray)
+        if extension in (".tif", ".tiff"):
+            import tifffile
+
+            try:
+                array = tifffile.memmap(path, mode="r")
+            except ValueError:
+                # compressed or tiled TIFF files cannot be mapped
+                array = tifffile.imread(path)
+            return Raster(array, rgb=True, gray=gray)
+
+    return Raster(read_image(source, flags))
+
+
+def _allocate(shape, dtype, workdir):
+    if workdir is None:
+        return np.empty(shape, dtype)
+    # the file is deleted when the array is garbage collected
+    return np.memmap(tempfile.TemporaryFile(dir=workdir), dtype=dtype, mode="w+", shape=shape)
+
+
+def _halo(name, params):
+    halo = HALOS[name]
+    return halo(**params) if callable(halo) else halo
+
+
+def _tiles(shape, tile):
+    height, width = shape
+    for y0 in range(0, height, tile):
+        for x0 in range(0, width, tile):
+            yield y0, min(y0 + tile, height), x0, min(x0 + tile, width)
+
+
+def _window(src, y0, y1, x0, x1):
+    if isinstance(src, Raster):
+        return src.window(y0, y1, x0, x1)
+    return np.asarray(src[y0:y1, x0:x1])
+
+
+def _time(timings, name, start):
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def run_local(src, steps, tile=TILE, timings=None, workdir=None):
+    """Run stages that only look at a neighbourhood of each pixel, tile by tile"""
+    halo = sum(_halo(name, params) for name, params in steps)
+    height, width = src.shape[:2]
+    out = None
+
+    for y0, y1, x0, x1 in _tiles((height, width), tile):
+        wy0, wy1 = max(y0 - halo, 0), min(y1 + halo, height)
+        wx0, wx1 = max(x0 - halo, 0), min(x1 + halo, width)
+
+        start = time.perf_counter()
+        img = _window(src, wy0, wy1, wx0, wx1)
+        _time(timings, "read", start)
+
+        for name, params in steps:
+            start = time.perf_counter()
+            img = STAGES[name](img, **params)
+            _time(timings, name, start)
+
+        if out is None:
+            out = _allocate((height, width) + img.shape[2:], img.dtype, workdir)
+        out[y0:y1, x0:x1] = img[y0 - wy0 : y1 - wy0, x0 - wx0 : x1 - wx0]
+
+    return out
+
+
+def pyr_down(src, levels=1, tile=TILE, workdir=None):
+    """
+    pyr_down of a full-size image, one level at a time and tile by tile.
+    Tiles start on even rows and columns and are read with a halo wider than
+    the 5x5 kernel of cv.pyrDown, so the result is the same as for the whole
+    image.
+    """
+    tile -= tile % 2
+    halo = 4
+    for _ in range(levels):
+        height, width = src.shape[:2]
+        out = None
+        for y0, y1, x0, x1 in _tiles((height, width), tile):
+            wy0, wy1 = max(y0 - halo, 0), min(y1 + halo, height)
+            wx0, wx1 = max(x0 - halo, 0), min(x1 + halo, width)
+            img = STAGES["pyr_down"](_window(src, wy0, wy1, wx0, wx1))
+
+            if out is None:
+                shape = ((height + 1) // 2, (width + 1) // 2)
+                out = _allocate(shape + img.shape[2:], img.dtype, workdir)
+            # output pixel i of the window is its input pixel 2 * i
+            oy0, oy1 = y0 // 2, (y1 + 1) // 2
+            ox0, ox1 = x0 // 2, (x1 + 1) // 2
+            out[oy0:oy1, ox0:ox1] = img[
+                oy0 - wy0 // 2 : oy1 - wy0 // 2, ox0 - wx0 // 2 : ox1 - wx0 // 2
+            ]
+        src = out
+    return src
+
+
+def _label(img):
+    # 8-connected components, as remove_small_objects(connectivity=2)
+    n, labels, stats, _ = cv.connectedComponentsWithStats(
+        (np.asarray(img) != 0).astype(np.uint8), connectivity=8, ltype=cv.CV_32S
+    )
+    return n, labels, stats[:, cv.CC_STAT_AREA]
+
+
+def _border_pairs(a, b):
+    """Pairs of labels of two adjacent lines of pixels that touch, 8-connected"""
+    pairs = []
+    for shift in (-1, 0, 1):
+        if shift < 0:
+            u, v = a[-shift:], b[:shift]
+        elif shift > 0:
+            u, v = a[:-shift], b[shift:]
+        else:
+            u, v = a, b
+        touching = (u > 0) & (v > 0)
+        pairs.append(np.stack([u[touching], v[touching]], axis=1))
+    return np.concatenate(pairs)
+
+
+def remove_small_objects(src, min_size, tile=TILE, workdir=None):
+    """
+    remove_small_objects(connectivity=2) of a full-size binary image, with
+    only one tile labelled at a time.
+    """
+    height, width = src.shape[:2]
+    tiles = list(_tiles((height, width), tile))
+
+    # label every tile, number the labels globally and keep the labels of the
+    # first and last rows and columns of every tile
+    offsets = {}
+    areas = [np.zeros(1, np.int64)]  # global label 0 is the background
+    rows, cols = {}, {}
+    count = 1
+    for y0, y1, x0, x1 in tiles:
+        n, labels, area = _label(_window(src, y0, y1, x0, x1))
+        labels = np.where(labels > 0, labels + count - 1, 0)
+        offsets[y0, x0] = count
+        areas.append(area[1:])
+        rows[y0, x0] = (labels[0].copy(), labels[-1].copy())
+        cols[y0, x0] = (labels[:, 0].copy(), labels[:, -1].copy())
+        count += n - 1
+    areas = np.concatenate(areas)
+
+    # components that continue across a tile border are joined
+    pairs = [np.zeros((0, 2), np.int64)]
+    for y in range(tile, height, tile):
+        above = np.concatenate([rows[y - tile, x][1] for x in range(0, width, tile)])
+        below = np.concatenate([rows[y, x][0] for x in range(0, width, tile)])
+        pairs.append(_border_pairs(above, below))
+    for x in range(tile, width, tile):
+        left = np.concatenate([cols[y, x - tile][1] for y in range(0, height, tile)])
+        right = np.concatenate([cols[y, x][0] for y in range(0, height, tile)])
+        pairs.append(_border_pairs(left, right))
+    pairs = np.concatenate(pairs)
+
+    graph = sparse.coo_matrix(
+        (np.ones(len(pairs), bool), (pairs[:, 0], pairs[:, 1])), shape=(count, count)
+    )
+    _, component = connected_components(graph, directed=False)
+    sizes = np.bincount(component, weights=areas)
+    keep = sizes[component] >= min_size
+    keep[0] = False
+
+    out = _allocate((height, width), bool, workdir)
+    for y0, y1, x0, x1 in tiles:
+        _, labels, _ = _label(_window(src, y0, y1, x0, x1))
+        labels = np.where(labels > 0, labels + offsets[y0, x0] - 1, 0)
+        out[y0:y1, x0:x1] = keep[labels]
+    return out
+
+
+def otsu_threshold(hist):
+    """Otsu's threshold of a 256 bin histogram, computed as OpenCV does"""
+    scale = 1.0 / hist.sum()
+    mu = 0.0
+    for i in range(256):
+        mu += i * float(hist[i])
+    mu *= scale
+
+    eps = np.finfo(np.float32).eps
+    mu1 = q1 = 0.0
+    max_sigma = max_val = 0
+    for i in range(256):
+        p_i = hist[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1.0 - eps:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
+
+
+def is_bright(src, threshold=128, tile=TILE):
+    """The test of the invert_bright stage, from the histograms of the tiles"""
+    hist = np.zeros(256, np.int64)
+    for y0, y1, x0, x1 in _tiles(src.shape[:2], tile):
+        hist += np.bincount(_window(src, y0, y1, x0, x1).ravel(), minlength=256)
+    t = otsu_threshold(hist)
+    return 255 * hist[t + 1 :].sum() / hist.sum() >= threshold
+
+
+def run_tiled(raster, steps, tile=TILE, timings=None, workdir=None):
+    """
+    Result of a chain of stages run on a Raster (see open_raster), computed
+    tile by tile.
+    """
+    img, steps = raster, list(steps)
+    local = []
+    while steps:
+        name, params = steps.pop(0)
+        if HALOS[name] is not None:
+            local.append((name, params))
+            continue
+
+        # the image must be complete before a stage that needs all of it
+        if local:
+            img = run_local(img, local, tile, timings, workdir)
+            local = []
+
+        start = time.perf_counter()
+        if name == "invert_bright":
+            if is_bright(img, tile=tile, **params):
+                local.append(("invert", {}))
+        elif name == "remove_small_objects":
+            img = remove_small_objects(img, tile=tile, workdir=workdir, **params)
+        elif name == "pyr_down":
+            img = pyr_down(img, tile=tile, workdir=workdir, **params)
+        else:
+            raise ValueError(f"Stage {name} cannot be run on tiles")
+        _time(timings, name, start)
+
+    if local:
+        img = run_local(img, local, tile, timings, workdir)
+    if isinstance(img, Raster):
+        img = img.read()
+    return img
@@ -0,0 +1,87 @@
+"""
+Topology of a skeleton, read from the CSR arrays of its skan Skeleton.
+
+skan keeps the paths of a skeleton as a CSR matrix: the pixels of path i are
+paths.indices[paths.indptr[i]:paths.indptr[i + 1]], in order along it, and
+degrees[j] is the number of skeleton pixels next to pixel j (8-connected).
+The endpoints, degrees and extents of paths are read from these arrays in
+compiled loops instead of building a coordinate array for every path.
+"""
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def _long_paths(indptr, lengths, min_length, min_points):
+    keep = np.empty(len(indptr) - 1, np.intp)
+    n = 0
+    for i in range(len(indptr) - 1):
+        if lengths[i] > min_length and indptr[i + 1] - indptr[i] > min_points:
+            keep[n] = i
+            n += 1
+    return keep[:n]
+
+
+@numba.njit(cache=True)
+def _path_ends(indptr, indices, paths):
+    n = len(paths)
+    ends = np.empty(2 * n, np.intp)
+    for k in range(n):
+        i = paths[k]
+        ends[k] = indices[indptr[i]]
+        ends[n + k] = indices[indptr[i + 1] - 1]
+    return ends
+
+
+@numba.njit(cache=True)
+def _gather(indptr, indices, paths):
+    n = len(paths)
+    offsets = np.zeros(n + 1, np.intp)
+    for k in range(n):
+        i = paths[k]
+        offsets[k + 1] = offsets[k] + indptr[i + 1] - indptr[i]
+    nodes = np.empty(offsets[n], np.intp)
+    for k in range(n):
+        i = paths[k]
+        nodes[offsets[k] : offsets[k + 1]] = indices[indptr[i] : indptr[i + 1]]
+    return nodes, offsets
+
+
+def long_paths(skeleton, min_length=0, min_points=0, lengths=None):
+    """
+    Indices of the paths longer than min_length pixels (along the path) with
+    more than min_points pixels. lengths are skeleton.path_lengths() if
+    already computed.
+    """
+    if lengths is None:
+        lengths = skeleton.path_lengths()
+    return _long_paths(
+        skeleton.paths.indptr, np.asarray(lengths, float), min_length, min_points
+    )
+
+
+def path_ends(skeleton, paths):
+    """Pixel ids of the first point of every path, then of their last points"""
+    return _path_ends(skeleton.paths.indptr, skeleton.paths.indices, np.asarray(paths, np.intp))
+
+
+def degrees(skeleton, pixels):
+    """Number of skeleton pixels next to each pixel id"""
+    return skeleton.degrees[pixels]
+
+
+def coordinates(skeleton, pixels):
+    """(row, col) integer coordinates of pixel ids"""
+    return skeleton.coordinates[pixels].astype(int)
+
+
+def path_coordinates(skeleton, paths):
+    """
+    Coordinates of the pixels of every path, as views of one array gathered
+    in a single pass rather than an array built per path.
+    """
+    nodes, offsets = _gather(
+        skeleton.paths.indptr, skeleton.paths.indices, np.asarray(paths, np.intp)
+    )
+    coords = coordinates(skeleton, nodes)
+    return [coords[offsets[k] : offsets[k + 1]] for k in range(len(paths))]
@@ -0,0 +1,146 @@
+"""
+2-means clustering of the endpoints of a v3 analysis.
+
+The endpoints of an image are a few hundred 2-D points, so Lloyd's algorithm
+on two clusters takes a few vectorized passes; a general k-means estimator
+spends more time validating and setting up than clustering.
+
+The cold start is the one of KMeans(n_clusters=2, random_state=42), k-means++
+seeding from the same random state, and Lloyd's iterations stop on the same
+tolerance, so the clusters are the ones the analyses have always been run
+with. With a key (e.g. the user and station of an image, where the camera
+frames the beard the same way), the iterations start from the centroids last
+found for that key instead, and the clusters keep the order they had for it.
+A warm start converges to the same clusters on well separated endpoints, but
+may settle on another split of ambiguous ones.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MAX_ITER = 300
+TOL = 1e-4
+RANDOM_STATE = 42
+
+# the draws of KMeans(random_state=42) for its seeding: one to choose the
+# first centroid, two for the candidates of the second. This is how
+# scikit-learn 1.6 (pinned in requirements.txt) consumes its random state;
+# tests/test_twomeans.py checks the clusters against KMeans itself
+DRAWS = np.random.RandomState(RANDOM_STATE).random_sample(3)
+
+
+def squared_distances(points, centroids, squared_norms):
+    """Squared distances from the points to each centroid, computed as sklearn does"""
+    distances = -2 * (centroids @ points.T)
+    distances += (centroids**2).sum(axis=1)[:, None]
+    distances += squared_norms[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def kmeans_plusplus(points, squared_norms):
+    """
+    Two initial centroids by greedy k-means++, drawn as sklearn draws them
+    from random_state=42.
+    """
+    n = len(points)
+    weights = np.ones(n)
+    # RandomState.choice(n, p=weights / weights.sum())
+    cdf = (weights / weights.sum()).cumsum()
+    cdf /= cdf[-1]
+    first = cdf.searchsorted(DRAWS[0], side="right")
+    closest = squared_distances(points, points[[first]], squared_norms)[0]
+    potential = closest @ weights
+
+    # 2 + log(n_clusters) candidates, the one reducing the potential most wins
+    candidates = np.searchsorted(
+        np.cumsum(weights * closest, dtype=np.float64), DRAWS[1:] * potential
+    )
+    np.clip(candidates, None, n - 1, out=candidates)
+    distances = squared_distances(points, points[candidates], squared_norms)
+    np.minimum(closest, distances, out=distances)
+    second = candidates[np.argmin(distances @ weights)]
+    return points[[first, second]].astype(float)
+
+
+def assign(points, centroids):
+    """Nearest centroid of each point, the first one on ties"""
+    distances = (centroids**2).sum(axis=1)[:, None] - 2 * (centroids @ points.T)
+    return (distances[1] < distances[0]).astype(int)
+
+
+def lloyd(points, centroids, tol, max_iter=MAX_ITER):
+    """
+    Labels and centroids of Lloyd's algorithm from the given centroids, run
+    until no point changes cluster or the centroids move less than tol
+    (squared). Returns None if a cluster gets empty.
+    """
+    labels = None
+    converged = False
+    for _ in range(max_iter):
+        new_labels = assign(points, centroids)
+        counts = np.bincount(new_labels, minlength=2)
+        if not counts.all():
+            return None
+        new_centroids = np.stack(
+            [np.bincount(new_labels, weights=points[:, i], minlength=2) for i in (0, 1)],
+            axis=1,
+        ) / counts[:, None]
+        shift = ((new_centroids - centroids) ** 2).sum()
+        centroids = new_centroids
+        if labels is not None and np.array_equal(new_labels, labels):
+            converged = True
+            break
+        labels = new_labels
+        if shift <= tol:
+            break
+    if not converged:
+        # the labels go with the last centroids
+        labels = assign(points, centroids)
+    return labels, centroids
+
+
+class TwoMeans:
+    """
+    2-means of point sets, warm-started from the centroids last found for
+    the same key. The last centroids of max_keys keys are kept, in LRU order.
+    """
+
+    def __init__(self, max_keys=1024):
+        self.max_keys = max_keys
+        self.starts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fit(self, points, key=None):
+        """Labels (0 or 1) of the points and the centroids of the two clusters"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(points) < 2:
+            raise ValueError(f"{len(points)} endpoints, at least 2 are needed for 2 clusters")
+
+        # centered points, for accurate distances
+        mean = points.mean(axis=0)
+        points = points - mean
+        tol = np.var(points, axis=0).mean() * TOL
+        if tol == 0:
+            raise ValueError("All endpoints are at the same point, they cannot be split in 2 clusters")
+
+        start = None
+        if key is not None:
+            with self.lock:
+                start = self.starts.get(key)
+        result = None if start is None else lloyd(points, start - mean, tol)
+        if result is None:
+            squared_norms = (points**2).sum(axis=1)
+            result = lloyd(points, kmeans_plusplus(points, squared_norms), tol)
+        if result is None:
+            raise ValueError("The endpoints could not be split in 2 clusters")
+        labels, centroids = result
+        centroids = centroids + mean
+
+        if key is not None:
+            with self.lock:
+                self.starts[key] = centroids
+                self.starts.move_to_end(key)
+                while len(self.starts) > self.max_keys:
+                    self.starts.popitem(last=False)
+        return labels, centroids
@@ -0,0 +1,64 @@
+"""
+Warm-up of the analysis pipelines.
+
+The first analysis in a process imports the dependencies of its pipeline
+and compiles skan's numba functions, which takes seconds. warm_up runs every
+pipeline once on a small synthetic image, so a worker pays for this when it
+starts instead of in its first request.
+"""
+import logging
+import time
+
+import cv2 as cv
+import numpy as np
+
+from analysis import run_analysis
+
+logger = logging.getLogger(__name__)
+
+# (version, params) of every pipeline, as run_analysis takes them, the most
+# used first
+PIPELINES = (
+    ("v3", {"calibration_factor": 1.0}),
+    ("v2", {}),
+    ("v1", {"method": 1}),
+    ("v1", {"method": 2}),
+)
+
+
+def sample_image(width=400, height=300):
+    """
+    PNG bytes of a few light curved fibers on a dark background, an image
+    every pipeline gets through to the end (v3 needs light fibers).
+    """
+    img = np.zeros((height, width, 3), np.uint8)
+    x = np.arange(20, width - 20)
+    for i, y0 in enumerate(range(25, height - 20, 22)):
+        y = y0 + 6 * np.sin(x / (15 + 5 * i))
+        end = len(x) - 15 * i  # fibers of different lengths
+        points = np.stack([x[:end], y[:end]], axis=1).round().astype(np.int32)
+        cv.polylines(img, [points], isClosed=False, color=(215, 215, 215), thickness=3)
+    _, encoded = cv.imencode(".png", img)
+    return encoded.tobytes()
+
+
+def warm_up():
+    """
+    Run every pipeline once. Returns the seconds each took; errors are
+    logged, not raised, so a failed warm-up only leaves the work to the
+    first request.
+    """
+    data = sample_image()
+    timings = {}
+    for version, params in PIPELINES:
+        name = f"{version}.{params['method']}" if "method" in params else version
+        start = time.perf_counter()
+        try:
+            run_analysis(version, "warm-up", data, params)
+        except Exception:
+            logger.exception("Warm-up of %s failed", name)
+        timings[name] = time.perf_counter() - start
+    logger.info(
+        "Pipelines warmed up: %s", ", ".join(f"{n} {t:.2f} s" for n, t in timings.items())
+    )
+    return timings